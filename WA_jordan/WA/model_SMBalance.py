@@ -15,9 +15,35 @@ import xarray as xr
 #import datetime
 import warnings
 import time
+import netCDF4
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from WAsheets import reclassify as rc
 import dask
 dask.config.set(scheduler='synchronous')
 
+# (nc_files key, output file, variable name, quantity) of the SMBalance outputs
+SMBALANCE_OUTPUTS = [
+    ('ETB', 'etincr_monthly.nc', 'Incremental_ET_M', 'Incremental_ET_M'),
+    ('ETG', 'etrain_monthly.nc', 'Rainfall_ET_M', 'Rainfall_ET_M'),
+    ('SRO', 'sro_monthly.nc', 'SRO_M', 'SRO_M'),
+    ('PERC', 'perco_monthly.nc', 'PERC_M', 'PERC_M'),
+    ('DPERC', 'd_perco_monthly.nc', 'D_PERC_M', 'D_PERC_M'),
+    ('Supply', 'supply_monthly.nc', 'Supply_M', 'Supply_M'),
+    ('ISRO', 'd_sro_monthly.nc', 'Incremental_SRO_M', 'Incremental_SRO_M'),
+    ('RDSM', 'sm_monthly.nc', 'Root_Depth_Soil_Moisture_M', 'Root_Depth_Soil_Moisture_M'),
+    ('GW', 'gw_monthly.nc', 'Groundwater_Storage_M', 'Grounwater_Storage_M'),
+    ('BF', 'bf_monthly.nc', 'Base_Flow_M', 'Base_Flow_M'),
+    ('TF', 'tf_monthly.nc', 'Total_Flow_M', 'Total_Flow_M'),
+    ]
+
+# LU codes treated as open water in the balance
+WATER_LU_CODES = [4, 23, 24, 63, 75]
+
+# memory ceiling in MB of the numpy engine tiles when max_memory is not given
+DEFAULT_MAX_MEMORY = 4096
+
 
 #%% Functions
 def open_nc(nc,timechunk=1,chunksize=1000):
@@ -179,18 +205,13 @@ def get_rootdepth_wa_plus(version = '1.0'):
 
 
 def root_depth(lu, root_depth_version):
-    rootdepth=lu.copy()
+    lu_categories, root_depth = get_rootdepth_wa_plus(version = root_depth_version)
+    rootdepth=rc.reclassify(lu, lu_categories, root_depth)
     rootdepth.name='Root depth'
     rootdepth.attrs={'units':'mm',
                     'quantity':'Effective root depth',
                     'source':'Root depth lookup table',
                     'period':'year'}
-    lu_categories, root_depth = get_rootdepth_wa_plus(version = root_depth_version)
-    for key in root_depth.keys():
-      lu_codes=lu_categories[key]
-      for lu_code in lu_codes:
-          rd = root_depth[key]
-          rootdepth=rootdepth.where(lu!=lu_code,rd)
     return rootdepth 
 
 
@@ -256,20 +277,13 @@ def get_fractions(version = '1.0'):
     return consumed_fractions[version], lucs[version]
 
 def Consumed_fraction(lu):
-    f_consumed=lu.copy()
+    consumed_fractions, lu_categories = get_fractions(version = '1.0')
+    f_consumed=rc.reclassify(lu, lu_categories, consumed_fractions)
     f_consumed.name='Consumed fraction'
     f_consumed.attrs={'units':'Fraction',
                     'quantity':'Consumed fraction',
                     'source':'Consumed fraction look-up table',
                     'period':'year'}
-#    consumed_fractions = get_fractions(version = '1.0')
-    consumed_fractions, lu_categories = get_fractions(version = '1.0')
-#    lu_categories, root_depth = get_rootdepth(version = '1.0')
-    for key in consumed_fractions.keys():
-        lu_code=lu_categories[key]
-        consumed_fraction = consumed_fractions[key]
-        for code in lu_code:
-            f_consumed = f_consumed.where(lu!=code,consumed_fraction)
     return f_consumed 
 
 def OpenAsArray(fh, bandnumber = 1, dtype = 'float32', nan_values = False):
@@ -310,10 +324,339 @@ def OpenAsArray(fh, bandnumber = 1, dtype = 'float32', nan_values = False):
     Array = Array.astype(np.float32)
     return Array
 
+#%% NumPy engine
+def smbalance_block(Pt, E, Int, nRD, LU, thetasat, Ari,
+                    f_perc=1, f_Smax=0.9, cf=20, f_bf=0.1, deep_perc_f=0.1,
+                    root_depth_version='1.0', out=None):
+    '''
+    Run the soil moisture balance recursion on NumPy arrays.
+
+    Pt, E, Int, nRD: ndarray (time, lat, lon)
+        Monthly precipitation, actual ET, interception and rainy days
+    LU: ndarray (year, lat, lon)
+        Yearly land use, each map is used for 12 consecutive months
+    thetasat, Ari: ndarray (lat, lon)
+        Saturated water content and aridity index
+    out: dict, optional
+        Preallocated (time, lat, lon) buffers keyed as SMBALANCE_OUTPUTS,
+        created when not given
+
+    Returns
+    -------
+    out: dict
+        The eleven monthly outputs keyed as in SMBALANCE_OUTPUTS. The
+        arithmetic follows run_SMBalance step by step so that the results
+        are identical to the xarray implementation.
+    '''
+    if out is None:
+        dtype = np.result_type(Pt, E, Int, nRD, LU, thetasat, Ari)
+        out = {key: np.empty((12 * len(LU),) + Pt.shape[1:], dtype=dtype)
+               for key, _, _, _ in SMBALANCE_OUTPUTS}
+    lu_categories, root_depths = get_rootdepth_wa_plus(version=root_depth_version)
+    consumed_fractions, lu_fractions = get_fractions(version='1.0')
+    nRD = np.where(nRD != 0, nRD, 1)
+    SM = E[0] * 0
+    GW = E[0] * 0
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        for j in range(len(LU)):
+            lu = LU[j]
+            f_consumed = rc.reclassify(lu, lu_fractions, consumed_fractions)
+            mask = rc.isin(lu, WATER_LU_CODES)
+            Rd = rc.reclassify(lu, lu_categories, root_depths)
+            SMmax = Rd * thetasat
+            for t in range(j * 12, (j + 1) * 12):
+                SMt_1 = SM.copy()
+                GWt_1 = GW.copy()
+                P = Pt[t]
+                ETa = E[t]
+                I = Int[t]
+                NRD = nRD[t]
+                zero = P * 0
+                ### surface runoff as a function of SMt_1
+                SMt_1 = np.where(SMt_1 < SMmax, SMt_1, SMmax)
+                SRO = np.where((P - I) > 0,
+                               (((P - I) / NRD)**2) / ((P - I) / NRD + cf * (SMmax - SMt_1)),
+                               zero) * NRD
+                ### correct ETa for desert areas
+                ETa = np.where(ETa > 0, ETa, P)
+                ETa = np.where((ETa < P) & (Ari < 0.2), P, ETa)
+                SRO = np.where(mask & (P < ETa), zero, SRO)
+                SRO = np.where(mask & (P >= ETa), P - ETa, SRO)
+                ### percolation as a function of SMt_1
+                perc = np.where(SMt_1 > f_Smax * SMmax,
+                                SMt_1 * (np.exp(-f_perc / SMt_1)), zero)
+                Stemp = SMt_1 + (P - I) - (ETa - I) - SRO - perc
+                ### ETincr, ETrain, Qsupply and SM update
+                ETincr = np.where(Stemp >= 0, zero, -1 * Stemp)
+                ETincr = np.where(mask & (P >= ETa), zero,
+                                  np.where(mask & (P < ETa), ETa - P, ETincr))
+                ETrain = np.where(Stemp >= 0, ETa, ETa - ETincr)
+                ETrain = np.where(ETrain > 0, ETrain, 0)
+                Qsupply = np.where(Stemp >= 0, zero, ETincr / f_consumed)
+                SM = np.where(Stemp >= 0, Stemp, Stemp + Qsupply)
+                ### incremental percolation and incremental runoff
+                perc_incr = np.where((SM > SMmax) & (perc + SRO > 0),
+                                     (SM - SMmax) * perc / (perc + SRO), zero)
+                SROincr = np.where(SM > SMmax, SM - SMmax - perc_incr, zero)
+                overflow = SM - SMmax
+                SM = np.where(SM < SMmax, SM, SMmax)
+                SRO = SRO + np.where(overflow > 0, overflow, SRO)
+                ### groundwater storage, base flow and total flow
+                GW_temp = GWt_1 + perc + perc_incr
+                BF = GW_temp * f_bf
+                TF = BF + SRO + SROincr
+                GW = GW_temp - BF
+                Deep_perc = deep_perc_f * GW
+                GW = GW - Deep_perc
+
+                out['ETB'][t] = ETincr
+                out['ETG'][t] = ETrain
+                out['SRO'][t] = SRO
+                out['PERC'][t] = perc
+                out['DPERC'][t] = perc_incr
+                out['Supply'][t] = Qsupply
+                out['ISRO'][t] = SROincr
+                out['RDSM'][t] = SM
+                out['GW'][t] = GW
+                out['BF'][t] = BF
+                out['TF'][t] = TF
+    return out
+
+def get_tiles(ysize, xsize, tile_size):
+    '''
+    Split a (ysize, xsize) grid in windows of at most tile_size x tile_size
+    pixels, or (tile_y, tile_x) pixels when tile_size is a pair. Returns a
+    list of (latitude slice, longitude slice).
+    '''
+    tile_y, tile_x = np.broadcast_to(tile_size, 2).tolist()
+    return [(slice(y, min(y + tile_y, ysize)), slice(x, min(x + tile_x, xsize)))
+            for y in range(0, ysize, tile_y)
+            for x in range(0, xsize, tile_x)]
+
+def chunk_aligned_size(chunk, max_size):
+    '''
+    Largest tile length of at most max_size pixels that does not split the
+    chunks of length chunk: the chunk itself, or its largest divisor when the
+    chunk is longer than max_size.
+    '''
+    if chunk <= max_size:
+        return chunk
+    return max(d for d in range(1, max_size + 1) if chunk % d == 0)
+
+def tile_size_for_memory(max_memory, n_months, itemsize, n_tiles=1):
+    '''
+    Largest square tile size for which n_tiles tiles of n_months months fit
+    in max_memory MB. A tile holds about 16 (time, lat, lon) arrays: the
+    inputs, the rainy days without zeros and the eleven outputs.
+    '''
+    tile_bytes = 16 * n_months * itemsize * n_tiles
+    return max(1, int(np.sqrt(max_memory * 2**20 / tile_bytes)))
+
+def smbalance_output_paths(MAIN_FOLDER, single_file=None):
+    '''
+    Output file of each SMBalance output, keyed as SMBALANCE_OUTPUTS. With
+    single_file all outputs are variables of MAIN_FOLDER/single_file.
+    '''
+    if single_file:
+        path = os.path.join(MAIN_FOLDER, single_file)
+        return {key: path for key, _, _, _ in SMBALANCE_OUTPUTS}
+    return {key: os.path.join(MAIN_FOLDER, fname)
+            for key, fname, _, _ in SMBALANCE_OUTPUTS}
+
+def init_output_nc(nc_file, template, name, attrs, comp, dtype='f4',
+                   append=False):
+    '''
+    Create an empty (time, latitude, longitude) NetCDF variable with the
+    coordinates of template so that it can be filled tile by tile. With
+    append the variable is added to the existing file nc_file.
+    '''
+    if not append:
+        coords = xr.Dataset(coords={dim: template[dim]
+                                    for dim in ['time', 'latitude', 'longitude']})
+        coords.to_netcdf(nc_file)
+    with netCDF4.Dataset(nc_file, 'a') as out_nc:
+        var = out_nc.createVariable(name, dtype, ('time', 'latitude', 'longitude'),
+                                    fill_value=np.nan, **comp)
+        var.setncatts(attrs)
+
+def open_smbalance_inputs(nc_files):
+    '''
+    Open the SMBalance input NetCDF files lazily as (time, lat, lon) arrays.
+
+    Returns the dictionary of DataArrays and the list of opened datasets,
+    which the caller closes when done.
+    '''
+    inputs = dict()
+    datasets = []
+    for key in ['P', 'ET', 'I', 'NRD', 'LU', 'SMsat', 'Ari']:
+        dts = xr.open_dataset(nc_files[key])
+        var = dts[list(dts.keys())[0]]
+        inputs[key] = var.transpose('time', 'latitude', 'longitude')
+        datasets.append(dts)
+    return inputs, datasets
+
+def smbalance_tile(inputs, ys, xs, params):
+    '''
+    Read the hyperslab (ys, xs) of all inputs and run smbalance_block on it.
+    '''
+    block = {key: inputs[key][:, ys, xs].values
+             for key in ['P', 'ET', 'I', 'NRD', 'LU']}
+    return smbalance_block(block['P'], block['ET'], block['I'], block['NRD'],
+                           block['LU'],
+                           inputs['SMsat'][0, ys, xs].values,
+                           inputs['Ari'][0, ys, xs].values,
+                           **params)
+
+# inputs opened once per worker process by _init_worker
+_WORKER_INPUTS = None
+
+def _init_worker(nc_files):
+    global _WORKER_INPUTS
+    _WORKER_INPUTS, _ = open_smbalance_inputs(nc_files)
+
+def _smbalance_tile_worker(ys, xs, params):
+    return smbalance_tile(_WORKER_INPUTS, ys, xs, params)
+
+def run_SMBalance_tiled(MAIN_FOLDER, nc_files, start_year, end_year,
+                        f_perc=1, f_Smax=0.9, cf=20, f_bf=0.1, deep_perc_f=0.1,
+                        root_depth_version='1.0', chunks=[1, 1000, 1000],
+                        tile_size=None, n_workers=1, progress_callback=None,
+                        max_memory=None, single_file=None):
+    '''
+    Run the soil moisture balance tile by tile on NumPy arrays.
+
+    Each spatial tile is read once for the whole period, the recursion over
+    the months runs in preallocated (time, lat, lon) buffers and the finished
+    tile is written straight into the eleven output NetCDF files. The outputs
+    are identical to the xarray implementation of run_SMBalance.
+
+    With n_workers > 1 the tiles are computed in a pool of worker processes,
+    each reading its own hyperslab of the inputs. The main process is the only
+    writer and stitches the tiles into the outputs as they finish.
+
+    tile_size: int, optional
+        Size of the square tiles in pixels. Default is the spatial chunk size
+        of the outputs, so that every compressed chunk is written once per
+        time step. Memory per tile is about 16 * n_months * tile_size**2 * 8
+        bytes.
+    max_memory: float, optional
+        Memory ceiling in MB for the tiles held at once. The tile size is
+        reduced to stay below it, the default tiles to a divisor of the chunk
+        size. Default is DEFAULT_MAX_MEMORY for the default tiles, no ceiling
+        for a given tile_size.
+    single_file: str, optional
+        Name of a NetCDF file in MAIN_FOLDER holding all eleven outputs as
+        variables. Default is None, one file per output.
+    n_workers: int, optional
+        Number of worker processes. Default is 1 (no pool), None uses all
+        cores.
+    progress_callback: callable, optional
+        Called as progress_callback(tiles_done, n_tiles, message)
+    '''
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    comp = dict(zlib=True,
+                least_significant_digit=2,
+                chunksizes=chunks)
+    params = dict(f_perc=f_perc, f_Smax=f_Smax, cf=cf, f_bf=f_bf,
+                  deep_perc_f=deep_perc_f,
+                  root_depth_version=root_depth_version)
+    in_files = {key: nc_files[key]
+                for key in ['P', 'ET', 'I', 'NRD', 'LU', 'SMsat', 'Ari']}
+    inputs, datasets = open_smbalance_inputs(in_files)
+    template = inputs['ET']
+    # the outputs take the precision of the inputs, as in the xarray engine
+    dtype = np.result_type(*[var.dtype for var in inputs.values()])
+    ysize, xsize = len(template.latitude), len(template.longitude)
+    if tile_size is None and max_memory is None:
+        max_memory = DEFAULT_MAX_MEMORY
+    if max_memory is not None:
+        # tiles in flight in the pool plus their results waiting to be written
+        n_tiles = 1 if n_workers == 1 else 3 * n_workers
+        max_tile = tile_size_for_memory(max_memory, len(template.time),
+                                        np.dtype(dtype).itemsize, n_tiles)
+        if tile_size is None:
+            # whole chunks, or tiles that do not straddle chunk boundaries
+            tile_size = (chunk_aligned_size(min(chunks[1], ysize), max_tile),
+                         chunk_aligned_size(min(chunks[2], xsize), max_tile))
+        else:
+            tile_size = min(tile_size, max_tile)
+
+    print("Creating output nc files...")
+    paths = smbalance_output_paths(MAIN_FOLDER, single_file)
+    created = set()
+    for key, fname, name, quantity in SMBALANCE_OUTPUTS:
+        attrs = {"units": "mm/month", "source": "-", "quantity": quantity}
+        init_output_nc(paths[key], template, name, attrs, comp, dtype=dtype,
+                       append=paths[key] in created)
+        created.add(paths[key])
+        nc_files[key] = paths[key]
+
+    tiles = get_tiles(ysize, xsize, tile_size)
+    n_workers = max(1, min(n_workers, len(tiles)))
+    out_ncs = {path: netCDF4.Dataset(path, 'a') for path in set(paths.values())}
+
+    def write_tile(i, ys, xs, out):
+        for key, fname, name, quantity in SMBALANCE_OUTPUTS:
+            out_ncs[paths[key]].variables[name][:, ys, xs] = out[key]
+        if progress_callback is not None:
+            progress_callback(i, len(tiles),
+                              "SMBalance tile {0}/{1}".format(i, len(tiles)))
+
+    start = time.time()
+    try:
+        if n_workers == 1:
+            for i, (ys, xs) in enumerate(tiles):
+                write_tile(i + 1, ys, xs, smbalance_tile(inputs, ys, xs, params))
+        else:
+            for dts in datasets:
+                dts.close()
+            datasets = []
+            ctx = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx,
+                                     initializer=_init_worker,
+                                     initargs=(in_files,)) as executor:
+                todo = iter(tiles)
+                pending = dict()
+                done_tiles = 0
+                # at most two tiles per worker in flight to bound the memory
+                for ys, xs in itertools.islice(todo, 2 * n_workers):
+                    fut = executor.submit(_smbalance_tile_worker, ys, xs, params)
+                    pending[fut] = (ys, xs)
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for fut in done:
+                        ys, xs = pending.pop(fut)
+                        done_tiles += 1
+                        write_tile(done_tiles, ys, xs, fut.result())
+                        for ys, xs in itertools.islice(todo, 1):
+                            nxt = executor.submit(_smbalance_tile_worker,
+                                                  ys, xs, params)
+                            pending[nxt] = (ys, xs)
+    finally:
+        for out_nc in out_ncs.values():
+            out_nc.close()
+        for dts in datasets:
+            dts.close()
+    print('     ', time.time() - start)
+    return nc_files
+
 #%% main
 def run_SMBalance(MAIN_FOLDER,nc_files, start_year, end_year, 
         f_perc=1,f_Smax=0.9, cf =  20, f_bf = 0.1, deep_perc_f = 0.1, root_depth_version = '1.0',
-         chunks=[1,1000,1000]):
+         chunks=[1,1000,1000], engine='numpy', tile_size=None, n_workers=1,
+         progress_callback=None, max_memory=None, single_file=None):
+
+    if engine == 'numpy':
+        return run_SMBalance_tiled(MAIN_FOLDER, nc_files, start_year, end_year,
+                                   f_perc=f_perc, f_Smax=f_Smax, cf=cf, f_bf=f_bf,
+                                   deep_perc_f=deep_perc_f,
+                                   root_depth_version=root_depth_version,
+                                   chunks=chunks, tile_size=tile_size,
+                                   n_workers=n_workers,
+                                   progress_callback=progress_callback,
+                                   max_memory=max_memory,
+                                   single_file=single_file)
 
     p_in = nc_files['P'] # Monthly Precipitation
     e_in = nc_files['ET'] # Monthly Actual Evapotranspiration
@@ -340,6 +683,12 @@ def run_SMBalance(MAIN_FOLDER,nc_files, start_year, end_year,
     f_Smax=0.9 #threshold for percolation
     cf =  20 #f_Ssat soil mositure correction factor to componsate the variation in filling up and drying in a month
     f_bf = 0.1 # base flow factor (multiplier of SM for estimating base flow)
+    
+    engine='numpy' # 'numpy' runs run_SMBalance_tiled, 'xarray' the code below
+    tile_size=None # tile size of the numpy engine, default the chunk size
+    n_workers=1 # worker processes of the numpy engine, None for all cores
+    max_memory=None # memory ceiling in MB of the numpy engine tiles
+    single_file=None # numpy engine: file name to write all outputs into one NetCDF
  
     '''
     warnings.filterwarnings("ignore", message='invalid value encountered in greater')
@@ -402,7 +751,7 @@ def run_SMBalance(MAIN_FOLDER,nc_files, start_year, end_year,
         
         #mask lu for water bodies
 #        mask = xr.where(((lu==80) | (lu==81) | (lu==70) | (lu==200)|(lu==90)), 1,0)
-        mask = xr.where(((lu==4) | (lu==23) | (lu==24) | (lu==63)|(lu==75)), 1,0)
+        mask = xr.where(rc.isin(lu, WATER_LU_CODES), 1,0)
         #include flooded shrub?
         Rd = root_depth(lu, root_depth_version) 
 #       SMmax=thetasat[0]*Rd
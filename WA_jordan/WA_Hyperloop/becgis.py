@@ -133,6 +133,99 @@ def calc_mean_std(fihs):
 
     return std, mean
 
+MONTHLY_CLIMATOLOGIES = collections.OrderedDict()
+
+def monthly_climatology(fhs, dates):
+    """
+    Calculate the number of values, mean, standard deviation and maximum per
+    pixel for each calendar month of a serie of maps, reading every map once.
+    The results of the last 8 series are cached, a series is recalculated when
+    one of its maps changes.
+
+    Parameters
+    ----------
+    fhs : ndarray
+        Array with filehandles pointing to maps to be used.
+    dates : ndarray
+        Array with datetime.date objects corresponding to fhs.
+
+    Returns
+    -------
+    climatology : dict
+        Dictionary with the months as keys and dictionaries with the number of
+        maps 'n', the number of values per pixel 'count' and the 'mean', 'std' 
+        (population standard deviation, NaN values ignored) and 'max' per 
+        pixel as values.
+    """
+    key = tuple((fh, os.stat(fh).st_size, os.stat(fh).st_mtime_ns, date) 
+                if os.path.isfile(fh) else (fh, date) for fh, date in zip(fhs, dates))
+    if key in MONTHLY_CLIMATOLOGIES:
+        MONTHLY_CLIMATOLOGIES.move_to_end(key)
+        return MONTHLY_CLIMATOLOGIES[key]
+
+    climatology = dict()
+    for fh, date in zip(fhs, dates):
+        data = open_as_array(fh, nan_values = True)
+        valid = ~np.isnan(data)
+        if date.month not in climatology:
+            climatology[date.month] = {'n': 0, 'count': np.zeros(data.shape), 
+                                       'mean': np.zeros(data.shape), 'm2': np.zeros(data.shape),
+                                       'max': np.full(data.shape, np.nan)}
+        stats = climatology[date.month]
+        stats['n'] += 1
+        stats['count'] += valid
+        # Welford's update of the running mean and sum of squared differences.
+        delta = np.where(valid, data - stats['mean'], 0.)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            stats['mean'] += np.where(valid, delta / stats['count'], 0.)
+        stats['m2'] += np.where(valid, delta * (data - stats['mean']), 0.)
+        stats['max'] = np.fmax(stats['max'], data)
+
+    for stats in climatology.values():
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            stats['std'] = np.sqrt(stats.pop('m2') / stats['count'])
+        stats['mean'][stats['count'] == 0] = np.nan
+        stats['std'][stats['count'] == 0] = np.nan
+
+    MONTHLY_CLIMATOLOGIES[key] = climatology
+    while len(MONTHLY_CLIMATOLOGIES) > 8:
+        MONTHLY_CLIMATOLOGIES.popitem(last = False)
+    return climatology
+
+def maximum_filter_per_class(array, classes, size = 10):
+    """
+    Calculate the maximum in a moving window for each pixel, taking only the
+    pixels of the same class into account. Pixels of other classes count as
+    zero, i.e. the result equals ndimage.maximum_filter(np.where(classes == c, array, 0), 
+    size) at the pixels of class c, with reflected borders. All classes are
+    done in a single sweep over the offsets in the window.
+
+    Parameters
+    ----------
+    array : ndarray
+        Array with the values.
+    classes : ndarray
+        Array with the class of each pixel, e.g. a landuse map.
+    size : int, optional
+        Size of the window in pixels, default is 10.
+
+    Returns
+    -------
+    maximum : ndarray
+        Array with the maximum per pixel.
+    """
+    rows, cols = array.shape
+    before = size // 2
+    pad_width = ((before, size - before - 1), (before, size - before - 1))
+    values = np.pad(array, pad_width, mode = 'symmetric')
+    labels = np.pad(classes, pad_width, mode = 'symmetric')
+    maximum = np.full(array.shape, -np.inf)
+    for dr in range(size):
+        for dc in range(size):
+            same_class = labels[dr:dr + rows, dc:dc + cols] == classes
+            np.maximum(maximum, np.where(same_class, values[dr:dr + rows, dc:dc + cols], 0.), out = maximum)
+    return maximum
+
 def CalcMeanStd(fhs, std_fh, mean_fh):
     """
     Calculate the mean and the standard deviation per pixel for a serie of maps.
@@ -723,6 +816,255 @@ def open_as_array(fih, bandnumber=1, nan_values=True):
     return array
 
 
+class ArrayCache(object):
+    """
+    Size-bounded LRU cache of the arrays read by open_as_array.
+
+    Arrays are keyed by filehandle, band, nan_values and the size and
+    modification time of the file, so an overwritten map is read again.
+    Callers get a copy, the cached array itself is never modified.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        Maximum size of the cached arrays, default is 512 MB.
+    """
+    def __init__(self, max_bytes=512 * 2**20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._arrays = collections.OrderedDict()
+
+    def get(self, fih, bandnumber=1, nan_values=True):
+        stat = os.stat(fih) if os.path.isfile(fih) else None
+        key = (fih, bandnumber, nan_values,
+               None if stat is None else (stat.st_size, stat.st_mtime_ns))
+        if key in self._arrays:
+            self._arrays.move_to_end(key)
+            self.hits += 1
+            return self._arrays[key].copy()
+        self.misses += 1
+        array = open_as_array(fih, bandnumber=bandnumber, nan_values=nan_values)
+        if array.nbytes <= self.max_bytes:
+            self._arrays[key] = array.copy()
+            self.nbytes += array.nbytes
+            while self.nbytes > self.max_bytes:
+                _, old = self._arrays.popitem(last=False)
+                self.nbytes -= old.nbytes
+        return array
+
+    def clear(self):
+        self._arrays.clear()
+        self.nbytes = 0
+
+
+ARRAY_CACHE = ArrayCache()
+
+
+def open_as_array_cached(fih, bandnumber=1, nan_values=True):
+    """
+    Open a map as an numpy array through the shared ARRAY_CACHE, see
+    open_as_array. Repeated reads of the same map come from memory.
+    """
+    return ARRAY_CACHE.get(fih, bandnumber=bandnumber, nan_values=nan_values)
+
+
+class RasterCatalog(object):
+    """
+    Date index of the (filehandles, dates) tuples in complete_data, reading
+    the maps through the shared ARRAY_CACHE.
+
+    Parameters
+    ----------
+    complete_data : dict, optional
+        Dictionary with variable names as keys and (filehandles, dates)
+        tuples as values.
+
+    Examples
+    --------
+    >>> catalog = RasterCatalog(complete_data)
+    >>> P = catalog.open('p', date)
+    """
+    def __init__(self, complete_data=None):
+        self._index = dict()
+        for key, value in (complete_data or {}).items():
+            self.add(key, value[0], value[1])
+
+    def add(self, key, fhs, dates):
+        self._index[key] = date_index(fhs, dates)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def dates(self, key):
+        return np.sort(list(self._index[key].keys()))
+
+    def filehandle(self, key, date):
+        return self._index[key][date]
+
+    def open(self, key, date, nan_values=True):
+        return open_as_array_cached(self.filehandle(key, date),
+                                    nan_values=nan_values)
+
+
+def date_index(fhs, dates):
+    """
+    Index filehandles by date, replacing the linear search fhs[dates == date][0].
+
+    Parameters
+    ----------
+    fhs : ndarray
+        Array with strings pointing to maps.
+    dates : ndarray
+        Array with datetime.date objects corresponding to fhs.
+
+    Returns
+    -------
+    index : dict
+        Dictionary with the dates as keys and the filehandles as values, the
+        first filehandle is kept for duplicate dates.
+    """
+    index = dict()
+    for date, fh in zip(dates, fhs):
+        index.setdefault(date, fh)
+    return index
+
+
+class LUClassIndex(object):
+    """
+    Index of the pixels of each class of a landuse map, to select the pixels
+    of a set of classes with a single gather instead of comparing the map
+    with every class. The pixels are sorted by class once, the indices of a 
+    set of classes are kept in memory after their first use.
+
+    Parameters
+    ----------
+    lu_fh : str
+        Filehandle pointing to a landuse map.
+    persist : boolean, optional
+        Save the index as '<lu_fh>.classindex.npz' and read it from there
+        while the landuse map is unchanged, default is True.
+
+    Examples
+    --------
+    >>> index = LUClassIndex(lu_fh)
+    >>> pixels = index.pixels([1, 8, 9])
+    >>> total = np.nansum(DATA.ravel()[pixels])
+    """
+    # number of memoized pixel sets per index
+    max_sets = 32
+
+    def __init__(self, lu_fh, persist=True):
+        self.lu_fh = lu_fh
+        self._sets = collections.OrderedDict()
+        stat = os.stat(lu_fh)
+        fingerprint = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+        index_fh = lu_fh + '.classindex.npz'
+
+        if persist and os.path.isfile(index_fh):
+            with np.load(index_fh) as index:
+                if np.array_equal(index['fingerprint'], fingerprint):
+                    self.shape = tuple(index['shape'])
+                    self.values = index['values']
+                    self.starts = index['starts']
+                    self.order = index['order']
+                    return
+
+        LULC = open_as_array(lu_fh, nan_values=True)
+        self.shape = LULC.shape
+        flat = LULC.ravel()
+        valid = np.flatnonzero(~np.isnan(flat))
+        self.order = valid[np.argsort(flat[valid], kind='stable')]
+        self.values, self.starts = np.unique(flat[self.order], return_index=True)
+        self.starts = np.append(self.starts, self.order.size)
+
+        if persist:
+            try:
+                np.savez(index_fh, fingerprint=fingerprint, shape=self.shape,
+                         values=self.values, starts=self.starts, order=self.order)
+            except OSError:
+                pass
+
+    def pixels(self, classes):
+        """
+        Flat indices of the pixels of the classes, in ascending order.
+        """
+        key = tuple(sorted(set(float(value) for value in classes)))
+        if key in self._sets:
+            self._sets.move_to_end(key)
+            return self._sets[key]
+        positions = np.searchsorted(self.values, key)
+        ranges = [self.order[self.starts[i]:self.starts[i + 1]]
+                  for i, value in zip(positions, key)
+                  if i < self.values.size and self.values[i] == value]
+        self._sets[key] = np.sort(np.concatenate(ranges)) if ranges else np.array([], dtype=np.intp)
+        while len(self._sets) > self.max_sets:
+            self._sets.popitem(last=False)
+        return self._sets[key]
+
+    @property
+    def nbytes(self):
+        """
+        Memory held by the index and its memoized pixel sets.
+        """
+        return (self.order.nbytes + self.values.nbytes + self.starts.nbytes
+                + sum(pixels.nbytes for pixels in self._sets.values()))
+
+    def mask(self, classes):
+        """
+        Boolean map of the pixels of the classes.
+        """
+        mask = np.zeros(self.shape, dtype=bool)
+        mask.ravel()[self.pixels(classes)] = True
+        return mask
+
+
+class LUClassIndexCache(object):
+    """
+    Size-bounded LRU cache of LUClassIndex objects.
+
+    Holds one index per landuse map, rebuilt when the size or modification
+    time of the map changes.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        Maximum size of the cached indexes, default is 512 MB.
+    """
+    def __init__(self, max_bytes=512 * 2**20):
+        self.max_bytes = max_bytes
+        self._indexes = collections.OrderedDict()
+
+    def get(self, lu_fh):
+        stat = os.stat(lu_fh)
+        path = os.path.abspath(lu_fh)
+        fingerprint = (stat.st_size, stat.st_mtime_ns)
+        if path in self._indexes and self._indexes[path][0] == fingerprint:
+            self._indexes.move_to_end(path)
+        else:
+            self._indexes[path] = (fingerprint, LUClassIndex(lu_fh))
+            self._indexes.move_to_end(path)
+        index = self._indexes[path][1]
+        nbytes = sum(cached.nbytes for _, cached in self._indexes.values())
+        while nbytes > self.max_bytes and len(self._indexes) > 1:
+            _, (_, old) = self._indexes.popitem(last=False)
+            nbytes -= old.nbytes
+        return index
+
+    def clear(self):
+        self._indexes.clear()
+
+
+LU_CLASS_INDEXES = LUClassIndexCache()
+
+def lu_class_index(lu_fh):
+    """
+    Shared LUClassIndex of a landuse map, rebuilt when the map changes.
+    """
+    return LU_CLASS_INDEXES.get(lu_fh)
+
+
 def create_geotiff(fih, array, driver, ndv, xsize, ysize, geot, projection, compress=None):
     """
     Creates a geotiff from a numpy array.
@@ -900,6 +1242,7 @@ def xdaily_to_monthly(files, dates, out_path, name_out):
 
     # Create tuples with date couples
     date_couples = np.array(zip(dates[0:-1], dates[1:]))
+    fhs = date_index(files, dates)
 
     # Loop over years and months
     for yyyy, month in np.unique([(date.year, date.month) for date in dates], axis=0):
@@ -920,8 +1263,8 @@ def xdaily_to_monthly(files, dates, out_path, name_out):
             print(date1, date2)
 
             # Open relevant maps
-            xdaily1 = open_as_array(files[dates == date1][0])
-            xdaily2 = open_as_array(files[dates == date2][0])
+            xdaily1 = open_as_array_cached(fhs[date1])
+            xdaily2 = open_as_array_cached(fhs[date2])
 
             # Correct dateranges at month edges
             if np.any([date1.month != month, date1.year != yyyy]):
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+D8 flow routing on numpy arrays: depression filling, flow directions,
+upstream (catchment) masks and flow accumulation.
+
+Depressions are filled with the Priority-Flood+epsilon algorithm (Barnes et
+al., 2014), which leaves every cell a strictly lower neighbour, so the
+steepest descent directions contain no pits or flats. Upstream masks and
+accumulations are then computed level by level in topological order of the
+flow network, each level with a single vectorized numpy operation.
+"""
+import math
+import heapq
+import collections
+import numpy as np
+
+# Row and column offsets of the 8 neighbours.
+OFFSETS = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+
+
+def fill_depressions(dem, epsilon=True):
+    """
+    Fill the depressions in a DEM with Priority-Flood, so that every cell
+    drains to the edge of the map or to a no-data cell.
+
+    Parameters
+    ----------
+    dem : ndarray
+        Elevations, no-data as np.nan.
+    epsilon : boolean, optional
+        Raise filled cells by the smallest possible increment above their
+        outlet instead of making them flat, default is True.
+
+    Returns
+    -------
+    filled : ndarray
+        Filled elevations (float64), no-data stays np.nan.
+    """
+    rows, cols = dem.shape
+    padded = np.pad(np.asarray(dem, dtype=np.float64), 1, mode='constant',
+                    constant_values=np.nan)
+    width = cols + 2
+    offsets = [dr * width + dc for dr, dc in OFFSETS]
+
+    nodata = np.isnan(padded)
+    # Cells next to the edge or to no-data cells are the outlets.
+    edge = np.zeros(padded.shape, dtype=bool)
+    for dr, dc in OFFSETS:
+        edge[1:-1, 1:-1] |= nodata[1 + dr:rows + 1 + dr, 1 + dc:cols + 1 + dc]
+    edge &= ~nodata
+    seeds = np.flatnonzero(edge)
+
+    filled = padded.ravel().tolist()
+    closed = (nodata | edge).ravel().tolist()
+    queue = list(zip(padded.ravel()[seeds].tolist(), seeds.tolist()))
+    heapq.heapify(queue)
+    pits = collections.deque()
+
+    while queue or pits:
+        if pits:
+            cell = pits.popleft()
+        else:
+            cell = heapq.heappop(queue)[1]
+        z = filled[cell]
+        for offset in offsets:
+            neighbour = cell + offset
+            if closed[neighbour]:
+                continue
+            closed[neighbour] = True
+            if filled[neighbour] <= z:
+                filled[neighbour] = math.nextafter(z, math.inf) if epsilon else z
+                pits.append(neighbour)
+            else:
+                heapq.heappush(queue, (filled[neighbour], neighbour))
+
+    return np.array(filled).reshape(padded.shape)[1:-1, 1:-1]
+
+
+def flow_directions(filled, xres=1., yres=1.):
+    """
+    Steepest descent (D8) flow directions.
+
+    Parameters
+    ----------
+    filled : ndarray
+        Elevations without depressions, no-data as np.nan.
+    xres : float, optional
+        Width of the cells, default is 1.
+    yres : float, optional
+        Height of the cells, default is 1.
+
+    Returns
+    -------
+    receivers : ndarray
+        Flat index of the cell each cell drains to, -1 for outlets and no-data
+        cells.
+    """
+    rows, cols = filled.shape
+    padded = np.pad(filled, 1, mode='constant', constant_values=np.nan)
+    index = np.arange(rows * cols).reshape(rows, cols)
+    steepest = np.zeros(filled.shape)
+    receivers = np.full(filled.shape, -1, dtype=np.int64)
+    for dr, dc in OFFSETS:
+        neighbours = padded[1 + dr:rows + 1 + dr, 1 + dc:cols + 1 + dc]
+        with np.errstate(invalid='ignore', under='ignore'):
+            drop = filled - neighbours
+            slope = drop / math.hypot(dr * yres, dc * xres)
+            steeper = slope > steepest
+            # Drops of a few ulps on filled flats near zero are denormal and
+            # the slope underflows to 0, drain those cells to any lower
+            # neighbour until a steeper one is found.
+            lower = (receivers < 0) & (drop > 0)
+        steepest[steeper] = slope[steeper]
+        receivers[steeper | lower] = (index + dr * cols + dc)[steeper | lower]
+    return receivers.ravel()
+
+
+def topological_levels(receivers):
+    """
+    Order the cells of a flow network from the outlets upstream.
+
+    Parameters
+    ----------
+    receivers : ndarray
+        Flat index of the cell each cell drains to, -1 for outlets.
+
+    Returns
+    -------
+    levels : list
+        Arrays with the flat indices of the cells at the same number of steps
+        from their outlet, the outlets first.
+    """
+    size = receivers.size
+    donors = np.argsort(receivers, kind='stable')
+    sorted_receivers = receivers[donors]
+    start = np.searchsorted(sorted_receivers, np.arange(size), side='left')
+    count = np.searchsorted(sorted_receivers, np.arange(size), side='right') - start
+
+    level = np.flatnonzero(receivers < 0)
+    levels = [level]
+    while True:
+        counts = count[level]
+        total = counts.sum()
+        if total == 0:
+            break
+        first = np.repeat(start[level] - np.cumsum(counts) + counts, counts)
+        level = donors[first + np.arange(total)]
+        levels.append(level)
+    return levels
+
+
+def upstream_mask(receivers, targets, levels=None):
+    """
+    Cells that drain into one of the target cells, including the targets.
+
+    Parameters
+    ----------
+    receivers : ndarray
+        Flat index of the cell each cell drains to, -1 for outlets.
+    targets : ndarray
+        Boolean map of the target cells.
+    levels : list, optional
+        Topological levels of the network, see topological_levels.
+
+    Returns
+    -------
+    upstream : ndarray
+        Boolean map with the shape of targets.
+    """
+    if levels is None:
+        levels = topological_levels(receivers)
+    upstream = np.array(targets, dtype=bool).ravel()
+    for level in levels[1:]:
+        upstream[level] |= upstream[receivers[level]]
+    return upstream.reshape(np.shape(targets))
+
+
+def flow_accumulation(receivers, shape, weights=None, levels=None):
+    """
+    Sum of the weights of each cell and all cells upstream of it.
+
+    Parameters
+    ----------
+    receivers : ndarray
+        Flat index of the cell each cell drains to, -1 for outlets.
+    shape : tuple
+        Shape of the map.
+    weights : ndarray, optional
+        Weight per cell, default is 1 (number of upstream cells).
+    levels : list, optional
+        Topological levels of the network, see topological_levels.
+
+    Returns
+    -------
+    accumulation : ndarray
+        Accumulated weights.
+    """
+    if levels is None:
+        levels = topological_levels(receivers)
+    if weights is None:
+        accumulation = np.ones(receivers.size)
+    else:
+        accumulation = np.nan_to_num(np.asarray(weights, dtype=np.float64)).ravel().copy()
+    for level in levels[:0:-1]:
+        np.add.at(accumulation, receivers[level], accumulation[level])
+    return accumulation.reshape(shape)
+
+
+def upstream_of(dem, targets, xres=1., yres=1.):
+    """
+    Cells upstream of the target cells on a DEM, after filling depressions.
+
+    Parameters
+    ----------
+    dem : ndarray
+        Elevations, no-data as np.nan.
+    targets : ndarray
+        Boolean map of the target cells.
+    xres : float, optional
+        Width of the cells, default is 1.
+    yres : float, optional
+        Height of the cells, default is 1.
+
+    Returns
+    -------
+    upstream : ndarray
+        Boolean map, True for the targets and the cells draining into them.
+    """
+    receivers = flow_directions(fill_depressions(dem), xres=xres, yres=yres)
+    return upstream_mask(receivers, targets)
@@ -8,6 +8,8 @@ from __future__ import print_function
 from builtins import zip
 from builtins import range
 import os
+import functools
+import multiprocessing
 import numpy as np
 import matplotlib.pyplot as plt
 import re
@@ -17,12 +19,46 @@ from datetime import datetime
 from scipy import interpolate
 from calendar import monthrange as mr
 from dateutil.relativedelta import relativedelta
+from concurrent.futures import ProcessPoolExecutor
 
 from WA_Hyperloop import becgis
 
 import WA_Hyperloop.get_dictionaries as gd
 
 
+_BASIN_MEANS = dict()
+
+def basin_mean(fh, mask_fh, exclude = None):
+    """
+    Mean of a map over the pixels of a mask, counting no-data as zero. The
+    means are cached by the size and modification time of both maps, so a
+    map is only reduced once when calibrating several formulas.
+    
+    Parameters
+    ----------
+    fh : str
+        Filehandle pointing to a map.
+    mask_fh : str
+        Filehandle pointing to a map that is no-data outside the basin.
+    exclude : tuple, optional
+        Values of mask_fh whose pixels count as zero, e.g. landuse classes.
+        
+    Returns
+    -------
+    mean : float
+        Mean of the map over the basin.
+    """
+    key = tuple((os.path.abspath(f), os.stat(f).st_size, os.stat(f).st_mtime_ns) 
+                if os.path.isfile(f) else f for f in (fh, mask_fh)) + (exclude,)
+    if key not in _BASIN_MEANS:
+        MASK = becgis.open_as_array_cached(mask_fh, nan_values = True)
+        basin = ~np.isnan(MASK)
+        if exclude is not None:
+            basin &= ~np.isin(MASK, exclude)
+        DATA = becgis.open_as_array(fh, nan_values = True)
+        _BASIN_MEANS[key] = np.nansum(DATA[basin], dtype = np.float64) / np.sum(~np.isnan(MASK))
+    return _BASIN_MEANS[key]
+
 def get_ts_from_complete_data(complete_data, mask, keys, dates = None):
     
     if keys == None:
@@ -30,25 +66,13 @@ def get_ts_from_complete_data(complete_data, mask, keys, dates = None):
     
     common_dates = becgis.common_dates([complete_data[key][1] for key in keys])
     becgis.assert_proj_res_ndv([complete_data[key][0] for key in keys])
-    
-    MASK = becgis.open_as_array(mask, nan_values = True)
+    catalog = becgis.RasterCatalog(complete_data)
     
     tss = dict()
     
     for key in keys:
         
-        var_mm = np.array([])
-        
-        for date in common_dates:
-            
-            tif = complete_data[key][0][complete_data[key][1] == date][0]
-            
-            DATA = becgis.open_as_array(tif, nan_values = True)
-            DATA[np.isnan(DATA)] = 0.0
-            
-            DATA[np.isnan(MASK)] = np.nan
-            
-            var_mm = np.append(var_mm, np.nanmean(DATA))
+        var_mm = np.array([basin_mean(catalog.filehandle(key, date), mask) for date in common_dates])
         
         tss[key] = (common_dates, var_mm)
 
@@ -62,35 +86,18 @@ def get_ts_from_complete_data_spec(complete_data, lu_fh, keys, a, dates = None):
     
     common_dates = becgis.common_dates([complete_data[key][1] for key in keys])
     becgis.assert_proj_res_ndv([complete_data[key][0] for key in keys])
+    catalog = becgis.RasterCatalog(complete_data)
     
-    MASK = becgis.open_as_array(lu_fh, nan_values = True)
-    
-    lucs = lucs = gd.get_sheet4_6_classes()
+    lucs = gd.get_sheet4_6_classes()
     gw_classes = list()
     for subclass in ['Forests','Rainfed Crops','Shrubland','Forest Plantations']:
         gw_classes += lucs[subclass]
-    mask_gw = np.logical_or.reduce([MASK == value for value in gw_classes])
     
     tss = dict()
     
     for key in keys:
         
-        var_mm = np.array([])
-        
-        for date in common_dates:
-            
-            tif = complete_data[key][0][complete_data[key][1] == date][0]
-            
-            DATA = becgis.open_as_array(tif, nan_values = True)
-            DATA[np.isnan(DATA)] = 0.0
-            
-            DATA[np.isnan(MASK)] = np.nan
-            
-            alpha = np.ones(np.shape(DATA)) * a
-            
-            alpha[mask_gw] = 0.0
-            
-            var_mm = np.append(var_mm, np.nanmean(DATA * alpha))
+        var_mm = np.array([a * basin_mean(catalog.filehandle(key, date), lu_fh, exclude = tuple(gw_classes)) for date in common_dates])
         
         tss[key] = (common_dates, var_mm)
 
@@ -103,9 +110,176 @@ def endofmonth(dates):
     return dts
     
 
+def supply_split_fraction(x, alpha, beta, theta):
+    """
+    Fraction of the total supply that is surface water supply in month x.
+    """
+    return alpha * (np.cos((x - theta) * (np.pi / 6)) * 0.5 + 0.5) + (beta * (1 - alpha))
+
+
+def supply_split_terms(tss, keys, operts):
+    """
+    Split the formula into the part that does not depend on the supply split
+    and the (last) supply variable, so the balance is evaluated with a single
+    operation per call.
+    
+    Returns
+    -------
+    base : ndarray
+        Result of the formula without its last term.
+    supply : ndarray
+        Timeseries of the last variable in the formula.
+    oper : str
+        Operator of the last term.
+    """
+    base = np.zeros(tss[keys[0]][1].shape)
+    
+    for key, oper in zip(keys[:-1], operts[:-1]):
+        base = apply_operator(base, tss[key][1], oper)
+    
+    return base, tss[keys[-1]][1], operts[-1]
+
+
+def apply_operator(ds, data, oper):
+    if oper == '+':
+        return ds + data
+    elif oper == '-':
+        return ds - data
+    elif oper == '/':
+        return ds / data
+    elif oper == '*':
+        return ds * data
+    else:
+        raise ValueError('Unknown operator in formula')
+
+
+def supply_split_model(x, alpha, beta, theta, base = None, supply = None, oper = '+', slope = False):
+    """
+    Cumulative storage change of the formula for months x when the last
+    variable is scaled by supply_split_fraction.
+    """
+    x = np.asarray(x, dtype = int)
+    ds = apply_operator(base[x], supply[x] * supply_split_fraction(x, alpha, beta, theta), oper)
+    
+    if slope:
+        return np.cumsum(ds) - np.mean(np.cumsum(ds))
+    else:
+        return np.cumsum(ds)
+
+
+def supply_split_jacobian(x, alpha, beta, theta, base = None, supply = None, oper = '+', slope = False):
+    """
+    Analytic jacobian of supply_split_model to alpha, beta and theta.
+    """
+    x = np.asarray(x, dtype = int)
+    phase = (x - theta) * (np.pi / 6)
+    dfraction = np.stack([np.cos(phase) * 0.5 + 0.5 - beta,
+                          np.ones(x.size) * (1 - alpha),
+                          alpha * 0.5 * (np.pi / 6) * np.sin(phase)], axis = 1)
+    
+    if oper == '+':
+        dds = supply[x]
+    elif oper == '-':
+        dds = -supply[x]
+    elif oper == '*':
+        dds = base[x] * supply[x]
+    elif oper == '/':
+        dds = -base[x] / (supply[x] * supply_split_fraction(x, alpha, beta, theta)**2)
+    else:
+        raise ValueError('Unknown operator in formula')
+    
+    jac = np.cumsum(dds[:, np.newaxis] * dfraction, axis = 0)
+    
+    if slope:
+        jac -= np.mean(jac, axis = 0)
+    
+    return jac
+
+
+def fit_supply_split(x, y, p0, bounds, base, supply, oper, slope):
+    """
+    Fit supply_split_model to y from starting point p0.
+    
+    Returns
+    -------
+    a : ndarray
+        Optimal alpha, beta and theta.
+    sse : float
+        Sum of squared errors of the fit.
+    """
+    model = functools.partial(supply_split_model, base = base, supply = supply, oper = oper, slope = slope)
+    jac = functools.partial(supply_split_jacobian, base = base, supply = supply, oper = oper, slope = slope)
+    a = optimization.curve_fit(model, x, y, p0 = p0, bounds = bounds, jac = jac)[0]
+    sse = np.sum((model(x, *a) - y)**2)
+    return a, sse
+
+
+def _fit_supply_split_job(job, x, y, base, supply, oper, slope):
+    p0, bounds = job
+    return fit_supply_split(x, y, p0, bounds, base, supply, oper, slope)
+
+
+def calibrate_supply_split(x, y, base, supply, oper, slope, bounds, starts = None, bounds_grid = None, n_workers = 1):
+    """
+    Fit the supply split for every combination of bounds and starting points,
+    in parallel when n_workers > 1, and keep the best fit.
+    
+    Parameters
+    ----------
+    x : ndarray
+        Months with GRACE data.
+    y : ndarray
+        GRACE storage (change) in the months x.
+    base, supply, oper :
+        Formula terms, see supply_split_terms.
+    slope : boolean
+        Fit the trend instead of the storage values.
+    bounds : tuple
+        Lower and upper bounds of alpha, beta and theta.
+    starts : list, optional
+        Starting points, default is the middle of the bounds. Starting points
+        outside a set of bounds are clipped to them.
+    bounds_grid : list, optional
+        Sets of bounds to fit, default is [bounds].
+    n_workers : int, optional
+        Number of processes, default is 1.
+        
+    Returns
+    -------
+    a : ndarray
+        Alpha, beta and theta of the fit with the smallest squared error.
+    fits : list
+        (p0, bounds, a, sse) of each fit.
+    """
+    if bounds_grid is None:
+        bounds_grid = [bounds]
+    
+    jobs = list()
+    for bnds in bounds_grid:
+        bnds = np.array(bnds, dtype = float)
+        bnds = np.broadcast_to(bnds, (2, 3))
+        for p0 in (starts if starts is not None else [(bnds[0] + bnds[1])/2.]):
+            jobs.append((np.clip(p0, bnds[0], bnds[1]), bnds))
+    
+    fit = functools.partial(_fit_supply_split_job, x = np.asarray(x), y = np.asarray(y), base = base,
+                            supply = supply, oper = oper, slope = slope)
+    
+    if n_workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers = n_workers, mp_context = multiprocessing.get_context('spawn')) as executor:
+            results = list(executor.map(fit, jobs))
+    else:
+        results = [fit(job) for job in jobs]
+    
+    fits = [(p0, bnds, a, sse) for (p0, bnds), (a, sse) in zip(jobs, results)]
+    best = min(range(len(fits)), key = lambda i: fits[i][3])
+    
+    return fits[best][2], fits
+
+
 def calc_var_correction(metadata, complete_data, output_dir,
                         formula = 'p-et-tr+supply_swa', plot = True,
-                        slope = False, bounds = ([0.0, 0.0, 1.], [1., 1., 12.])):
+                        slope = False, bounds = ([0.0, 0.0, 1.], [1., 1., 12.]),
+                        starts = None, bounds_grid = None, n_workers = 1):
     
     bounds = np.array(bounds)
     
@@ -133,48 +307,23 @@ def calc_var_correction(metadata, complete_data, output_dir,
         grace = (grace[0], grace[1] - np.nanmean(grace[1]))
     
     # Function to determine the balance
+    base, supply, oper = supply_split_terms(tss, keys, operts)
+    
     def func(x, alpha, beta, theta, slope = slope):
-        
-        ds = np.zeros(x.size)
-        
-        for key, oper in zip(keys, operts):
-            
-            scalar_array = alpha * (np.cos((x - theta) * (np.pi / 6)) * 0.5 + 0.5) + (beta * (1 - alpha))
-            
-            if key == keys[-1]:
-                new_data = tss[key][1][x] * scalar_array
-            else:
-                new_data = tss[key][1][x]
-            
-            if oper == '+':
-                ds += new_data
-            elif oper == '-':
-                ds -= new_data
-            elif oper == '/':
-                ds /= new_data
-            elif oper == '*':
-                ds *= new_data
-            else:
-                raise ValueError('Unknown operator in formula')
-        
-        if slope:
-            return np.cumsum(ds) - np.mean(np.cumsum(ds))
-        else:
-            return np.cumsum(ds)
+        return supply_split_model(x, alpha, beta, theta, base = base, supply = supply, oper = oper, slope = slope)
     
     # Check which Grace datapoints are missing and make a list of indice-numbers for which
     # data is available.
     msk = ~np.isnan(grace[1])
-    x = np.where(msk == True)[0].astype(int).tolist()
+    x = np.where(msk == True)[0].astype(int)
     
     print("Starting alpha optimization")
     
-    # Initial values for alpha, beta and theta
-    p0 = (bounds[0] + bounds[1])/2.
-    
     # Find values for alpha, beta and theta so that the waterbalance matches as closely
-    # as possible with Grace.
-    a, b = optimization.curve_fit(func, x, grace[1][msk], p0 = p0 , bounds= bounds)
+    # as possible with Grace, starting from the middle of the bounds unless other
+    # starting points or bounds are given.
+    a, fits = calibrate_supply_split(x, grace[1][msk], base, supply, oper, slope, bounds,
+                                     starts = starts, bounds_grid = bounds_grid, n_workers = n_workers)
     
     if plot:
         
@@ -203,7 +352,7 @@ def calc_var_correction(metadata, complete_data, output_dir,
         ax = plt.gca()
         ax.set_facecolor('lightgray')
         X = np.arange(tss[var_name][0].size)
-        scalar_array = a[0] * (np.cos((X - a[2]) * (np.pi / 6)) * 0.5 + 0.5) + (a[1] * (1 - a[0]))
+        scalar_array = supply_split_fraction(X, *a)
         plt.plot(tss[var_name][0], scalar_array, color = 'darkblue')
         plt.scatter(tss[var_name][0], scalar_array, color = 'darkblue')
         plt.ylim([0, 1])
@@ -245,18 +394,20 @@ def calc_var_correction(metadata, complete_data, output_dir,
 
 
 def calc_gwsupply(total_supply, params):
-    x = list(range(len(total_supply[0])))
-    scalar_array = params[0] * (np.cos((x - params[2]) * (np.pi / 6)) * 0.5 + 0.5) + (params[1] * (1 - params[0]))
+    x = np.arange(len(total_supply[0]))
+    scalar_array = supply_split_fraction(x, *params)
     gw_supply = (total_supply[0], total_supply[1] - (total_supply[1] * scalar_array))
     return gw_supply
     
 def correct_var(metadata, complete_data, output_dir, formula,
-                new_var, slope = False, bounds = (0, [1.0, 1., 12.])):
+                new_var, slope = False, bounds = (0, [1.0, 1., 12.]),
+                starts = None, bounds_grid = None, n_workers = 1):
     
     var = split_form(formula)[0][-1]
     
     a, x0 = calc_var_correction(metadata, complete_data, output_dir,
-                            formula = formula, slope = slope, plot = True, bounds = bounds)
+                            formula = formula, slope = slope, plot = True, bounds = bounds,
+                            starts = starts, bounds_grid = bounds_grid, n_workers = n_workers)
     
     for date, fn in zip(complete_data[var][1], complete_data[var][0]):
         
@@ -266,7 +417,7 @@ def correct_var(metadata, complete_data, output_dir, formula,
         
         x = calc_delta_months(x0, date)
         
-        fraction = a[0] * (np.cos((x - a[2]) * (np.pi / 6)) * 0.5 + 0.5) + (a[1] * (1 - a[0]))
+        fraction = supply_split_fraction(x, *a)
         
         data *= fraction
         
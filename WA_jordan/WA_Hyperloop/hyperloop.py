@@ -19,6 +19,8 @@ import csv
 import matplotlib.pyplot as plt
 import numpy as np
 from shutil import copyfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 
 import WA_Hyperloop.becgis as becgis
@@ -720,21 +722,142 @@ def NetCDF_to_Raster(input_nc, output_tiff, ras_variable,
     # Return
     return output_tiff
 
-def SortWaterPix(nc, variable, output_folder, time_var = 'time_yyyymm'):
-    spa_ref = Spatial_Reference(4326)
-    nc1 = netCDF4.Dataset(nc)
-    time = nc1.variables[time_var][:]
-    for time_value in time:
-        output_dir = os.path.join(output_folder, variable)
-        output_tif = os.path.join(output_dir, "{0}_{1}.tif".format(variable, time_value))
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-        NetCDF_to_Raster(input_nc=nc,
-                                output_tiff=output_tif,
-                                ras_variable=variable,
-                                x_variable='longitude', y_variable='latitude',
-                                crs=spa_ref,
-                                time={'variable': time_var, 'value': time_value})
+def NetCDF_to_Rasters(input_nc, output_folder, ras_variable,
+                      x_variable='longitude', y_variable='latitude',
+                      crs=None, time_variable='time_yyyymm', time_values=None,
+                      compress=None, cog=False, vrt=False, statistics=False,
+                      n_threads=4):
+    """
+    Export the time slices of a variable in a NetCDF file to GeoTIFFs. The
+    file is opened and the geotransform is computed once, the slices are
+    read one by one and written by a pool of threads.
+    
+    Parameters
+    ----------
+    input_nc : str
+        NetCDF file.
+    output_folder : str
+        Folder to store the GeoTIFFs, named "{ras_variable}_{time_value}.tif".
+    ras_variable : str
+        Variable to export.
+    x_variable : str, optional
+        Name of the x dimension, default is 'longitude'.
+    y_variable : str, optional
+        Name of the y dimension, default is 'latitude'.
+    crs : str, optional
+        WKT of the projection, default is WGS84.
+    time_variable : str, optional
+        Name of the time dimension, default is 'time_yyyymm'.
+    time_values : list, optional
+        Time values to export, default is all.
+    compress : str, optional
+        Compression of the GeoTIFFs, e.g. 'DEFLATE' or 'LZW', default is None.
+    cog : boolean, optional
+        Write tiled Cloud Optimized GeoTIFFs, default is False.
+    vrt : boolean, optional
+        Also write a VRT with the GeoTIFFs as bands, default is False.
+    statistics : boolean, optional
+        Compute the band statistics of each GeoTIFF, default is False.
+    n_threads : int, optional
+        Number of threads writing GeoTIFFs, default is 4.
+        
+    Returns
+    -------
+    output_tiffs : list
+        The GeoTIFFs, in the order of time_values.
+    output_vrt : str
+        The VRT, only returned when vrt is True.
+    """
+    if crs is None:
+        crs = Spatial_Reference(4326)
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+    
+    inp_nc = netCDF4.Dataset(input_nc, 'r')
+    inp_values = inp_nc.variables[ras_variable]
+    x_index = inp_values.dimensions.index(x_variable)
+    y_index = inp_values.dimensions.index(y_variable)
+    t_index = inp_values.dimensions.index(time_variable)
+    
+    times = inp_nc.variables[time_variable][:]
+    if time_values is None:
+        time_values = times
+    # first index of each time value, as list.index
+    time_indices = dict()
+    for i, time_value in enumerate(times.tolist()):
+        time_indices.setdefault(time_value, i)
+    
+    inp_x = inp_nc.variables[x_variable][:]
+    inp_y = inp_nc.variables[y_variable][:]
+    cellsize_x = abs(np.mean(np.diff(inp_x)))
+    cellsize_y = -abs(np.mean(np.diff(inp_y)))
+    flip = inp_y[-1] > inp_y[0]
+    out_top_left_x = inp_x[0] - cellsize_x/2.0
+    out_top_left_y = (inp_y[-1] if flip else inp_y[0]) - cellsize_y/2.0
+    geotransform = (out_top_left_x, cellsize_x, 0, out_top_left_y, 0, cellsize_y)
+    
+    options = ['COMPRESS={0}'.format(compress)] if compress else []
+    if not cog and compress:
+        options.append('TILED=YES')
+    
+    def write(output_tiff, inp_array):
+        driver = gdal.GetDriverByName('MEM' if cog else 'GTiff')
+        if os.path.exists(output_tiff):
+            gdal.GetDriverByName('GTiff').Delete(output_tiff)
+        y_ncells, x_ncells = inp_array.shape
+        out_source = driver.Create('' if cog else output_tiff, x_ncells, y_ncells,
+                                   1, gdaltype_from_dtype(inp_array.dtype),
+                                   [] if cog else options)
+        out_source.SetGeoTransform(geotransform)
+        out_source.SetProjection(crs)
+        out_band = out_source.GetRasterBand(1)
+        out_band.WriteArray(inp_array)
+        if statistics:
+            out_band.ComputeStatistics(True)
+        if cog:
+            gdal.GetDriverByName('COG').CreateCopy(output_tiff, out_source,
+                                                   options=options)
+        out_source = None
+        return output_tiff
+    
+    output_tiffs = list()
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        for time_value in time_values:
+            time_index = time_indices[time_value]
+            selection = [slice(None)] * inp_values.ndim
+            selection[t_index] = time_index
+            inp_array = np.ma.getdata(inp_values[tuple(selection)])
+            
+            # Transpose array if necessary
+            if y_index > x_index:
+                inp_array = np.transpose(inp_array)
+            if flip:
+                inp_array = np.flipud(inp_array)
+            
+            output_tiff = os.path.join(output_folder, "{0}_{1}.tif".format(ras_variable, time_value))
+            output_tiffs.append(output_tiff)
+            pending.append(executor.submit(write, output_tiff, inp_array))
+            while len(pending) > 2 * n_threads:
+                pending.popleft().result()
+        while pending:
+            pending.popleft().result()
+    
+    inp_nc.close()
+    
+    if vrt:
+        output_vrt = os.path.join(output_folder, "{0}.vrt".format(ras_variable))
+        gdal.BuildVRT(output_vrt, output_tiffs, separate=True)
+        return output_tiffs, output_vrt
+    
+    return output_tiffs
+
+def SortWaterPix(nc, variable, output_folder, time_var = 'time_yyyymm', n_threads = 4):
+    output_dir = os.path.join(output_folder, variable)
+    NetCDF_to_Rasters(nc, output_dir, variable,
+                      x_variable='longitude', y_variable='latitude',
+                      crs=Spatial_Reference(4326), time_variable=time_var,
+                      statistics=True, n_threads=n_threads)
     return output_dir
 
 #def calc_missing_runoff_fractions(metadata):
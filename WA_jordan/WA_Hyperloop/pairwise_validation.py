@@ -83,6 +83,12 @@ def compare_rasters2stations(ds1_fhs, ds1_dates, station_dict, output_dir, stati
     becgis.assert_proj_res_ndv([ds1_fhs])
     no_of_stations = len(list(station_dict.keys()))
     ds1_dates = becgis.convert_datetime_date(ds1_dates, out = 'datetime')
+    
+    # Resolve all station pixels once and read each raster once for all stations.
+    stations = list(station_dict.keys())
+    xpixels, ypixels = pixelcoordinates_array([station[0] for station in stations], [station[1] for station in stations], ds1_fhs[0])
+    ds1_columns = becgis.date_index(np.arange(len(ds1_dates)), ds1_dates)
+    ds1_matrix = sample_rasters(ds1_fhs, xpixels, ypixels)
 
     for i, station in enumerate(station_dict.keys()):
         
@@ -91,15 +97,14 @@ def compare_rasters2stations(ds1_fhs, ds1_dates, station_dict, output_dir, stati
         sample_size = common_dates.size
         
         if sample_size >= min_records:
-            ds1_values = list()
-            xpixel, ypixel = pixelcoordinates(station[0], station[1], ds1_fhs[0])
+            xpixel, ypixel = xpixels[i], ypixels[i]
             
             if np.any([np.isnan(xpixel), np.isnan(ypixel)]):
                 print("Skipping station ({0}), cause its not on the map".format(station))
                 continue
             else:
-                for date in common_dates:
-                    ds1_values.append(becgis.open_as_array(ds1_fhs[ds1_dates == date][0], nan_values = True)[ypixel, xpixel])
+                xpixel, ypixel = int(xpixel), int(ypixel)
+                ds1_values = list(ds1_matrix[i, [ds1_columns[date] for date in common_dates]])
                     
                 common_station_values = [station_values[station_dates == date][0] for date in common_dates]
                 
@@ -189,7 +194,144 @@ def compare_rasters2stations(ds1_fhs, ds1_dates, station_dict, output_dir, stati
 
     return results
 
-def compare_rasters2rasters(ds1_fhs, ds1_dates, ds2_fhs, ds2_dates, output_dir = None, dataset_names = None, data_treshold = 0.75):
+def read_rows(fh, y0, rows):
+    """
+    Read a block of rows from a raster, no-data-values are set to np.nan.
+    
+    Parameters
+    ----------
+    fh : str
+        Filehandle pointing to a raster.
+    y0 : int
+        First row to read.
+    rows : int
+        Number of rows to read.
+        
+    Returns
+    -------
+    array : ndarray
+        The rows [y0, y0 + rows) of the raster.
+    """
+    dataset = gdal.Open(fh, gdal.GA_ReadOnly)
+    band = dataset.GetRasterBand(1)
+    ndv = band.GetNoDataValue()
+    array = band.ReadAsArray(0, y0, dataset.RasterXSize, rows)
+    dataset = None
+    if ndv is not None:
+        array[array == ndv] = np.nan
+    return array
+
+def validation_statistics(ds1_fhs, ds1_dates, ds2_fhs, ds2_dates, lu = None, classes = None, block_rows = None):
+    """
+    Compare two series of raster maps in a single pass. The maps of each
+    common date are read once (in blocks of block_rows rows when given) and
+    added to NaN-aware running sums per pixel, so the series are never held
+    in memory as a whole. The relative bias, RMSE, Pearson-correlation and
+    Nash-Sutcliffe coefficients per pixel follow from these sums, with ds1
+    as the reference as in pairwise_validation.
+    
+    Parameters
+    ----------
+    ds1_fhs : ndarray
+        Array with strings pointing to maps of dataset 1.
+    ds1_dates : ndarray
+        Array with same shape as ds1_fhs, containing datetime.date objects.
+    ds2_fhs : ndarray
+        Array with strings pointing to maps of dataset 2.
+    ds2_dates : ndarray
+        Array with same shape as ds2_fhs, containing datetime.date objects.
+    lu : ndarray, optional
+        Landuse map, to calculate the spatial mean of both datasets per class
+        and date in the same pass.
+    classes : list, optional
+        Landuse classes to summarize, default is all classes in lu.
+    block_rows : int, optional
+        Number of rows to read at once, default is None (whole maps).
+        
+    Returns
+    -------
+    results : dict
+        Dictionary with the common 'dates', the number of paired samples 'n'
+        and 'pearson', 'rmse', 'ns' and 'bias' per pixel. 'ds1_totals' and
+        'ds2_totals' hold the spatial mean of each dataset per date and, when
+        lu is given, 'ds1_per_class' and 'ds2_per_class' the spatial means
+        per date (rows) and class (columns), over the valid pixels of each
+        dataset.
+    """
+    common_dates = becgis.common_dates([ds1_dates, ds2_dates])
+    ds1_index = becgis.date_index(ds1_fhs, ds1_dates)
+    ds2_index = becgis.date_index(ds2_fhs, ds2_dates)
+    driver, NDV, xsize, ysize, GeoT, Projection = becgis.get_geoinfo(ds1_fhs[0])
+    if block_rows is None:
+        block_rows = ysize
+    
+    names = ['n', 's1', 's2', 's11', 's22', 's12', 'sd']
+    sums = {name: np.zeros((ysize, xsize)) for name in names}
+    totals = np.zeros((2, len(common_dates), 2))
+    
+    if lu is not None:
+        lu = np.asarray(lu)
+        if classes is None:
+            classes = np.unique(lu[~np.isnan(lu)])
+        classes = np.asarray(classes, dtype = float)
+        order = np.argsort(classes)
+        # index of the class of each pixel, len(classes) for other pixels
+        pos = np.clip(np.searchsorted(classes[order], lu), 0, len(classes) - 1)
+        with np.errstate(invalid = 'ignore'):
+            lu_idx = np.where(classes[order][pos] == lu, order[pos], len(classes))
+        class_sums = np.zeros((2, len(common_dates), len(classes) + 1, 2))
+    
+    for y0 in range(0, ysize, block_rows):
+        rows = min(block_rows, ysize - y0)
+        block = {name: sums[name][y0:y0 + rows] for name in names}
+        for t, date in enumerate(common_dates):
+            if rows == ysize:
+                DS1 = becgis.open_as_array(ds1_index[date], nan_values = True)
+                DS2 = becgis.open_as_array(ds2_index[date], nan_values = True)
+            else:
+                DS1 = read_rows(ds1_index[date], y0, rows)
+                DS2 = read_rows(ds2_index[date], y0, rows)
+            
+            for i, DS in enumerate([DS1, DS2]):
+                valid = ~np.isnan(DS)
+                totals[i, t] += [np.sum(DS[valid], dtype = np.float64), np.sum(valid)]
+                if lu is not None:
+                    idx = lu_idx[y0:y0 + rows][valid]
+                    class_sums[i, t, :, 0] += np.bincount(idx, weights = DS[valid], minlength = len(classes) + 1)
+                    class_sums[i, t, :, 1] += np.bincount(idx, minlength = len(classes) + 1)
+            
+            paired = ~np.isnan(DS1) & ~np.isnan(DS2)
+            x = DS1[paired]
+            y = DS2[paired]
+            block['n'][paired] += 1
+            block['s1'][paired] += x
+            block['s2'][paired] += y
+            block['s11'][paired] += x.astype(np.float64)**2
+            block['s22'][paired] += y.astype(np.float64)**2
+            block['s12'][paired] += x.astype(np.float64) * y
+            block['sd'][paired] += (x - y)**2
+    
+    n = sums['n']
+    results = {'dates': common_dates, 'n': n}
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        m1 = sums['s1'] / n
+        m2 = sums['s2'] / n
+        ss1 = sums['s11'] - n * m1**2
+        ss2 = sums['s22'] - n * m2**2
+        results['pearson'] = (sums['s12'] - n * m1 * m2) / (np.sqrt(ss1) * np.sqrt(ss2))
+        results['rmse'] = np.where(n == 0., np.nan, np.sqrt(sums['sd'] / n))
+        results['ns'] = 1. - sums['sd'] / ss1
+        results['bias'] = sums['s2'] / sums['s1']
+        results['ds1_totals'] = totals[0, :, 0] / totals[0, :, 1]
+        results['ds2_totals'] = totals[1, :, 0] / totals[1, :, 1]
+        if lu is not None:
+            results['ds1_per_class'] = class_sums[0, :, :-1, 0] / class_sums[0, :, :-1, 1]
+            results['ds2_per_class'] = class_sums[1, :, :-1, 0] / class_sums[1, :, :-1, 1]
+    for varname in ['pearson', 'ns', 'bias']:
+        results[varname][n == 0] = np.nan
+    return results
+
+def compare_rasters2rasters(ds1_fhs, ds1_dates, ds2_fhs, ds2_dates, output_dir = None, dataset_names = None, data_treshold = 0.75, block_rows = None):
     """ 
     Compare two series of raster maps by computing
     the relative bias, RMAE, Pearson-correlation coefficient and
@@ -215,12 +357,14 @@ def compare_rasters2rasters(ds1_fhs, ds1_dates, ds2_fhs, ds2_dates, output_dir =
     data_treshold : float, optional
         pixels with less than data_treshold * total_number_of_samples actual values are set to no-data, i.e. pixels with
         too few data points are ignored.
+    block_rows : int, optional
+        number of rows to read at once, see validation_statistics. Default is None, whole maps.
         
     Returns
     -------
     results : dict
-        dictionary with four keys (relative bias, RMAE, Pearson-correlation coefficient and 
-        the Nash-Sutcliffe) with 2dnarrays of the values per pixel.
+        dictionary with four keys ('bias', 'rmse', 'pearson' and 'ns') with 2dnarrays of the 
+        relative bias, RMSE, Pearson-correlation coefficient and the Nash-Sutcliffe coefficient per pixel.
         
     Examples
     --------
@@ -235,33 +379,15 @@ def compare_rasters2rasters(ds1_fhs, ds1_dates, ds2_fhs, ds2_dates, output_dir =
     
     driver, NDV, xsize, ysize, GeoT, Projection = becgis.get_geoinfo(ds1_fhs[0])
     
-    common_dates = becgis.common_dates([ds1_dates, ds2_dates])
-    
-    diff_sum = np.zeros((ysize,xsize))
-    non_nans = np.zeros((ysize,xsize))
-    
-    progress = 0 
+    stats = validation_statistics(ds1_fhs, ds1_dates, ds2_fhs, ds2_dates, block_rows = block_rows)
+    common_dates = stats['dates']
     samples = len(common_dates)
     
-    for date in common_dates:
-        
-        DS1 = becgis.open_as_array(ds1_fhs[ds1_dates == date][0], nan_values = True)
-        DS2 = becgis.open_as_array(ds2_fhs[ds2_dates == date][0], nan_values = True)
-        
-        DS1[np.isnan(DS2)] = np.nan
-        DS2[np.isnan(DS1)] = np.nan
-        
-        non_nans[~np.isnan(DS1)] += np.ones((ysize,xsize))[~np.isnan(DS1)]
-        
-        diff = (DS1 - DS2)**2
-        diff_sum[~np.isnan(DS1)] += diff[~np.isnan(DS1)]
-        
-        progress += 1
-        print("progress: {0} of {1} finished".format(progress, samples))
-
-    diff_sum[non_nans <= data_treshold*samples] = np.nan
+    # pixels with too few samples are set to no-data
+    too_few = stats['n'] <= data_treshold*samples
     results = dict()
-    results['rmse'] = np.where(non_nans == 0., np.nan, np.sqrt(diff_sum / non_nans))
+    for varname in ['rmse', 'pearson', 'ns', 'bias']:
+        results[varname] = np.where(too_few, np.nan, stats[varname])
     
     startdate = common_dates[0].strftime('%Y%m%d')
     enddate = common_dates[-1].strftime('%Y%m%d')
@@ -317,35 +443,17 @@ def compare_rasters2rasters_per_lu(ds1_fhs, ds1_dates, ds2_fhs, ds2_dates, lu_fh
     driver, NDV, xsize, ysize, GeoT, Projection = becgis.get_geoinfo(lu_fh)
     becgis.create_geotiff(lu_fh.replace('.tif','_.tif'), LUCS, driver, NDV, xsize, ysize, GeoT, Projection)
 
-    common_dates = becgis.common_dates([ds1_dates, ds2_dates])
+    stats = validation_statistics(ds1_fhs, ds1_dates, ds2_fhs, ds2_dates, lu = LUCS, classes = selected_lucs)
     
-    ds1_totals = np.array([])
-    ds2_totals = np.array([])
+    ds1_totals = stats['ds1_totals']
+    ds2_totals = stats['ds2_totals']
     
     DS1_per_class = dict()
     DS2_per_class = dict()
     
-    for date in common_dates:
-        
-        DS1 = becgis.open_as_array(ds1_fhs[ds1_dates == date][0], nan_values = True)
-        DS2 = becgis.open_as_array(ds2_fhs[ds2_dates == date][0], nan_values = True)
-        
-        for clss in selected_lucs:
-            
-            if clss in list(DS1_per_class.keys()):
-                DS1_per_class[clss] = np.append(DS1_per_class[clss], np.nanmean(DS1[LUCS == clss]))
-            else:
-                DS1_per_class[clss] = np.array([np.nanmean(DS1[LUCS == clss])])
-                
-            if clss in list(DS2_per_class.keys()):
-                DS2_per_class[clss] = np.append(DS2_per_class[clss], np.nanmean(DS2[LUCS == clss]))
-            else:
-                DS2_per_class[clss] = np.array([np.nanmean(DS2[LUCS == clss])])
-
-        ds1_totals = np.append(ds1_totals, np.nanmean(DS1))
-        ds2_totals = np.append(ds2_totals, np.nanmean(DS2))
-        
-        print("Finished {0}, going to {1}".format(date, common_dates[-1]))
+    for i, clss in enumerate(selected_lucs):
+        DS1_per_class[clss] = stats['ds1_per_class'][:, i]
+        DS2_per_class[clss] = stats['ds2_per_class'][:, i]
     
     for clss in selected_lucs:
         
@@ -856,6 +964,112 @@ def pixelcoordinates(lat,lon,rasterfile):
         ypixel = np.nan
     return xpixel, ypixel
 
+def pixelcoordinates_array(lats, lons, rasterfile):
+    """
+    Vectorized version of pixelcoordinates for a set of points.
+    
+    Parameters
+    ----------
+    lats : ndarray
+        Latitudes in same unit as provided map, usually decimal degrees.
+    lons : ndarray
+        Longitudes in same unit as provided map, usually decimal degrees.
+    rasterfile : str
+        Filehandle pointing to georeferenced rasterfile.
+        
+    Returns
+    -------
+    xpixels : ndarray
+        The columns in which the coordinates are situated, np.nan for points
+        that are not on the map.
+    ypixels : ndarray
+        The rows in which the coordinates are situated, np.nan for points
+        that are not on the map.
+    """
+    SourceDS = gdal.Open(rasterfile, gdal.GA_ReadOnly)
+    xsize = SourceDS.RasterXSize
+    ysize = SourceDS.RasterYSize
+    GeoT = SourceDS.GetGeoTransform()
+    SourceDS = None
+    lats = np.asarray(lats, dtype = float)
+    lons = np.asarray(lons, dtype = float)
+    on_map = (lons >= GeoT[0]) & (lons <= GeoT[0] + xsize * GeoT[1]) & (lats <= GeoT[3]) & (lats >= GeoT[3] + ysize * GeoT[5])
+    xpixels = np.clip(np.floor((lons - GeoT[0]) / GeoT[1]), 0, xsize - 1)
+    ypixels = np.clip(np.floor((lats - GeoT[3]) / GeoT[5]), 0, ysize - 1)
+    xpixels[~on_map] = np.nan
+    ypixels[~on_map] = np.nan
+    for lat, lon in zip(lats[~on_map], lons[~on_map]):
+        print('longitude or latitude is not on the map {0}, returning NaNs'.format((lat,lon)))
+    return xpixels, ypixels
+
+def sample_rasters(fhs, xpixels, ypixels):
+    """
+    Extract the values of a set of pixels from a series of rasters. Each
+    raster is opened once and only the window around the pixels, or the
+    blocks holding them when that is less data, is read.
+    
+    Parameters
+    ----------
+    fhs : 1dnarray
+        Filehandles pointing to rasters with the same grid.
+    xpixels : ndarray
+        Columns of the pixels, see pixelcoordinates_array.
+    ypixels : ndarray
+        Rows of the pixels, see pixelcoordinates_array.
+        
+    Returns
+    -------
+    values : ndarray
+        Array of shape (pixels, rasters) with the pixel values, no-data-values
+        and pixels not on the map are np.nan.
+    """
+    xpixels = np.asarray(xpixels, dtype = float)
+    ypixels = np.asarray(ypixels, dtype = float)
+    on_map = ~np.isnan(xpixels) & ~np.isnan(ypixels)
+    x = xpixels[on_map].astype(int)
+    y = ypixels[on_map].astype(int)
+    values = None
+    windows = None
+    
+    for j, fh in enumerate(fhs):
+        dataset = gdal.Open(fh, gdal.GA_ReadOnly)
+        band = dataset.GetRasterBand(1)
+        ndv = band.GetNoDataValue()
+        
+        if windows is None:
+            # Read the bounding window of all pixels or only the blocks with pixels.
+            windows = list()
+            if x.size > 0:
+                bx, by = band.GetBlockSize()
+                blocks = np.unique(np.array([x // bx, y // by]).T, axis = 0)
+                window_size = (x.max() - x.min() + 1) * (y.max() - y.min() + 1)
+                if len(blocks) * bx * by < window_size:
+                    for xb, yb in blocks:
+                        xoff, yoff = int(xb * bx), int(yb * by)
+                        members = np.where((x // bx == xb) & (y // by == yb))[0]
+                        windows.append((xoff, yoff, min(bx, dataset.RasterXSize - xoff), min(by, dataset.RasterYSize - yoff), members))
+                else:
+                    windows.append((int(x.min()), int(y.min()), int(x.max() - x.min() + 1), int(y.max() - y.min() + 1), np.arange(x.size)))
+        
+        data = None
+        for xoff, yoff, xs, ys, members in windows:
+            window = band.ReadAsArray(xoff, yoff, xs, ys)
+            if data is None:
+                data = np.zeros(x.size, dtype = np.result_type(window.dtype, np.float32))
+            data[members] = window[y[members] - yoff, x[members] - xoff]
+            if ndv is not None:
+                data[members[window[y[members] - yoff, x[members] - xoff] == ndv]] = np.nan
+        dataset = None
+        
+        if values is None:
+            values = np.full((xpixels.size, len(fhs)), np.nan, dtype = np.float32 if data is None else data.dtype)
+        if data is not None:
+            values[on_map, j] = data
+    
+    if values is None:
+        values = np.full((xpixels.size, 0), np.nan)
+    return values
+
 def get_timeseries_raster(ds1_fhs, ds1_dates, coordinates, output_fh, unit = 'm3/s'):
     """
     Substract a timeseries from a set of raster files. Store results in a csv-file.
@@ -874,16 +1088,13 @@ def get_timeseries_raster(ds1_fhs, ds1_dates, coordinates, output_fh, unit = 'm3
     unit : str, optional
         String indicating the unit of the data, default is 'm3/s'.
     """
-    ds1_values = list()   
     xpixel, ypixel = pixelcoordinates(coordinates[0], coordinates[1], ds1_fhs[0])
     
     if np.any([np.isnan(xpixel), np.isnan(ypixel)]):
         print("Coordinates ({0}) not on the map".format(coordinates))
     else:
-        for date in ds1_dates:
-            ds1_values.append(becgis.open_as_array(ds1_fhs[ds1_dates == date][0], nan_values = True)[ypixel, xpixel])
-        
-        ds1_values = np.array(ds1_values)    
+        ds1_index = becgis.date_index(ds1_fhs, ds1_dates)
+        ds1_values = sample_rasters([ds1_index[date] for date in ds1_dates], [xpixel], [ypixel])[0]
         
         csv_file = open(output_fh, 'wb')
         writer = csv.writer(csv_file, delimiter=';')
@@ -12,8 +12,8 @@ from builtins import range
 import numpy as np
 import os
 import csv
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib.pyplot as plt
-from scipy import ndimage
 import pandas as pd
 import xml.etree.ElementTree as ET
 import datetime
@@ -136,6 +136,9 @@ def create_sheet2_csv(lulc_dict, classes_dict, lu_fh, start_month, et_fhs, et_da
     
     # Check for which dates calculations can be made.
     common_dates = becgis.common_dates([et_dates, t_dates, i_dates])
+    et_index = becgis.date_index(et_fhs, et_dates)
+    t_index = becgis.date_index(t_fhs, t_dates)
+    i_index = becgis.date_index(i_fhs, i_dates)
     water_dates = np.copy(common_dates)
     for w in water_dates:
         if w.month < start_month:
@@ -168,9 +171,9 @@ def create_sheet2_csv(lulc_dict, classes_dict, lu_fh, start_month, et_fhs, et_da
         writer.writerow(first_row)
         
         # Open the T, ET and I maps and set NDV pixels to NaN.
-        T = becgis.open_as_array(t_fhs[t_dates == date][0], nan_values = True)
-        ET = becgis.open_as_array(et_fhs[et_dates == date][0], nan_values = True)
-        I = becgis.open_as_array(i_fhs[i_dates == date][0], nan_values = True)
+        T = becgis.open_as_array_cached(t_index[date], nan_values = True)
+        ET = becgis.open_as_array_cached(et_index[date], nan_values = True)
+        I = becgis.open_as_array_cached(i_index[date], nan_values = True)
                 
         # Convert units from [mm/month] to [km3/month].
         I = I * MapArea / 1000000
@@ -285,6 +288,11 @@ def splitET_ITE(lu_fh, et_fhs, et_dates, lai_fhs, lai_dates, p_fhs, p_dates, n_f
     
     # Check for which dates calculations can be made.
     common_dates = becgis.common_dates([et_dates, lai_dates, p_dates, n_dates, ndm_dates])
+    et_index = becgis.date_index(et_fhs, et_dates)
+    lai_index = becgis.date_index(lai_fhs, lai_dates)
+    p_index = becgis.date_index(p_fhs, p_dates)
+    n_index = becgis.date_index(n_fhs, n_dates)
+    ndm_index = becgis.date_index(ndm_fhs, ndm_dates)
     
     if not ndm_max_original:
         ndm_months = np.array([date.month for date in ndm_dates])
@@ -293,39 +301,30 @@ def splitET_ITE(lu_fh, et_fhs, et_dates, lai_fhs, lai_dates, p_fhs, p_dates, n_f
         if not os.path.exists(ndm_max_folder):
                 os.makedirs(ndm_max_folder)
                 
-        ndm_max_fhs = dict()
-
-        footprint = np.ones((10,10), dtype = np.bool)
+        ndm_climatology = becgis.monthly_climatology(ndm_fhs, ndm_dates)
         
-        for month in np.unique(ndm_months):
-            std, mean = becgis.calc_mean_std(ndm_fhs[ndm_months == month])
-            ndm_temporal_mean = mean #+ 2 * std
+        def calc_ndm_max(month):
+            ndm_temporal_mean = ndm_climatology[month]['mean'].copy() #+ 2 * ndm_climatology[month]['std']
             ndm_temporal_mean [np.isnan(ndm_temporal_mean )] = 0.
-            ndm_spatial_max = ndm_temporal_mean * 0.0
-            for lu in np.unique(LU):
-                ndm_lu = ndm_temporal_mean * 0.0
-                ndm_lu[LU == lu] = ndm_temporal_mean[LU == lu]
-                intermediate = ndimage.maximum_filter(ndm_lu, footprint = footprint)
-                ndm_spatial_max[LU==lu] = intermediate[LU==lu]
+            ndm_spatial_max = becgis.maximum_filter_per_class(ndm_temporal_mean, LU, size = 10)
             output_fh = os.path.join(ndm_max_folder, 'ndm_max_{0}.tif'.format(month_labels[month]))
             becgis.create_geotiff(output_fh, ndm_spatial_max, driver, NDV, xsize, ysize, GeoT, Projection)
-            ndm_max_fhs[month] = output_fh
-            del std, mean, ndm_spatial_max
+            return output_fh
+        
+        # Calculate and save the maps of the different months in parallel.
+        months = np.unique(ndm_months)
+        with ThreadPoolExecutor(max_workers = min(len(months), os.cpu_count() or 1)) as executor:
+            ndm_max_fhs = dict(zip(months, executor.map(calc_ndm_max, months)))
     
     if ndm_max_original:
         # Create some variables to calculate the monthly maximum NDM.
-        ndm_months = np.array([date.month for date in ndm_dates])
-        unique_ndm_months, counts = np.unique(ndm_months, return_counts = True)
+        ndm_climatology = becgis.monthly_climatology(ndm_fhs, ndm_dates)
         NDMmax = dict()
         
-        # Calculate the maximum average NDM value for each month.
-        for month in unique_ndm_months:
-            ndm_monthly_mean = np.zeros((ysize,xsize))
-            for date in ndm_dates[ndm_months == month]:
-                data = becgis.open_as_array(ndm_fhs[ndm_dates == date][0], nan_values = True)
-                ndm_monthly_mean[:,:] += data
-            ndm_monthly_mean[:,:] /= counts[unique_ndm_months == month]
-            NDMmax[month] = np.nanmax(ndm_monthly_mean)
+        # Calculate the maximum average NDM value for each month, pixels with
+        # missing values are ignored.
+        for month, stats in ndm_climatology.items():
+            NDMmax[month] = np.nanmax(np.where(stats['count'] == stats['n'], stats['mean'], np.nan))
     
     # Create some variables needed to plot graphs.
     if plot_graph:
@@ -337,9 +336,9 @@ def splitET_ITE(lu_fh, et_fhs, et_dates, lai_fhs, lai_dates, p_fhs, p_dates, n_f
     # Start iterating over dates.
     for date in common_dates:
         # Open data to calculate I and set NDV pixels to NaN.
-        LAI = becgis.open_as_array(lai_fhs[lai_dates == date][0], nan_values = True)
-        P = becgis.open_as_array(p_fhs[p_dates == date][0], nan_values = True)
-        n = becgis.open_as_array(n_fhs[n_dates == date][0], nan_values = True)
+        LAI = becgis.open_as_array(lai_index[date], nan_values = True)
+        P = becgis.open_as_array(p_index[date], nan_values = True)
+        n = becgis.open_as_array(n_index[date], nan_values = True)
         
         # Calculate I.
         I = LAI * (1 - (1 + (P/n) * (1 - np.exp(-0.5 * LAI)) * (1/LAI))**-1) * n
@@ -350,11 +349,11 @@ def splitET_ITE(lu_fh, et_fhs, et_dates, lai_fhs, lai_dates, p_fhs, p_dates, n_f
         I[np.isnan(LAI)] = 0.
         
         # Open ET and NDM maps and set NDV pixels to NaN.
-        ET = becgis.open_as_array(et_fhs[et_dates == date][0], nan_values = True)
+        ET = becgis.open_as_array(et_index[date], nan_values = True)
         
         I = np.nanmin((I, ET), axis = 0)
         
-        NDM = becgis.open_as_array(ndm_fhs[ndm_dates == date][0], nan_values = True)
+        NDM = becgis.open_as_array(ndm_index[date], nan_values = True)
         
         if ndm_max_original:
             NDMMAX = 0.95 / NDMmax[date.month]
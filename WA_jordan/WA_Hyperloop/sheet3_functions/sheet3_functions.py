@@ -548,19 +548,25 @@ def calc_Y_WP_season(startdate, enddate, lu_fh, lu_class, croptype, etgreen_fhs,
         fractions[0] = (start_month_length - startdate.day + 1) / start_month_length
         fractions[-1] = (enddate.day -1) / end_month_length
         
-        NDMs = np.stack([becgis.open_as_array(ndm_fhs[ndm_dates == date][0], nan_values = True) * fraction for date, fraction in zip(req_dates, fractions)], axis=2)
+        ndm_index = becgis.date_index(ndm_fhs, ndm_dates)
+        etgreen_index = becgis.date_index(etgreen_fhs, etgreen_dates)
+        etblue_index = becgis.date_index(etblue_fhs, etblue_dates)
+        p_index = becgis.date_index(p_fhs, p_dates)
+        
+        # the same months are read for every crop and season, through the array cache
+        NDMs = np.stack([becgis.open_as_array_cached(ndm_index[date], nan_values = True) * fraction for date, fraction in zip(req_dates, fractions)], axis=2)
         NDM = np.nansum(NDMs, axis=2)
         del NDMs
         
-        ETGREENs = np.stack([becgis.open_as_array(etgreen_fhs[etgreen_dates == date][0], nan_values = True) * fraction for date, fraction in zip(req_dates, fractions)], axis=2)
+        ETGREENs = np.stack([becgis.open_as_array_cached(etgreen_index[date], nan_values = True) * fraction for date, fraction in zip(req_dates, fractions)], axis=2)
         ETGREEN = np.nansum(ETGREENs, axis=2)
         del ETGREENs
         
-        ETBLUEs = np.stack([becgis.open_as_array(etblue_fhs[etblue_dates == date][0], nan_values = True) * fraction for date, fraction in zip(req_dates, fractions)], axis=2)
+        ETBLUEs = np.stack([becgis.open_as_array_cached(etblue_index[date], nan_values = True) * fraction for date, fraction in zip(req_dates, fractions)], axis=2)
         ETBLUE = np.nansum(ETBLUEs, axis=2)
         del ETBLUEs
         
-        Ps = np.stack([becgis.open_as_array(p_fhs[p_dates == date][0], nan_values = True) * fraction for date, fraction in zip(req_dates, fractions)], axis=2)
+        Ps = np.stack([becgis.open_as_array_cached(p_index[date], nan_values = True) * fraction for date, fraction in zip(req_dates, fractions)], axis=2)
         P = np.nansum(Ps, axis=2)
         del Ps
         
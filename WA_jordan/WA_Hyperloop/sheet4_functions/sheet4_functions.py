@@ -55,10 +55,13 @@ def calc_difference(ds1, ds2, output_folder):
         
     common_dates = becgis.common_dates([ds1[1], ds2[1]])
     
+    ds1_index = becgis.date_index(ds1[0], ds1[1])
+    ds2_index = becgis.date_index(ds2[0], ds2[1])
+    
     for dt in common_dates:
     
-        DS1 = becgis.open_as_array(ds1[0][ds1[1] == dt][0], nan_values = True)
-        DS2 = becgis.open_as_array(ds2[0][ds2[1] == dt][0], nan_values = True)
+        DS1 = becgis.open_as_array(ds1_index[dt], nan_values = True)
+        DS2 = becgis.open_as_array(ds2_index[dt], nan_values = True)
         
         DS2[np.isnan(DS2)] = 0.0
         
@@ -576,17 +579,16 @@ def accumulate_per_classes(lu_fh, AREAS, fh, classes, scale = 1e-6):
         The sum or mean (depending on scale) of the masked values in fh.
     
     """
-    LULC = becgis.open_as_array(lu_fh, nan_values = True)
-    mask = np.logical_or.reduce([LULC == value for value in classes])
-    if np.any([type(fh) is str, type(fh) is np.string_, type(fh) is np.str_ ]):
+    pixels = becgis.lu_class_index(lu_fh).pixels(classes)
+    if isinstance(fh, (str, bytes)):
         data = becgis.open_as_array(fh, nan_values = True)
     else:
         data = fh
         
     if scale == None:
-        accum = np.nanmean(data[mask])
+        accum = np.nanmean(data.ravel()[pixels])
     else:
-        accum = np.nansum(data[mask] * scale * AREAS[mask])
+        accum = np.nansum(data.ravel()[pixels] * scale * AREAS.ravel()[pixels])
     return accum
 
 def accumulate_per_categories(lu_fh, AREAS, fh, dictionary, scale = 1e-6):
@@ -598,8 +600,9 @@ def accumulate_per_categories(lu_fh, AREAS, fh, dictionary, scale = 1e-6):
     ----------
     lu_fh : str
         Filehandle pointing to a landusemap.
-    fh : str
-        Filehandle pointing to a map with data to be accumulated.
+    fh : str or ndarray
+        Filehandle pointing to a map with data to be accumulated, the map is 
+        read once for all categories.
     dictionary : dict
         Dictionary with the different landuseclasses per category, also see 
         examples.
@@ -620,6 +623,9 @@ def accumulate_per_categories(lu_fh, AREAS, fh, dictionary, scale = 1e-6):
                       'Shrubland': [2, 12, 14, 15]}
     
     """
+    if isinstance(fh, (str, bytes)):
+        fh = becgis.open_as_array(fh, nan_values = True)
+    
     accumulated = dict()
     for category in list(dictionary.keys()):
         classes = dictionary[category]
@@ -27,6 +27,7 @@ import ogr
 import cairosvg
 
 import WA_Hyperloop.becgis as becgis
+import WA_Hyperloop.flow_routing as fr
 from WA_Hyperloop import hyperloop as hl
 import WA_Hyperloop.get_dictionaries as gd
 from WA_Hyperloop.paths import get_path
@@ -434,75 +435,49 @@ def upstream_of_lu_class(dem_fh, lu_fh, output_folder, clss=63):
     Parameters
     ----------
     dem_fh : str
-        Filehandle pointing to a Digital Elevation Model.
+        Filehandle pointing to a Digital Elevation Model, it is resampled to
+        the landuse map when it is on a different grid.
     lu_fh : str
         Filehandle pointing to a landuse classification map.
-    clss : int, optional
-        Landuse identifier for which the upstream pixels will be determined.
-        Default is 63 (Managed Water Bodies)
+    clss : int, list or None, optional
+        Landuse identifier(s) for which the upstream pixels will be determined.
+        Default is 63 (Managed Water Bodies). None marks all pixels as
+        downstream.
     output_folder : str
         Folder to store the map 'upstream.tif', contains value 1 for
         pixels upstream of waterbodies, 0 for pixels downstream.
 
     Returns
     -------
-    upstream_fh : str
-        Filehandle pointing to 'upstream.tif' map.
+    upstream : ndarray
+        Boolean map on the landuse grid, True for pixels upstream of the
+        landuseclass.
     """
     upstream_fh = os.path.join(output_folder, 'upstream.tif')
+    driver, NDV, xsize, ysize, GeoT, Projection = becgis.get_geoinfo(lu_fh)
 
     if clss is not None:
-        import pcraster as pcr
-
-        temp_folder = tf.mkdtemp()
-        extra_temp_folder = os.path.join(temp_folder, "out")
-        os.makedirs(extra_temp_folder)
-
-        temp_dem_fh = os.path.join(temp_folder, "dem.map")
-        output1 = os.path.join(temp_folder, "catchments.map")
-        output2 = os.path.join(temp_folder, "catchments.tif")
-        temp2_lu_fh = os.path.join(temp_folder, "lu.map")
-
-        srs_lu, ts_lu, te_lu, ndv_lu = becgis.get_gdalwarp_info(lu_fh)
-        te_lu_new = ' '.join([te_lu.split(' ')[0], te_lu.split(' ')[3], te_lu.split(' ')[2], te_lu.split(' ')[1]])
-
-        GeoT = becgis.get_geoinfo(dem_fh)[4]
-
-        assert abs(GeoT[1]) == abs(GeoT[5]), "Please provide a DEM with square pixels. Unfortunately, PCRaster does not support rectangular pixels."
-
-        temp1_lu_fh = becgis.match_proj_res_ndv(dem_fh, np.array([lu_fh]), temp_folder)
-
-        os.system("gdal_translate -projwin {0} -of PCRaster {1} {2}".format(te_lu_new, dem_fh, temp_dem_fh))
-        os.system("gdal_translate -projwin {0} -of PCRaster {1} {2}".format(te_lu_new, temp1_lu_fh[0], temp2_lu_fh))
+        lulc = becgis.open_as_array(lu_fh, nan_values=True)
 
-        dem = pcr.readmap(temp_dem_fh)
-        ldd = pcr.lddcreate(dem, 9999999, 9999999, 9999999, 9999999)
-        lulc = pcr.nominal(pcr.readmap(temp2_lu_fh))
-        waterbodies = (lulc == clss)
-        catch = pcr.catchment(ldd, waterbodies)
-        pcr.report(catch, output1)
-
-        os.system("gdal_translate -of GTiff {0} {1}".format(output1, output2))
-
-        output3 = becgis.match_proj_res_ndv(lu_fh, np.array([output2]), extra_temp_folder)
-
-        upstream = becgis.open_as_array(output3[0], nan_values=True)
-        upstream[np.isnan(upstream)] = 0.
-        upstream = upstream.astype(np.bool)
-
-        shutil.rmtree(temp_folder)
+        # Route on the DEM resampled to the landuse grid.
+        dem_info = becgis.get_geoinfo(dem_fh)
+        if dem_info[2:5] == (xsize, ysize, GeoT) and dem_info[5].IsSame(Projection):
+            dem = becgis.open_as_array(dem_fh, nan_values=True)
+        else:
+            temp_folder = tf.mkdtemp()
+            dem_reproj_fh = becgis.match_proj_res_ndv(lu_fh, np.array([dem_fh]), temp_folder)
+            dem = becgis.open_as_array(dem_reproj_fh[0], nan_values=True)
+            shutil.rmtree(temp_folder)
 
-        if upstream_fh is not None:
-            driver, NDV, xsize, ysize, GeoT, Projection = becgis.get_geoinfo(lu_fh)
-            becgis.create_geotiff(upstream_fh, upstream.astype(np.int8), driver, NDV, xsize, ysize, GeoT, Projection)
+        upstream = fr.upstream_of(dem, np.isin(lulc, clss),
+                                  xres=abs(GeoT[1]), yres=abs(GeoT[5]))
     else:
-        dummy = becgis.open_as_array(lu_fh, nan_values=True) * 0.
-        dummy = dummy.astype(np.int16)
-        driver, NDV, xsize, ysize, GeoT, Projection = becgis.get_geoinfo(lu_fh)
-        becgis.create_geotiff(upstream_fh, dummy, driver, NDV, xsize, ysize, GeoT, Projection)
+        upstream = np.zeros((ysize, xsize), dtype=bool)
+
+    becgis.create_geotiff(upstream_fh, upstream.astype(np.int16), driver, NDV, xsize, ysize, GeoT, Projection)
 
     print("Finished calculating up and downstream areas.")
-    return upstream_fh
+    return upstream
 
 def linear_fractions(lu_fh, upstream_fh, proxy_fh, output_fh, xs, unit='km',
                      quantity='Distance to water', gw_only_classes=None,
@@ -515,9 +490,9 @@ def linear_fractions(lu_fh, upstream_fh, proxy_fh, output_fh, xs, unit='km',
     ----------
     lu_fh : str
         Filehandle pointing to a landuse classification map.
-    upstream_fh : str
+    upstream_fh : str or ndarray
         Filehandle pointing to map indicating areas upstream and downstream
-        of managed water bodies.
+        of managed water bodies, or the boolean map itself.
     proxy_fh : str
         Filehandle pointing to a map with values used to determine a fraction based on
         a linear function.
@@ -554,7 +529,10 @@ def linear_fractions(lu_fh, upstream_fh, proxy_fh, output_fh, xs, unit='km',
         or beta.
     """
 
-    upstream = becgis.open_as_array(upstream_fh).astype(np.bool)
+    if isinstance(upstream_fh, np.ndarray):
+        upstream = upstream_fh.astype(bool)
+    else:
+        upstream = becgis.open_as_array(upstream_fh).astype(bool)
     distances = becgis.open_as_array(proxy_fh, nan_values=True)
 
     f1 = interpolate.interp1d([xs[0], xs[1]], [1, 0], kind='linear',
@@ -666,13 +644,14 @@ def dryness_fractions(p_fh, std, mean, fractions_dryness_fh, base=-0.5, top=0.0)
 def calc_fractions(p_data, output_dir, dem_fh, lu_fh, fraction_altitude_xs):
     p_fhs, p_dates = p_data
     dem_reproj_fhs = becgis.match_proj_res_ndv(lu_fh, np.array([dem_fh]), output_dir)
-    upstream_fh = upstream_of_lu_class(dem_fh, lu_fh, output_dir, clss=None)
+    upstream = upstream_of_lu_class(dem_reproj_fhs[0], lu_fh, output_dir)
     fractions_altitude_fh = os.path.join(output_dir, 'fractions_altitude.tif')
-    linear_fractions(lu_fh, upstream_fh, dem_reproj_fhs[0], fractions_altitude_fh,
+    linear_fractions(lu_fh, upstream, dem_reproj_fhs[0], fractions_altitude_fh,
                      fraction_altitude_xs, unit='m', quantity='Altitude',
                      plot_graph=False)
 
-    p_months = np.array([date.month for date in p_dates])
+    p_climatology = becgis.monthly_climatology(p_fhs, p_dates)
+    p_index = becgis.date_index(p_fhs, p_dates)
 
     fractions_fhs = np.array([])
 
@@ -681,14 +660,16 @@ def calc_fractions(p_data, output_dir, dem_fh, lu_fh, fraction_altitude_xs):
         fractions_dryness_fh = os.path.join(output_dir, 'fractions_dryness', 'fractions_dryness_{0}_{1}.tif'.format(pdate.year, str(pdate.month).zfill(2)))
         fractions_fh = os.path.join(output_dir, 'fractions', 'fractions_{0}_{1}.tif'.format(pdate.year, str(pdate.month).zfill(2)))
 
-        # If not done yet, calculate the mean and std of the precipitation for the current month of the year.
-        std, mean = becgis.calc_mean_std(p_fhs[p_months == pdate.month])
+        # The mean and std of the precipitation for the current month of the year, std is
+        # NaN for pixels with missing values as in becgis.calc_mean_std.
+        stats = p_climatology[pdate.month]
+        std = np.where(stats['count'] == stats['n'], stats['std'], np.nan)
 
         # Determine fractions regarding dryness to determine non-utilizable outflow.
-        dryness_fractions(p_fhs[p_dates == pdate][0], std, mean,
+        dryness_fractions(p_index[pdate], std, stats['mean'],
                           fractions_dryness_fh, base=-0.5, top=0.0)
         # Multiply the altitude and dryness fractions.
-        FH1 = becgis.open_as_array(fractions_altitude_fh, nan_values = True)
+        FH1 = becgis.open_as_array_cached(fractions_altitude_fh, nan_values = True)
         FH2 = becgis.open_as_array(fractions_dryness_fh, nan_values = True)
         FH3 = FH1 * FH2
         if not os.path.exists(os.path.split(fractions_fh)[0]):
@@ -6,6 +6,7 @@ Created on Tue Jul 30 14:16:35 2019
 """
 import numpy as np
 import os
+import hashlib
 try:
     import gdal
     import osr
@@ -14,7 +15,6 @@ except:
     from osgeo import gdal
     from osgeo import osr
     from osgeo import ogr
-from geopy.distance import geodesic
 
 def GetGeoInfo(fh, subdataset = 0):
     """
@@ -193,6 +193,108 @@ def MatchProjResNDV(source_file, target_fhs, output_dir, resample = 'near', dtyp
             CreateGeoTiff(output_file, DATA, driver, NDV, xsize, ysize, GeoT, Projection)
     return output_files
 
+# Directory to store pixel area grids between runs, None to keep them in memory only
+GRID_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.wa_cache', 'grids')
+_AREA_GRIDS = dict()
+_BASIN_GRIDS = dict()
+
+def _pixel_area_column(GeoT, ysize):
+    """
+    Area [km2] of one pixel per row of a lat/lon grid on the WGS84 ellipsoid,
+    closed-form area of the band between two parallels.
+    """
+    a = 6378137.0
+    f = 1 / 298.257223563
+    e2 = f * (2 - f)
+    e = np.sqrt(e2)
+    top = GeoT[3] + np.arange(ysize) * GeoT[5]
+    bottom = top + GeoT[5]
+    def q(lat):
+        s = np.sin(np.radians(lat))
+        return (1 - e2) * (s / (1 - e2 * s**2) - 1 / (2 * e) * np.log((1 - e * s) / (1 + e * s)))
+    return a**2 / 2 * np.radians(abs(GeoT[1])) * np.abs(q(top) - q(bottom)) / 1e6
+
+def PixelAreaGrid(GeoT, xsize, ysize):
+    """
+    Area of the pixels of a lat/lon grid, computed once per geotransform and
+    size and cached in memory and in GRID_CACHE_DIR.
+    
+    Parameters
+    ----------
+    GeoT : list
+        Geotransform of the grid.
+    xsize : int
+        Amount of pixels in x direction.
+    ysize : int
+        Amount of pixels in y direction.
+        
+    Returns
+    -------
+    map_area : ndarray
+        The area per cell [km2], read-only and shared by all callers.
+    """
+    key = (tuple(float(g) for g in GeoT), int(xsize), int(ysize))
+    if key in _AREA_GRIDS:
+        return _AREA_GRIDS[key]
+    column = None
+    if GRID_CACHE_DIR is not None:
+        fh = os.path.join(GRID_CACHE_DIR, 'area_{0}.npy'.format(
+                hashlib.sha1(repr(key).encode()).hexdigest()))
+        if os.path.isfile(fh):
+            try:
+                column = np.load(fh)
+            except (OSError, ValueError):
+                column = None
+            if column is not None and column.shape != (ysize,):
+                column = None
+    if column is None:
+        column = _pixel_area_column(GeoT, ysize)
+        if GRID_CACHE_DIR is not None:
+            try:
+                os.makedirs(GRID_CACHE_DIR, exist_ok=True)
+                tmp = fh.replace('.npy', '_{0}.tmp.npy'.format(os.getpid()))
+                np.save(tmp, column)
+                os.replace(tmp, fh)
+            except OSError:
+                pass
+    map_area = np.repeat(column[:, None], xsize, axis = 1)
+    map_area.setflags(write = False)
+    _AREA_GRIDS[key] = map_area
+    return map_area
+
+def BasinAreaMask(basin_mask):
+    """
+    Basin mask, pixel area and pixel area inside the basin of a basin mask
+    geotiff, read once per file (and modification time).
+    
+    Parameters
+    ----------
+    basin_mask : str
+        Filehandle pointing to the basin mask geotiff.
+        
+    Returns
+    -------
+    basin : ndarray
+        Basin mask with np.nan outside the basin.
+    map_area : ndarray
+        The area per cell [km2].
+    area_mask : ndarray
+        The area per cell inside the basin [km2], np.nan outside.
+    
+    The arrays are read-only and shared by all callers.
+    """
+    st = os.stat(basin_mask)
+    key = (os.path.abspath(basin_mask), st.st_mtime_ns, st.st_size)
+    if key not in _BASIN_GRIDS:
+        driver, NDV, xsize, ysize, GeoT, Projection = GetGeoInfo(basin_mask)
+        basin = OpenAsArray(basin_mask, nan_values = True)
+        map_area = PixelAreaGrid(GeoT, xsize, ysize)
+        area_mask = map_area * basin
+        basin.setflags(write = False)
+        area_mask.setflags(write = False)
+        _BASIN_GRIDS[key] = (basin, map_area, area_mask)
+    return _BASIN_GRIDS[key]
+
 def MapPixelAreakm(fh, approximate_lengths = False):
     """ 
     Calculate the area of the pixels in a geotiff.
@@ -210,18 +312,7 @@ def MapPixelAreakm(fh, approximate_lengths = False):
         The area per cell.
     """
     driver, NDV, xsize, ysize, GeoT, Projection = GetGeoInfo(fh)
-    AreaColumn = np.zeros((ysize,1))
-    for y in range(ysize):
-        P1 = (GeoT[3] + y*GeoT[5], GeoT[0])
-        P2 = (P1[0],P1[1]+GeoT[1]) 
-        P3 = (P1[0]+GeoT[5],P1[1])
-        P4 = (P1[0]+GeoT[5],P1[1]+GeoT[1])
-        
-        u = geodesic(P1, P2).kilometers
-        l = geodesic(P3, P4).kilometers
-        h = geodesic(P1, P3).kilometers
-        AreaColumn[y,0] = (u+l)/2*h
-    map_area = np.repeat(AreaColumn, xsize, axis = 1)
+    map_area = np.array(PixelAreaGrid(GeoT, xsize, ysize))
     if approximate_lengths:
         pixel_approximation = np.sqrt(abs(GeoT[1]) * abs(GeoT[5]))
         map_area = np.sqrt(map_area) / pixel_approximation
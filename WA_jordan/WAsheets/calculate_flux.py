@@ -126,9 +126,7 @@ def calc_non_utilizable(P, Etrain, Etincr, fractions_fh, basin_mask, chunksize=N
         The total volume of non_utilizable runoff.
     """ 
     if type(basin_mask) is str:
-        basin=gis.OpenAsArray(basin_mask,nan_values=True)
-        area_map=gis.MapPixelAreakm(basin_mask)
-        area_mask=area_map*basin
+        basin,area_map,area_mask=gis.BasinAreaMask(basin_mask)
     else: #basin_mask is 2D array
         area_mask=basin_mask
         
@@ -202,9 +200,7 @@ def calc_flux_per_basin(dts_nc, basin_mask,
     dts=open_nc(dts_nc,chunksize=chunksize)
     #read area mask
     if type(basin_mask) is str:
-        basin=gis.OpenAsArray(basin_mask,nan_values=True)
-        area_map=gis.MapPixelAreakm(basin_mask)
-        area_mask=area_map*basin
+        basin,area_map,area_mask=gis.BasinAreaMask(basin_mask)
     else: #basin_mask is 2D array
         area_mask=basin_mask
     #calculate flux 
@@ -255,100 +251,342 @@ def calc_flux_per_LU_class(dts_nc, lu_nc, basin_mask,
     return
         dataframe (in TCM)
     '''
-    dts=open_nc(dts_nc,chunksize=chunksize)
+    return calc_fluxes_per_LU_class({'flux':dts_nc}, lu_nc, basin_mask,
+                                    chunksize=chunksize,
+                                    outputs={'flux':output},
+                                    lu_dictionary=lu_dictionary,
+                                    quantity=quantity)['flux']
+
+def calc_fluxes_per_LU_class(dts_ncs, lu_nc, basin_mask,
+                             chunksize=None, 
+                             outputs=None,            
+                             lu_dictionary=None, 
+                             quantity='volume'):
+    '''
+    calculate flux per LU class of several datasets in one pass over the 
+    LU map, see calc_flux_per_LU_class
+    
+    dts_ncs: dict
+        {name: path to dataset (NetCDF)}
+    outputs: dict
+        {name: path to output (csv)}, default is None
+    
+    return
+        dict {name: dataframe}
+    '''
+    dts={name:open_nc(nc,chunksize=chunksize) for name,nc in dts_ncs.items()}
     lu=open_nc(lu_nc,chunksize=chunksize,layer=0)
     
     #read basin mask
     if type(basin_mask) is str:
-        basin=gis.OpenAsArray(basin_mask,nan_values=True)
+        basin,area_map,area_mask=gis.BasinAreaMask(basin_mask)
         
     if quantity=='volume':
         #get area mask
-        if type(basin_mask) is str:
-            area_map=gis.MapPixelAreakm(basin_mask)
-            area_mask=area_map*basin
-        else:
+        if type(basin_mask) is not str:
             area_mask=basin_mask 
-        dts_m=dts*area_mask #flux = depth*area
+        weights=area_mask #flux = depth*area
         method='sum'
         
     elif quantity=='depth':
-        dts_m=dts*basin
+        weights=basin
         method='mean'
-        
-#    n_lu=len(lu.time) #number of landuse map
     
-#    if n_lu==1: #single landuse map
-#        LU=lu[0] #get single landuse map            
+    dfs=aggregate_by_lu(dts,lu,lu_dictionary=lu_dictionary,
+                        how=method,weights=weights)
     
-    if lu_dictionary is None:
-        df=aggregate_by_lu_unique(dts_m,lu,how=method)
-    elif type(lu_dictionary) is dict:
-        df=aggregate_by_lu_dictionary(dts_m,lu,lu_dictionary,
-                                      how=method)
-        
-    if output is not None: #export result if output path is defined
-        df.to_csv(output,sep=';')
-        print('Save LU flux as {0}'.format(output))
+    for name,df in dfs.items():
+        if outputs is not None and outputs.get(name) is not None:
+            #export result if output path is defined
+            df.to_csv(outputs[name],sep=';')
+            print('Save LU flux as {0}'.format(outputs[name]))
     lu.close()
-    dts.close()
-    return df
+    for dataset in dts.values():
+        dataset.close()
+    return dfs
 
 def aggregate_by_lu_unique(dts,LU,how='sum'):
     '''aggregate dataset by unique LU classes in LU map(s)
     '''
-    unique_LU=np.unique(LU) #get unique landuse classes
-    unique_LU=unique_LU[~np.isnan(unique_LU)] #exclude nan
-    data=[] #create empty data list
-    
-    LU=dts*0+LU #Trick: to keep same time dimension
-    dts=LU*0+dts #Trick: to keep same time dimension
-    for lucl in unique_LU: #agrregate total fluxes per each lu class
-        dts_lu=xr.where(LU==lucl,dts,np.nan) #mask only lu class
-        if how=='sum':
-            df_lu=dts_lu.sum(dim=[
-                    'latitude',
-                    'longitude'
-                    ]).to_dataframe() #sum of all pixels in lu class
-        elif how=='mean':
-            df_lu=dts_lu.mean(dim=[
-                    'latitude',
-                    'longitude'
-                    ]).to_dataframe() #mean of all pixels in lu class          
-        if len(df_lu.columns)>1:      
-            df_lu.columns=['{0}-{1}'.format(lucl,
-                           col) for col in df_lu.columns] #rename column with variable   
-        else:
-            df_lu.columns=['{0}'.format(lucl) for col in df_lu.columns] #rename column             
-        data.append(df_lu) #append data list by lu class
-    df=pd.concat(data, axis=1) #merge all results into 1 dataframe
-    return df
+    return aggregate_by_lu({'dts':dts},LU,how=how)['dts']
 
 def aggregate_by_lu_dictionary(dts,LU,lu_dictionary,how='sum'):
     '''aggregate dataset by LU classes categories 
     '''
-    data=[] #create empty data list
-    LU=dts*0+LU #Trick: to keep same time dimension
-    dts=LU*0+dts #Trick: to keep same time dimension
-    for key in lu_dictionary: #agrregate total fluxes per each lu class
-        classes=lu_dictionary[key]
-        dts_lu=xr.where(LU.isin(classes),dts,np.nan) #mask only lu class
-        if how=='sum':
-            df_lu=dts_lu.sum(dim=[
-                    'latitude',
-                    'longitude'
-                    ]).to_dataframe() #sum of all pixels in lu class
-        elif how=='mean':
-            df_lu=dts_lu.mean(dim=[
-                    'latitude',
-                    'longitude'
-                    ]).to_dataframe() #mean of all pixels in lu class        
-        if len(df_lu.columns)>1:      
-            df_lu.columns=['{0}-{1}'.format(key,
-                           col) for col in df_lu.columns] #rename column with variable   
+    return aggregate_by_lu({'dts':dts},LU,lu_dictionary=lu_dictionary,
+                           how=how)['dts']
+
+def _lu_index(lu):
+    '''
+    LU codes in a 1D array of LU values and the index of each value in codes
+    '''
+    if lu.size==0:
+        return lu[:0],np.zeros(0,dtype=np.intp)
+    if lu.min()>=0 and lu.max()<2**20:
+        code=lu.astype(np.intp)
+        if np.array_equal(code,lu): #integer codes: O(n) with bincount
+            present=np.flatnonzero(np.bincount(code))
+            index=np.zeros(present[-1]+1,dtype=np.intp)
+            index[present]=np.arange(len(present))
+            return present.astype(lu.dtype),index[code]
+    return np.unique(lu,return_inverse=True)
+
+def aggregate_by_lu(datasets,LU,lu_dictionary=None,how='sum',weights=None):
+    '''
+    aggregate several datasets by LU classes in one pass
+    
+    Each time step of the LU map is read once and the sum (and pixel count)
+    of every variable of every dataset is accumulated per LU code with 
+    np.bincount. Results are identical to masking and reducing the datasets
+    one LU class at a time.
+    
+    datasets: dict
+        {name: xr.Dataset or xr.DataArray}
+    LU: xr.DataArray
+        LU map(s), with or without time dimension
+    lu_dictionary: dict
+        {category: [LU codes]}, default None aggregates by unique LU code
+    how: str
+        'sum' or 'mean'
+    weights: np.array, optional
+        (latitude,longitude) map multiplied with the datasets
+        e.g. pixel area, NaN pixels are excluded
+    
+    return
+        dict {name: dataframe}, columns '{class}' or '{class}-{variable}'
+    '''
+    dfs=aggregate_by_zone(datasets,None,None,LU=LU,lu_dictionary=lu_dictionary,
+                          how=how,weights=weights)
+    return {name:df[0] for name,df in dfs.items()}
+
+def aggregate_by_zone(datasets,zones,members,LU=None,lu_dictionary=None,
+                      how='sum',weights=None):
+    '''
+    aggregate several datasets by zones (and LU classes) in one pass
+    
+    Like aggregate_by_lu, but the sums and pixel counts are accumulated per
+    zone and LU code at once, with the index zone*(number of codes)+code. 
+    The result of a group of zones (e.g. a sub-basin) is the sum over its 
+    zones, see subbasin_zones.
+    
+    zones: np.array
+        (latitude,longitude) zone label per pixel, -1 outside all zones
+        None for one zone with all pixels
+    members: np.array
+        (zones x groups) True if the zone belongs to the group
+    LU: xr.DataArray, optional
+        LU map(s), default None aggregates all pixels of a zone
+    
+    return
+        dict {name: [dataframe of each group]}, columns as aggregate_by_lu
+        or the variables of the dataset without LU map
+    '''
+    datasets={name:(dts.to_dataset() if isinstance(dts,xr.DataArray) else dts)
+              for name,dts in datasets.items()}
+    if weights is not None:
+        weights=np.asarray(weights)
+    if zones is None:
+        members=np.ones((1,1),dtype=bool)
+    else:
+        zones=np.asarray(zones)
+        members=np.asarray(members,dtype=bool)
+    nzones=members.shape[0]
+    has_time=LU is not None and 'time' in LU.dims
+    lu_times=pd.Index(LU.time.values) if has_time else None
+    #time steps of each dataset that are in the LU map, in dataset order
+    steps={}
+    for name,dts in datasets.items():
+        times=pd.Index(dts.time.values)
+        if has_time:
+            times=times[times.isin(lu_times)]
+        steps[name]=times
+    records={name:{var:[] for var in dts.data_vars} 
+             for name,dts in datasets.items()}
+    codes_seen=[]
+    for t in (lu_times if has_time else [None]):
+        if LU is not None:
+            lu=LU.sel(time=t) if has_time else LU
+            lu=np.asarray(lu.transpose('latitude','longitude').values)
+            finite=~np.isnan(lu)
+            if zones is not None:
+                finite&=zones>=0
+            codes,index=_lu_index(lu[finite])
+        else: #one class with all pixels of the zones
+            finite=zones>=0
+            codes=np.zeros(1)
+            index=np.zeros(np.count_nonzero(finite),dtype=np.intp)
+        if zones is not None:
+            index=zones[finite]*len(codes)+index
+        size=nzones*len(codes)
+        codes_seen.append(codes)
+        for name,dts in datasets.items():
+            if has_time: #dataset time step of this LU map
+                times=[t] if t in steps[name] else []
+            else: #same LU map for all time steps
+                times=steps[name]
+            for ti in times:
+                for var in dts.data_vars:
+                    data=dts[var].sel(time=ti).transpose(
+                            'latitude','longitude').values
+                    if weights is not None:
+                        data=data*weights
+                    data=data[finite]
+                    valid=~np.isnan(data)
+                    sums=np.bincount(index[valid],weights=data[valid],
+                                     minlength=size)
+                    counts=np.bincount(index[valid],minlength=size)
+                    records[name][var].append(
+                            (ti,codes,sums.reshape(nzones,len(codes)),
+                             counts.reshape(nzones,len(codes))))
+    #all LU codes in the LU map(s)
+    all_codes=np.unique(np.concatenate(codes_seen))
+    if LU is None: #one class with all codes
+        classes=[(None,all_codes)]
+    else:
+        all_codes=all_codes.astype(LU.dtype)
+        if lu_dictionary is None:
+            classes=[(lucl,[lucl]) for lucl in all_codes]
         else:
-            df_lu.columns=['{0}'.format(key) for col in df_lu.columns] #rename column             
-        data.append(df_lu) #append data list by lu class
-    df=pd.concat(data, axis=1) #merge all results into 1 dataframe
-    return df
+            classes=[(key,lu_dictionary[key]) for key in lu_dictionary]
+    dfs={}
+    for name,dts in datasets.items():
+        times=steps[name]
+        variables=list(dts.data_vars)
+        S={}
+        C={}
+        for var in variables:
+            S[var]=np.zeros((len(times),nzones,len(all_codes)))
+            C[var]=np.zeros((len(times),nzones,len(all_codes)))
+            for ti,codes,sums,counts in records[name][var]:
+                i=times.get_loc(ti)
+                j=np.searchsorted(all_codes,codes)
+                S[var][i][:,j]+=sums
+                C[var][i][:,j]+=counts
+        dfs[name]=[]
+        for group in range(members.shape[1]):
+            rows=np.flatnonzero(members[:,group])
+            columns=[]
+            data=[]
+            for var in variables:
+                S_group=S[var][:,rows].sum(axis=1)
+                C_group=C[var][:,rows].sum(axis=1)
+                dtype=np.result_type(dts[var].dtype,
+                                     weights.dtype if weights is not None 
+                                     else dts[var].dtype)
+                values=[]
+                for key,lu_codes in classes:
+                    cols=np.flatnonzero(np.isin(all_codes,lu_codes))
+                    s=S_group[:,cols].sum(axis=1)
+                    if how=='sum':
+                        values.append(s.astype(dtype))
+                    elif how=='mean':
+                        c=C_group[:,cols].sum(axis=1)
+                        with np.errstate(invalid='ignore',divide='ignore'):
+                            values.append((s/c).astype(dtype))
+                data.append(values)
+            for k,(key,lu_codes) in enumerate(classes):
+                for v,var in enumerate(variables):
+                    if LU is None:
+                        col=var #column of the variable
+                    elif len(variables)>1:
+                        col='{0}-{1}'.format(key,var) #rename column with variable
+                    else:
+                        col='{0}'.format(key) #rename column
+                    columns.append((col,data[v][k]))
+            df=pd.DataFrame(dict(columns),index=pd.Index(times,name='time'))
+            dfs[name].append(df)
+    return dfs
+
+def subbasin_zones(subbasin_masks):
+    '''
+    zone labels of several (sub-)basin masks
+    
+    A zone is a set of pixels that are inside the same masks, so masks may 
+    overlap, e.g. the basin mask and the sub-basin masks. Every mask is the 
+    group of the zones it covers, see aggregate_by_zone.
+    
+    subbasin_masks: dict
+        {sub-basin: path to mask (GeoTIFF)}, all on the same grid
+    
+    return
+        zones: np.array
+            zone label per pixel, -1 outside all masks
+        members: np.array
+            (zones x masks) True if the zone is inside the mask, the masks 
+            in the order of subbasin_masks
+        basin: np.array
+            1 inside the masks, np.nan outside
+        area_mask: np.array
+            pixel area inside the masks [km2], np.nan outside
+    '''
+    grids=[gis.BasinAreaMask(subbasin_masks[sb]) for sb in subbasin_masks]
+    inside=np.array([~np.isnan(basin) for basin,area_map,area_mask in grids])
+    shape=inside.shape[1:]
+    inside=inside.reshape(len(grids),-1)
+    covered=inside.any(axis=0)
+    #zone of each pixel is its pattern of masks
+    patterns,first,labels=np.unique(np.packbits(inside[:,covered],axis=0),
+                                    axis=1,return_index=True,
+                                    return_inverse=True)
+    zones=np.full(inside.shape[1],-1,dtype=np.intp)
+    zones[covered]=labels.reshape(-1)
+    members=inside[:,covered][:,first].T
+    with np.errstate(invalid='ignore'):
+        basin=np.fmax.reduce([basin for basin,area_map,area_mask in grids])
+        area_mask=np.fmax.reduce([area_mask for basin,area_map,area_mask 
+                                  in grids])
+    return zones.reshape(shape),members,basin,area_mask
 
+def calc_fluxes_per_subbasin(dts_ncs, subbasin_masks, lu_nc=None,
+                             chunksize=None, 
+                             outputs=None,            
+                             lu_dictionary=None, 
+                             quantity='volume'):
+    '''
+    calculate flux per (sub-)basin, and per LU class if lu_nc is given, of 
+    several datasets with one pass over each dataset for all sub-basins, 
+    see calc_flux_per_basin and calc_flux_per_LU_class
+    
+    dts_ncs: dict
+        {name: path to dataset (NetCDF)}
+    subbasin_masks: dict
+        {sub-basin: path to mask (GeoTIFF)}
+    lu_nc: str, optional
+        path to NetCDF of LULC map, default None for the total per sub-basin
+    outputs: dict
+        {name: path to output (csv) with {0} for the sub-basin}, 
+        default is None
+    quantity: str
+        'volume' OR 'depth'
+    
+    return
+        dict {sub-basin: {name: dataframe}}
+    '''
+    dts={name:open_nc(nc,chunksize=chunksize) for name,nc in dts_ncs.items()}
+    lu=None if lu_nc is None else open_nc(lu_nc,chunksize=chunksize,layer=0)
+    zones,members,basin,area_mask=subbasin_zones(subbasin_masks)
+    
+    if quantity=='volume':
+        weights=area_mask #flux = depth*area
+        method='sum'
+    elif quantity=='depth':
+        weights=basin
+        method='mean'
+    
+    dfs=aggregate_by_zone(dts,zones,members,LU=lu,lu_dictionary=lu_dictionary,
+                          how=method,weights=weights)
+    
+    results={}
+    for i,sb in enumerate(subbasin_masks):
+        results[sb]={name:df[i] for name,df in dfs.items()}
+        for name,df in results[sb].items():
+            if outputs is not None and outputs.get(name) is not None:
+                #export result if output path is defined
+                output=outputs[name].format(sb)
+                df.to_csv(output,sep=';')
+                print('Save subbasin flux as {0}'.format(output))
+    if lu is not None:
+        lu.close()
+    for dataset in dts.values():
+        dataset.close()
+    return results
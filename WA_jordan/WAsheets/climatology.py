@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Monthly climatologies of datacubes
+
+The count, mean, standard deviation and maximum per calendar month of a
+monthly datacube are computed in a single pass over blocks of time steps,
+merging the statistics of each block into running statistics (Chan et al.)
+instead of grouping the datacube once per statistic. Results are cached by
+the source file of the datacube and broadcast lazily back to its time axis.
+"""
+import os
+import hashlib
+import collections
+import numpy as np
+import xarray as xr
+
+_CLIMATOLOGIES = collections.OrderedDict()
+CACHE_SIZE = 8
+
+class MonthlyClimatology:
+    '''
+    Running count, mean, variance and maximum per calendar month, ignoring
+    NaN values
+
+    The standard deviation is the population standard deviation (ddof=0),
+    as xarray's groupby std.
+    '''
+    def __init__(self):
+        self.n = {}
+        self.count = {}
+        self.mean = {}
+        self.m2 = {}
+        self.max = {}
+
+    def update(self, months, block):
+        '''
+        Add a block of time steps
+
+        months: array of int
+            calendar month of each time step
+        block: ndarray
+            data, time as the first dimension
+        '''
+        months = np.asarray(months)
+        block = np.asarray(block)
+        for m in np.unique(months):
+            data = block[months == m]
+            valid = ~np.isnan(data)
+            count = valid.sum(axis=0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mean = np.nansum(data, axis=0, dtype=np.float64) / count
+            m2 = np.nansum((data - mean)**2, axis=0, dtype=np.float64)
+            maximum = np.fmax.reduce(data, axis=0)
+            if m not in self.n:
+                self.n[m] = len(data)
+                self.count[m] = count
+                self.mean[m] = mean
+                self.m2[m] = m2
+                self.max[m] = maximum
+                continue
+            n_a = self.count[m]
+            total = n_a + count
+            with np.errstate(divide='ignore', invalid='ignore'):
+                delta = mean - self.mean[m]
+                merged_mean = self.mean[m] + delta * count / total
+                merged_m2 = self.m2[m] + m2 + delta**2 * n_a * count / total
+            self.mean[m] = np.where(count == 0, self.mean[m],
+                                    np.where(n_a == 0, mean, merged_mean))
+            self.m2[m] = np.where(count == 0, self.m2[m],
+                                  np.where(n_a == 0, m2, merged_m2))
+            self.max[m] = np.fmax(self.max[m], maximum)
+            self.count[m] = total
+            self.n[m] += len(data)
+
+    def result(self):
+        '''
+        Statistics per calendar month as arrays with the months as first
+        dimension
+
+        return
+        dict with 'month', 'n' (number of time steps), 'count' (number of
+        valid values), 'mean', 'std' and 'max'
+        '''
+        months = sorted(self.n.keys())
+        with np.errstate(divide='ignore', invalid='ignore'):
+            std = [np.sqrt(self.m2[m] / self.count[m]) for m in months]
+        return {
+            'month': np.array(months),
+            'n': np.array([self.n[m] for m in months]),
+            'count': np.stack([self.count[m] for m in months]),
+            'mean': np.stack([self.mean[m] for m in months]),
+            'std': np.stack(std),
+            'max': np.stack([self.max[m] for m in months]),
+            }
+
+def _cache_key(da):
+    source = da.encoding.get('source')
+    if source is None or not os.path.isfile(source):
+        return None
+    st = os.stat(source)
+    # slices of the same file keep its source, tell them apart by coordinates
+    coords = hashlib.sha256()
+    for dim in da.dims:
+        if dim in da.coords:
+            coords.update(np.ascontiguousarray(da[dim].values).tobytes())
+    return (os.path.abspath(source), st.st_size, st.st_mtime_ns, da.name,
+            da.shape, coords.hexdigest())
+
+def monthly_climatology(da, block_size=12):
+    '''
+    Climatology of a monthly datacube
+
+    da: xr.DataArray
+        datacube with dimensions (time, latitude, longitude)
+    block_size: int
+        number of time steps loaded at once
+
+    return
+    xr.Dataset with 'count', 'mean', 'std' and 'max' along a 'month'
+    dimension and the number of time steps per month 'n'. Datacubes opened
+    from a file are cached by path, size, modification time and coordinates.
+    '''
+    key = _cache_key(da)
+    if key is not None and key in _CLIMATOLOGIES:
+        _CLIMATOLOGIES.move_to_end(key)
+        return _CLIMATOLOGIES[key]
+    da = da.transpose('time', ...)
+    months = da['time'].dt.month.values
+    clim = MonthlyClimatology()
+    for t0 in range(0, da.sizes['time'], block_size):
+        block = da.isel(time=slice(t0, t0 + block_size)).values
+        clim.update(months[t0:t0 + block_size], block)
+    stats = clim.result()
+    dims = ('month',) + da.dims[1:]
+    coords = {dim: da[dim] for dim in da.dims[1:] if dim in da.coords}
+    coords['month'] = stats['month']
+    result = xr.Dataset({name: (dims, stats[name])
+                         for name in ['count', 'mean', 'std', 'max']},
+                        coords=coords)
+    result['n'] = ('month', stats['n'])
+    if key is not None:
+        _CLIMATOLOGIES[key] = result
+        while len(_CLIMATOLOGIES) > CACHE_SIZE:
+            _CLIMATOLOGIES.popitem(last=False)
+    return result
+
+def broadcast_months(stat, time):
+    '''
+    Spread a statistic per calendar month lazily over a time axis
+
+    stat: xr.DataArray
+        statistic with a 'month' dimension
+    time: xr.DataArray
+        time coordinate
+
+    return
+    dask-backed xr.DataArray with a 'time' dimension instead of 'month'
+    '''
+    stat = stat.chunk({'month': 1})
+    return stat.sel(month=time.dt.month).drop_vars('month')
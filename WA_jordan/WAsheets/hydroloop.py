@@ -11,6 +11,7 @@ import os
 import numpy as np
 import pandas as pd
 import xarray as xr
+import dask
 import matplotlib.pyplot as plt
 import calendar
 import datetime
@@ -21,6 +22,9 @@ from dateutil.relativedelta import relativedelta
 from . import calculate_flux as cf
 from . import get_dictionaries as gd
 from . import GIS_functions as gis
+from . import reclassify as rc
+from . import climatology as clm
+from . import profiling
 ##
 from scipy import interpolate
 
@@ -114,15 +118,23 @@ def calc_yearly_sheet(monthly_csvs,output_folder,hydroyear='A-DEC'):
             
             
     return yearly_csvs
-def add_flow(flow_nc,additional_flow_nc,
-             name='total_flow',
-             output=None,chunksize=None):
+def quantize(data,least_significant_digit=2):
     '''
-    Add additional_flow_nc to flow_nc and save to new dataset
+    Round data as netCDF4 does when saving with least_significant_digit, 
+    so that a datacube kept in memory has the values it would have after 
+    being saved and read again
+    '''
+    bits=np.ceil(np.log2(10.**least_significant_digit))
+    scale=float(2.**bits)
+    rounded=(np.around(data*scale)/scale).astype(data.dtype)
+    rounded.name=data.name
+    rounded.attrs=data.attrs
+    return rounded
+
+def add_flow_da(flow,additional_flow,name='total_flow'):
+    '''
+    Add additional_flow to flow (xr.DataArray)
     '''
-    flow=cf.open_nc(flow_nc,chunksize=chunksize,layer=0)
-    additional_flow=cf.open_nc(additional_flow_nc,
-                               chunksize=chunksize,layer=0)
     source_info='sum of '+flow.name+' and '+additional_flow.name
     total_flow=flow+additional_flow
     #Add attributes
@@ -132,7 +144,19 @@ def add_flow(flow_nc,additional_flow_nc,
     total_flow.attrs={'units':flow.attrs['units'],
                     'source':source_info,
                     'quantity':name
-                                  }    
+                                  }
+    return total_flow
+
+def add_flow(flow_nc,additional_flow_nc,
+             name='total_flow',
+             output=None,chunksize=None):
+    '''
+    Add additional_flow_nc to flow_nc and save to new dataset
+    '''
+    flow=cf.open_nc(flow_nc,chunksize=chunksize,layer=0)
+    additional_flow=cf.open_nc(additional_flow_nc,
+                               chunksize=chunksize,layer=0)
+    total_flow=add_flow_da(flow,additional_flow,name=name)
     if output is None:
         output=os.path.join(
                 os.path.dirname(flow_nc),
@@ -146,15 +170,10 @@ def add_flow(flow_nc,additional_flow_nc,
                  encoding={total_flow.name:comp})  
     return output  
 
-def substract_flow(flow_nc,subtract_flow_nc,
-             name='difference_flow',
-             output=None,chunksize=None):
+def substract_flow_da(flow,subtract_flow,name='difference_flow'):
     '''
-    substract subtract_flow_nc from flow_nc and save to new dataset
+    substract subtract_flow from flow (xr.DataArray)
     '''
-    flow=cf.open_nc(flow_nc,chunksize=chunksize,layer=0)
-    subtract_flow=cf.open_nc(subtract_flow_nc,
-                               chunksize=chunksize,layer=0)
     source_info='difference of '+flow.name+' and '+subtract_flow.name
     difference_flow=flow-subtract_flow
     #Add attributes
@@ -164,7 +183,19 @@ def substract_flow(flow_nc,subtract_flow_nc,
     difference_flow.attrs={'units':flow.attrs['units'],
                     'source':source_info,
                     'quantity':name
-                                  }    
+                                  }
+    return difference_flow
+
+def substract_flow(flow_nc,subtract_flow_nc,
+             name='difference_flow',
+             output=None,chunksize=None):
+    '''
+    substract subtract_flow_nc from flow_nc and save to new dataset
+    '''
+    flow=cf.open_nc(flow_nc,chunksize=chunksize,layer=0)
+    subtract_flow=cf.open_nc(subtract_flow_nc,
+                               chunksize=chunksize,layer=0)
+    difference_flow=substract_flow_da(flow,subtract_flow,name=name)
     if output is None:
         output=os.path.join(
                 os.path.dirname(flow_nc),
@@ -178,6 +209,36 @@ def substract_flow(flow_nc,subtract_flow_nc,
                  encoding={difference_flow.name:comp})  
     return output  
 
+def split_flow_da(flow,fraction=0.5,sub_names=['sw','gw']):
+    '''
+    split flow (xr.DataArray) into 2 flows using a fraction map 
+    (xr.DataArray) or value
+    '''
+    source_info=flow.name
+    if isinstance(fraction,xr.DataArray): #use fraction map
+        source_info+= ' multiplied by ' +fraction.name
+    else:
+        source_info+= ' multiplied by {0}'.format(fraction)
+
+    flow_one=flow*fraction 
+    flow_two=flow-flow_one 
+    
+    #modify attributes of splitted flow datasets
+    flow_one=flow_one.transpose('time','latitude','longitude')
+    flow_two=flow_two.transpose('time','latitude','longitude')
+    name=flow.name
+    flow_one.name='{0}_{1}'.format(name,sub_names[0])
+    flow_two.name='{0}_{1}'.format(name,sub_names[1])
+    flow_one.attrs={'units':flow.attrs['units'],
+                    'source':source_info,
+                    'quantity':flow.attrs['quantity']
+                                  }
+    flow_two.attrs={'units':flow.attrs['units'],
+                    'source':flow.name+' minus ' +source_info,
+                    'quantity':flow.attrs['quantity']
+                                  }
+    return flow_one,flow_two
+
 def split_flow(flow_nc,
                fraction=0.5,
                fraction_nc=None,                           
@@ -201,31 +262,12 @@ def split_flow(flow_nc,
         name of the splitted flows ex. ['sw','gw']
     '''
     flow=cf.open_nc(flow_nc,chunksize=chunksize,layer=0)
-    source_info=flow.name
     if fraction_nc is not None: #use fraction map
         fraction=cf.open_nc(fraction_nc,
                             chunksize=chunksize,layer=0)
-        source_info+= ' multiplied by ' +fraction.name
-    else:
-        source_info+= ' multiplied by {0}'.format(fraction)
-
-    flow_one=flow*fraction 
-    flow_two=flow-flow_one 
-    
-    #modify attributes of splitted flow datasets
-    flow_one=flow_one.transpose('time','latitude','longitude')
-    flow_two=flow_two.transpose('time','latitude','longitude')
+    flow_one,flow_two=split_flow_da(flow,fraction=fraction,
+                                    sub_names=sub_names)
     name=flow.name
-    flow_one.name='{0}_{1}'.format(name,sub_names[0])
-    flow_two.name='{0}_{1}'.format(name,sub_names[1])
-    flow_one.attrs={'units':flow.attrs['units'],
-                    'source':source_info,
-                    'quantity':flow.attrs['quantity']
-                                  }
-    flow_two.attrs={'units':flow.attrs['units'],
-                    'source':flow.name+' minus ' +source_info,
-                    'quantity':flow.attrs['quantity']
-                                  }
     if output is None:
         output=flow_nc.replace('.nc','_{0}.nc')
     comp = dict(zlib=True, 
@@ -275,6 +317,28 @@ def flow_ratio(numerator_nc,denominator_nc,
                  encoding={ratio.name:comp})  
     return output
 
+def write_datacubes(datacubes,chunksize=None):
+    '''
+    Save several datacubes in one evaluation of their dask graph, so that 
+    inputs and intermediate results shared by the datacubes are read and 
+    computed only once, block by block
+    
+    datacubes: dict
+        {output path: xr.DataArray}
+    '''
+    comp = dict(zlib=True, 
+                complevel=9, 
+                least_significant_digit=2, 
+                chunksizes=chunksize)
+    stores=[]
+    for output,data in datacubes.items():
+        print('Save {0} as {1}'.format(data.name,output))
+        stores.append(data.to_netcdf(output,
+                                     encoding={data.name:comp},
+                                     compute=False))
+    dask.compute(*stores)
+    return list(datacubes.keys())
+
 ##To create fractions.nc file        
 def calc_fractions(p_nc,dem,lu,fraction_altitude_xs,output=None,chunksize=None):
     dts_p=cf.open_nc(p_nc,chunksize=chunksize,layer=0)
@@ -291,20 +355,23 @@ def calc_fractions(p_nc,dem,lu,fraction_altitude_xs,output=None,chunksize=None):
     dates  = pd.DatetimeIndex(dts_p['time'].values)
     p_months = np.array([date.month for date in dates])
 
+    # P climatology, std is NaN where P is missing in any year as in calc_mean_std
+    p_clim = clm.monthly_climatology(dts_p)
+    p_std = p_clim['std'].where(p_clim['count'] == p_clim['n'])
+    
     frac = np.zeros((len(dts_p['time']),len(dts_p['latitude']),len(dts_p['longitude'])))
+    profiling.expect(len(dts_p.time))
     for i in range(len(dts_p.time)):
         P_i = dts_p.isel(time=i).values      
-        fra = dts_p[0]*0
-        aa = [p_months == dates[i].month]      
-        P = dts_p[aa[0]].values
-        std, mean = calc_mean_std(P)
-        fra['time'] = dts_p.isel(time=i)['time']
+        std = p_std.sel(month=p_months[i]).values
+        mean = p_clim['mean'].sel(month=p_months[i]).values
         fractions_dryness_fh = dryness_fractions(P_i, std, mean, base=-0.5, top=0.0)
         
         FH1 = fractions_altitude
         FH2 = fractions_dryness_fh
         FH3 = FH1 * FH2
         frac[i] = FH3    
+        profiling.advance()
     
     f = frac + dts_p*0         
     # f = xr.DataArray(frac, dims=['time','latitude','longitude'], coords={'time':dts_p['time'], 
@@ -528,27 +595,13 @@ def calc_transpiration(et_nc,i_nc,ndm_nc,
     et=cf.open_nc(et_nc,chunksize=chunksize,layer=0)
     interception=cf.open_nc(i_nc,chunksize=chunksize,layer=0)
     ndm=cf.open_nc(ndm_nc,chunksize=chunksize,layer=0)
-    #calculate maximum NDM
+    #calculate maximum NDM per month and spread it to all time steps
+    ndm_clim=clm.monthly_climatology(ndm)
     if not ndm_max_original:
-        ndm_month_avg=ndm.groupby('time.month').mean(
-                dim=['time'],skipna=True) #calculate monthly mean
-        ndm_month_std=ndm.groupby('time.month').std(
-                dim=['time'],skipna=True) #calculate monthly std
-        ndm_month_max=ndm_month_avg+2*ndm_month_std
-        #spread monthly max to all time steps in datacube
-        ndm_max=ndm*0        
-        for i in range(len(ndm_max)):
-           m=pd.to_datetime(ndm.time[0].data).month #month index
-           ndm_max[i]=ndm_month_max[m-1]
-        
-    if ndm_max_original:
-        ndm_month_max=ndm.groupby('time.month').max(
-                dim=['time'],skipna=True) #calculate monthly max      
-        #spread monthly max to all time steps in datacube
-        ndm_max=ndm*0  
-        for i in range(len(ndm_max)):
-           m=pd.to_datetime(ndm.time[0].data).month #month index
-           ndm_max[i]=ndm_month_max[m-1]/0.95
+        ndm_month_max=ndm_clim['mean']+2*ndm_clim['std']
+    else:
+        ndm_month_max=ndm_clim['max']/0.95
+    ndm_max=clm.broadcast_months(ndm_month_max,ndm['time'])
     #calculate Transpiration
     t=xr.ufuncs.minimum((ndm/ndm_max),0.95)*(et-interception)
     #fill in nan value due to missing ndm value    
@@ -783,25 +836,37 @@ def calc_sw_supply_fraction_by_LU(lu_nc,aeisw_tif,
     aeisw_nc: string
         Area equipped with surface water irrigation map (netCDF)
         
+    '''
+    LU=cf.open_nc(lu_nc,chunksize=chunksize,layer=0)   
+    sw_supply_fraction=sw_supply_fraction_by_LU_da(LU,aeisw_tif)
+    comp = dict(zlib=True, 
+                complevel=9, 
+                least_significant_digit=2, 
+                chunksizes=chunksize)
+    encoding = {'sw_supply_fraction': comp}    
+    if output is None:
+        output=os.path.join(os.path.dirname(lu_nc),
+                            'sw_supply_fraction.nc')
+    sw_supply_fraction.to_netcdf(output,encoding=encoding)
+    print('Save monthly sw supply fraction datacube as {0}'.format(output))
+    del LU
+    return output
+
+def sw_supply_fraction_by_LU_da(LU,aeisw_tif):
+    '''
+    SW supply fraction by LU map (xr.DataArray), see 
+    calc_sw_supply_fraction_by_LU
     '''
     lucs = gd.get_sheet4_6_classes() 
     fractions = gd.get_sheet4_6_fractions() #SW supply fractions
-    LU=cf.open_nc(lu_nc,chunksize=chunksize,layer=0)   
-    
-    sw_supply_fraction=LU*0
-    # fraction from dictionary
-    for key in list(fractions.keys()):
-        classes = lucs[key]
-        fraction = fractions[key]
-        # print('{0} {1} {2}'.format(key,classes,fraction))
-        sw_supply_fraction = xr.where(
-                LU.isin(classes),fraction,sw_supply_fraction)        
+    # fraction from dictionary, 0 for LU classes not in the dictionary
+    sw_supply_fraction = rc.reclassify(LU, lucs, fractions, default=0)
     # update fraction with aeisw (GMIA)
     aeisw=gis.OpenAsArray(aeisw_tif,nan_values=True)
     aeisw=aeisw/100 #convert percentage to fraction
     aeisw = np.where(np.isnan(aeisw),np.nanmean(aeisw),aeisw)  #assume average aeisw where NaN
     sw_supply_fraction = xr.where(
-                LU.isin(lucs['Irrigated crops']),# for irrigated crops
+                rc.isin(LU, lucs['Irrigated crops']),# for irrigated crops
                 aeisw,#sw_supply_fraction = aeisw
                 sw_supply_fraction)          
     #save output    
@@ -813,19 +878,7 @@ def calc_sw_supply_fraction_by_LU(lu_nc,aeisw_tif,
                               'quantity':'Fraction of SW supply'
                                   }
     sw_supply_fraction.name = 'sw_supply_fraction'
-    
-    comp = dict(zlib=True, 
-                complevel=9, 
-                least_significant_digit=2, 
-                chunksizes=chunksize)
-    encoding = {'sw_supply_fraction': comp}    
-    if output is None:
-        output=os.path.join(os.path.dirname(lu_nc),
-                            'sw_supply_fraction.nc')
-    sw_supply_fraction.to_netcdf(output,encoding=encoding)
-    print('Save monthly sw supply fraction datacube as {0}'.format(output))
-    del LU
-    return output
+    return sw_supply_fraction
 
 def calc_sw_return_fraction(sroincr_nc,percincr_nc,
                             output=None,
@@ -845,16 +898,7 @@ def calc_sw_return_fraction(sroincr_nc,percincr_nc,
     '''
     sroincr=cf.open_nc(sroincr_nc,chunksize=chunksize,layer=0)
     percincr=cf.open_nc(percincr_nc,chunksize=chunksize,layer=0)
-    #calculate sw return fraction
-    dtot=sroincr+percincr
-    sw_return_frac=xr.where(dtot>0,sroincr/dtot,0)
-    #add attributes
-    sw_return_frac.name='sw_return_fraction'
-    sw_return_frac=sw_return_frac.transpose('time','latitude','longitude')
-    sw_return_frac.attrs={'units':'-',
-                              'source':'SROincr/(SROincr+PERCincr)',
-                              'quantity':'sw_return_fraction'
-                                  }   
+    sw_return_frac=sw_return_fraction_da(sroincr,percincr)
     #save output
     if output is None:
         output=os.path.join(os.path.dirname(sroincr_nc),'sw_return_fraction.nc')
@@ -869,6 +913,22 @@ def calc_sw_return_fraction(sroincr_nc,percincr_nc,
     return output
 
 
+def sw_return_fraction_da(sroincr,percincr):
+    '''
+    Surface water return fraction (xr.DataArray), see calc_sw_return_fraction
+    '''
+    #calculate sw return fraction
+    dtot=sroincr+percincr
+    sw_return_frac=xr.where(dtot>0,sroincr/dtot,0)
+    #add attributes
+    sw_return_frac.name='sw_return_fraction'
+    sw_return_frac=sw_return_frac.transpose('time','latitude','longitude')
+    sw_return_frac.attrs={'units':'-',
+                              'source':'SROincr/(SROincr+PERCincr)',
+                              'quantity':'sw_return_fraction'
+                                  }   
+    return sw_return_frac
+
 def calc_nonconsumed_supply(supply_nc,etincr_nc,
                             output=None, chunksize=None):
     '''
@@ -924,9 +984,27 @@ def calc_land_surface_water_demand(lai_nc, etref_nc, p_nc, lu_nc,
     et_reference=cf.open_nc(etref_nc,chunksize=chunksize,layer=0)
     lu=cf.open_nc(lu_nc,chunksize=chunksize,layer=0)
     p=cf.open_nc(p_nc,chunksize=chunksize,layer=0)
-    
+    demand=land_surface_water_demand_da(lai,et_reference,p,lu)
+    #save results
+    if output is None:
+        output=os.path.join(os.path.dirname(lai_nc),'water_demand.nc')
+    comp = dict(zlib=True, 
+                complevel=9, 
+                least_significant_digit=2, 
+                chunksizes=chunksize)
+    demand.to_netcdf(output,
+                     encoding={'land_surface_water_demand':comp}) 
+                  
+    print('Save monthly land surface water demand datacube as {0}'.format(output))
+    return output
+
+def land_surface_water_demand_da(lai,et_reference,p,lu):
+    '''
+    Land surface water demand (xr.DataArray), see 
+    calc_land_surface_water_demand
+    '''
     #calculate Potential ET using LAI-based crop coefficient Kc
-    kc = xr.where(lu.isin([4, 5, 30, 23, 24, 63]), #mask water classes
+    kc = xr.where(rc.isin(lu, [4, 5, 30, 23, 24, 63]), #mask water classes
                   1.4, #water KC
                   (1 - xr.ufuncs.exp(-0.5 * lai)) / 0.76) #non-water KC   
     
@@ -945,18 +1023,7 @@ def calc_land_surface_water_demand(lai_nc, etref_nc, p_nc, lu_nc,
                               'source':'Potential ET - Effective Rainfall',
                               'quantity':'land_surface_water_demand'
                                   }   
-    #save results
-    if output is None:
-        output=os.path.join(os.path.dirname(lai_nc),'water_demand.nc')
-    comp = dict(zlib=True, 
-                complevel=9, 
-                least_significant_digit=2, 
-                chunksizes=chunksize)
-    demand.to_netcdf(output,
-                     encoding={'land_surface_water_demand':comp}) 
-                  
-    print('Save monthly land surface water demand datacube as {0}'.format(output))
-    return output
+    return demand
 
 def calc_residential_water_consumption(population_tif,
                                        basin_mask,
@@ -979,10 +1046,36 @@ def calc_residential_water_consumption(population_tif,
     flow_type: str
         'demand' or 'supply'
     '''
+    lu=cf.open_nc(lu_nc,chunksize=chunksize,layer=0)
+    residential_wc=residential_water_consumption_da(population_tif,
+                                                    basin_mask,lu,
+                                                    wcpc=wcpc,
+                                                    flow_type=flow_type)
+    if output is None:
+        output=os.path.join(os.path.dirname(lu_nc),
+                                     'residential_{0}.nc'.format(
+                                             flow_type))
+    comp = dict(zlib=True, 
+                complevel=9, 
+                least_significant_digit=2, 
+                chunksizes=chunksize)
+    print('Save residential water {0} as {1}'.format(
+            flow_type,output))
+    residential_wc.to_netcdf(output,
+                         encoding={residential_wc.name:comp})    
+    #close files and return results
+    lu.close()
+    return output
+
+def residential_water_consumption_da(population_tif,basin_mask,lu,
+                                     wcpc=100,flow_type='demand'):
+    '''
+    Residential water demand or supply (xr.DataArray), see 
+    calc_residential_water_consumption
+    '''
     # Read input data
     population=gis.OpenAsArray(population_tif,nan_values=True)
-    area=gis.MapPixelAreakm(basin_mask)
-    lu=cf.open_nc(lu_nc,chunksize=chunksize,layer=0)
+    area=gis.BasinAreaMask(basin_mask)[1]
     #get residential classes
     sheet4_lucs=gd.get_sheet4_6_classes() 
     classes = sheet4_lucs['Residential']    
@@ -1022,23 +1115,7 @@ def calc_residential_water_consumption(population_tif,
                       'source':'WCPC*Population/area',
                       'quantity':'residential water {0}'.format(flow_type)
                                   }
-    if output is None:
-        output=os.path.join(os.path.dirname(lu_nc),
-                                     'residential_{0}.nc'.format(
-                                             flow_type))
-    comp = dict(zlib=True, 
-                complevel=9, 
-                least_significant_digit=2, 
-                chunksizes=chunksize)
-    print('Save residential water {0} as {1}'.format(
-            flow_type,output))
-    residential_wc.to_netcdf(output,
-                         encoding={residential_wc.name:comp})    
-    #close files and return results
-    lu.close()
-    del population
-    del area
-    return output
+    return residential_wc
 
 #%% Sheet 5 functions
 def calc_sw_from_wp(sro,sroincr,bf,supply_sw,output=None,
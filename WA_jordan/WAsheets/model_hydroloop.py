@@ -1,5 +1,6 @@
 from . import calculate_flux as cf
 from . import hydroloop as hl
+from . import profiling
 import os
 import pandas as pd
 import time
@@ -7,6 +8,40 @@ import warnings
 import dask
 dask.config.set(scheduler='synchronous')
 
+def _monthly(*keys):
+    return [('data_cube','monthly',key) for key in keys]
+
+# BASIN entries read by each step, used as cache key by step_cache.StepCache
+STEP_INPUTS = {
+    'resample_lu': [('data_cube','yearly','lu'),('chunksize',)]
+                    +_monthly('p'),
+    'split_et': _monthly('et','i','t','p','lai','nrd','ndm'),
+    'split_supply': _monthly('lu','supply')
+                    +[('gis_data','aeisw'),('chunksize',)],
+    'calc_demand': _monthly('lai','etref','p','lu')+[('chunksize',)],
+    'calc_return': _monthly('supply','etincr','sroincr','percincr')
+                    +[('chunksize',)],
+    'calc_residential_supply': _monthly('lu')
+                    +[('gis_data','population'),('gis_data','basin_mask'),
+                      ('params','wcpc'),('params','wcpc_min'),('chunksize',)],
+    'calc_total_supply': _monthly('sw_supply_fraction','sw_return',
+                                  'gw_return','residential_supply',
+                                  'residential_demand','sw_supply',
+                                  'gw_supply','demand')
+                    +[('params','residential_sw_supply_fraction'),
+                      ('chunksize',)],
+    'calc_supply_fused': _monthly('lu','supply','lai','etref','p','etincr',
+                                  'sroincr','percincr')
+                    +[('gis_data','aeisw'),('gis_data','population'),
+                      ('gis_data','basin_mask'),('params','wcpc'),
+                      ('params','wcpc_min'),
+                      ('params','residential_sw_supply_fraction'),
+                      ('chunksize',)],
+    'calc_fraction': _monthly('p','perc')
+                    +[('data_cube','yearly','lu'),('gis_data','dem'),
+                      ('params','fraction_xs'),('chunksize',)],
+    }
+
 def create_data_cube(metadata, nc_files,table_data):
     basin_name = metadata['name']
     hydro_year = metadata['hydro_year']
@@ -183,6 +218,36 @@ def initialize_hydroloop(metadata, nc_files,table_data):
 
     return BASIN
           
+def run_step(step, BASIN, cache=None, progress=None, records=None):
+    '''
+    Run a hydroloop step with a profiling.StepMonitor
+
+    step: function
+        step taking BASIN as argument
+    cache: step_cache.StepCache, optional
+        cache of the steps in STEP_INPUTS
+    progress: function, optional
+        called as progress(step_name, done, total) with the units of work
+        done by the step
+    records: list, optional
+        the StepMonitor.record of the step is appended, also when it fails
+
+    return
+    result of the step, StepMonitor.record of the step
+    '''
+    monitor = profiling.StepMonitor(step.__name__, progress=progress)
+    try:
+        with monitor:
+            if cache is not None and step.__name__ in STEP_INPUTS:
+                result = cache.run_basin_step(step, BASIN,
+                                              STEP_INPUTS[step.__name__])
+            else:
+                result = step(BASIN)
+    finally:
+        if records is not None:
+            records.append(monitor.record)
+    return result, monitor.record
+
 def resample_lu(BASIN): 
     warnings.filterwarnings("ignore")
     ### Resample yearly LU to monthly netCDF
@@ -352,6 +417,125 @@ def calc_total_supply(BASIN):
           
     return BASIN
           
+# datacubes saved by calc_supply_fused by default, the ones read by the 
+# sheets and calc_time_series
+FUSED_OUTPUTS = ['supply','supply_sw','supply_gw','demand',
+                 'return_sw','return_gw',
+                 'return_sw_from_sw','return_sw_from_gw',
+                 'return_gw_from_sw','return_gw_from_gw']
+
+def calc_supply_fused(BASIN,outputs=None):
+    '''
+    Fused split_supply, calc_demand, calc_return, calc_residential_supply 
+    and calc_total_supply
+    
+    The supply, return, demand and residential datacubes are built as one
+    graph in memory and evaluated once, block by block. Only the datacubes in
+    outputs are saved, with the file names used by the step by step functions.
+    Intermediate datacubes are rounded as if they had been saved and read
+    again, so the saved datacubes are identical to the step by step results.
+    
+    outputs: list, optional
+        keys of BASIN['data_cube']['monthly'] to save, default FUSED_OUTPUTS
+    '''
+    warnings.filterwarnings("ignore")
+    if outputs is None:
+        outputs=FUSED_OUTPUTS
+    monthly=BASIN['data_cube']['monthly']
+    chunksize=BASIN['chunksize']
+    q=hl.quantize
+    def open_cube(key):
+        return cf.open_nc(monthly[key],chunksize=chunksize,layer=0)
+    def split(flow,fraction):
+        flow_one,flow_two=hl.split_flow_da(flow,fraction=fraction)
+        return q(flow_one),q(flow_two)
+    lu=open_cube('lu')
+    supply=open_cube('supply')
+    supply_folder=os.path.dirname(monthly['supply'])
+    lu_folder=os.path.dirname(monthly['lu'])
+    def supply_path(name):
+        return os.path.join(supply_folder,'{0}.nc'.format(name))
+    cubes=[] #(key,path,datacube) in the order of the step by step functions
+    ### split supply
+    sw_supply_fraction=q(hl.sw_supply_fraction_by_LU_da(
+            lu,BASIN['gis_data']['aeisw']))
+    sw_supply,gw_supply=split(supply,sw_supply_fraction)
+    cubes+=[('sw_supply_fraction',
+             os.path.join(lu_folder,'sw_supply_fraction.nc'),
+             sw_supply_fraction),
+            ('sw_supply',monthly['supply'].replace('.nc','_sw.nc'),sw_supply),
+            ('gw_supply',monthly['supply'].replace('.nc','_gw.nc'),gw_supply)]
+    ### demand of land surface
+    demand=q(hl.land_surface_water_demand_da(open_cube('lai'),
+                                             open_cube('etref'),
+                                             open_cube('p'),lu))
+    ### non-consumed supply or return flow, split by sroincr/total_incremental
+    return_flow=q(hl.substract_flow_da(supply,open_cube('etincr'),
+                                       name='return'))
+    sw_return_fraction=q(hl.sw_return_fraction_da(open_cube('sroincr'),
+                                                  open_cube('percincr')))
+    sw_return,gw_return=split(return_flow,sw_return_fraction)
+    cubes+=[('sw_return',supply_path('return_sw'),sw_return),
+            ('gw_return',supply_path('return_gw'),gw_return)]
+    ### residential supply and demand
+    residential_supply=q(hl.residential_water_consumption_da(
+            BASIN['gis_data']['population'],BASIN['gis_data']['basin_mask'],
+            lu,wcpc=BASIN['params']['wcpc'],flow_type='supply'))
+    residential_demand=q(hl.residential_water_consumption_da(
+            BASIN['gis_data']['population'],BASIN['gis_data']['basin_mask'],
+            lu,wcpc=BASIN['params']['wcpc_min'],flow_type='demand'))
+    cubes+=[('residential_supply',
+             os.path.join(lu_folder,'residential_supply.nc'),
+             residential_supply),
+            ('residential_demand',
+             os.path.join(lu_folder,'residential_demand.nc'),
+             residential_demand)]
+    ### split return flow and residential supply by source sw/gw
+    return_sw_from_sw,return_sw_from_gw=split(sw_return,sw_supply_fraction)
+    return_gw_from_sw,return_gw_from_gw=split(gw_return,sw_supply_fraction)
+    f=BASIN['params']['residential_sw_supply_fraction']
+    sw_residential_supply,gw_residential_supply=split(residential_supply,f)
+    ### add residential sw/gw supply to sw/gw supply and sw/gw return
+    supply_sw=q(hl.add_flow_da(sw_supply,sw_residential_supply,
+                               name='total_sw_supply'))
+    supply_gw=q(hl.add_flow_da(gw_supply,gw_residential_supply,
+                               name='total_gw_supply'))
+    return_sw_from_sw=q(hl.add_flow_da(return_sw_from_sw,sw_residential_supply,
+                                       name='total_return_sw_from_sw'))
+    return_gw_from_gw=q(hl.add_flow_da(return_gw_from_gw,gw_residential_supply,
+                                       name='total_return_gw_from_gw'))
+    ### add residential demand to total demand, total return and supply
+    total_demand=q(hl.add_flow_da(demand,residential_demand,
+                                  name='total_demand'))
+    return_sw=q(hl.add_flow_da(return_sw_from_gw,return_sw_from_sw,
+                               name='return_sw'))
+    return_gw=q(hl.add_flow_da(return_gw_from_gw,return_gw_from_sw,
+                               name='return_gw'))
+    total_supply=q(hl.add_flow_da(supply_sw,supply_gw,name='total_supply'))
+    cubes+=[('supply_sw',supply_path('total_sw_supply'),supply_sw),
+            ('supply_gw',supply_path('total_gw_supply'),supply_gw),
+            ('return_sw_from_sw',supply_path('total_return_sw_from_sw'),
+             return_sw_from_sw),
+            ('return_gw_from_gw',supply_path('total_return_gw_from_gw'),
+             return_gw_from_gw),
+            ('return_sw_from_gw',supply_path('return_sw_gw'),
+             return_sw_from_gw),
+            ('return_gw_from_sw',supply_path('return_gw_sw'),
+             return_gw_from_sw),
+            ('demand',os.path.join(os.path.dirname(monthly['lai']),
+                                   'total_demand.nc'),total_demand),
+            ('return_sw',supply_path('return_sw'),return_sw),
+            ('return_gw',supply_path('return_gw'),return_gw),
+            ('supply',supply_path('total_supply'),total_supply)]
+    ### save requested datacubes in one pass
+    datacubes={}
+    for key,path,data in cubes:
+        if key in outputs:
+            datacubes[path]=data #later datacube wins when paths are shared
+            monthly[key]=path
+    hl.write_datacubes(datacubes,chunksize=chunksize)
+    return BASIN
+
 def calc_fraction(BASIN):
     warnings.filterwarnings("ignore")
     ### calculate recharge
@@ -368,16 +552,16 @@ def calc_fraction(BASIN):
 def calc_time_series(BASIN):
           
     ### Calculate subbasin-wide timeseries
-
+    keys=['sro','return_sw','bf','supply_sw']
+    fluxes=cf.calc_fluxes_per_subbasin(
+            {key:BASIN['data_cube']['monthly'][key] for key in keys},
+            BASIN['gis_data']['subbasin_mask'],
+            outputs={key:os.path.join(BASIN['output_folder'],
+                                      'subbasin_{0}_'+key+'.csv') 
+                     for key in keys})
+    profiling.expect(len(BASIN['gis_data']['subbasin_mask']))
     for sb in BASIN['gis_data']['subbasin_mask']:
-        subbasin={}
-        for key in ['sro','return_sw','bf','supply_sw']:
-            output=os.path.join(BASIN['output_folder'],
-                                'subbasin_{0}_{1}.csv'.format(sb,key))
-            df=cf.calc_flux_per_basin(BASIN['data_cube']['monthly'][key],
-                                    BASIN['gis_data']['subbasin_mask'][sb],
-                                    output=output)
-            subbasin[key]=df        
+        subbasin=fluxes[sb]
         # read subbasin inflow
         if len(BASIN['params']['dico_in'][sb])==0: #no inflow
             inflow=None 
@@ -439,6 +623,7 @@ def calc_time_series(BASIN):
         BASIN['ts_data']['q_outflow'][sb]=discharge
         BASIN['ts_data']['dS_sw'][sb]=dS_sw    
         inflow = None
+        profiling.advance()
           
     # outflow of basin is outflow of downstream subbasin   
     for sb in BASIN['params']['dico_out']:
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Progress and resource usage of the hydroloop steps
+
+A StepMonitor is active while a step runs. Its units of work are the dask
+tasks the step computes (chunks read, computed and written to NetCDF) plus
+the units that loops outside dask report with expect() and advance(), e.g.
+one per time slice. Besides the progress it records the wall-clock time, the
+bytes read and written by the process and the peak resident memory, sampled
+by a background thread. The records of a run are saved as a JSON run profile
+with write_run_profile.
+"""
+import os
+import json
+import time
+import threading
+from dask.callbacks import Callback
+
+try:
+    import psutil
+except ImportError: #fall back on /proc, Linux only
+    psutil = None
+
+_ACTIVE = []
+
+def io_counters():
+    '''
+    Bytes read and written by the process, (None, None) if unknown
+    '''
+    if psutil is not None:
+        try:
+            io = psutil.Process().io_counters()
+            return (getattr(io, 'read_chars', io.read_bytes),
+                    getattr(io, 'write_chars', io.write_bytes))
+        except (psutil.Error, AttributeError, NotImplementedError):
+            pass
+    try:
+        with open('/proc/self/io') as f:
+            values = dict(line.split(': ') for line in f.read().splitlines())
+        return int(values['rchar']), int(values['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+def rss():
+    '''
+    Resident memory of the process in bytes, None if unknown
+    '''
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+class StepMonitor(Callback):
+    '''
+    Progress and resource usage of one step, use as context manager around
+    the step
+
+    step: str
+        name of the step
+    progress: function, optional
+        called as progress(step, done, total) when units of work are done,
+        at most every `interval` seconds
+    interval: float
+        seconds between progress calls and memory samples
+    '''
+    def __init__(self, step, progress=None, interval=0.1):
+        super().__init__()
+        self.step = step
+        self.progress = progress
+        self.interval = interval
+        self.done = 0
+        self.total = 0
+        self.tasks = 0
+        self.peak_rss = None
+        self.record = {}
+        self._last_report = 0.
+        self._stop = threading.Event()
+
+    def _sample(self):
+        value = rss()
+        if value is not None:
+            self.peak_rss = max(self.peak_rss or 0, value)
+
+    def _sampler(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def _report(self, force=False):
+        now = time.time()
+        if self.progress is not None and \
+                (force or now - self._last_report >= self.interval):
+            self._last_report = now
+            self.progress(self.step, self.done, max(self.total, self.done))
+
+    def expect(self, units):
+        '''
+        Add units of work to the total
+        '''
+        self.total += units
+        self._report()
+
+    def advance(self, units=1):
+        '''
+        Mark units of work as done
+        '''
+        self.done += units
+        self._report()
+
+    # dask callbacks, every task of a computed graph is a unit of work
+    def _start_state(self, dsk, state):
+        self.expect(sum(len(state[key]) for key in
+                        ['ready', 'waiting', 'running', 'finished']))
+
+    def _posttask(self, key, result, dsk, state, worker_id):
+        self.tasks += 1
+        self.advance()
+
+    def __enter__(self):
+        _ACTIVE.append(self)
+        self._start_time = time.time()
+        self._start_io = io_counters()
+        self._start_rss = rss()
+        self._sample()
+        self._thread = threading.Thread(target=self._sampler, daemon=True)
+        self._thread.start()
+        return super().__enter__()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        super().__exit__(exc_type, exc_value, tb)
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+        _ACTIVE.remove(self)
+        end_io = io_counters()
+        self.record = {
+            'step': self.step,
+            'started': time.strftime('%Y-%m-%d %H:%M:%S',
+                                     time.localtime(self._start_time)),
+            'wall_time': time.time() - self._start_time,
+            'status': 'failed' if exc_type is not None else 'completed',
+            'units_done': self.done,
+            'units_total': max(self.total, self.done),
+            'dask_tasks': self.tasks,
+            'read_bytes': None if end_io[0] is None
+                          else end_io[0] - self._start_io[0],
+            'write_bytes': None if end_io[1] is None
+                           else end_io[1] - self._start_io[1],
+            'rss_start': self._start_rss,
+            'rss_end': rss(),
+            'peak_rss': self.peak_rss,
+            }
+        self._report(force=True)
+        return False
+
+def expect(units):
+    '''
+    Add units of work to the active StepMonitor, if any
+    '''
+    if _ACTIVE:
+        _ACTIVE[-1].expect(units)
+
+def advance(units=1):
+    '''
+    Mark units of work of the active StepMonitor as done, if any
+    '''
+    if _ACTIVE:
+        _ACTIVE[-1].advance(units)
+
+def write_run_profile(records, output, **metadata):
+    '''
+    Save the records of the StepMonitors of a run as JSON
+
+    records: list
+        StepMonitor.record of each step
+    output: str
+        path of the JSON file
+    metadata:
+        extra entries of the profile, e.g. the basin name
+    '''
+    profile = dict(metadata)
+    profile['created'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    profile['wall_time'] = sum(record.get('wall_time', 0) for record in records)
+    profile['steps'] = records
+    folder = os.path.dirname(output)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    with open(output, 'w') as f:
+        json.dump(profile, f, indent=2, default=str)
+    return output
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Lookup-table reclassification of land use maps
+
+A {class: [codes]} dictionary and a {class: value} dictionary (as returned by
+get_dictionaries or get_fractions) are compiled into a dense array indexed by
+the LU code, which maps a whole LU map or datacube in a single gather instead
+of one full-grid pass per code. The functions accept NumPy arrays, dask arrays
+and xarray DataArrays (lazy or not).
+"""
+import numpy as np
+import xarray as xr
+
+def compile_lut(lu_categories, values, dtype=None):
+    '''
+    Compile the lookup table of a reclassification
+
+    lu_categories: dict
+        {class: [LU codes]}
+    values: dict
+        {class: value}, classes missing from lu_categories are skipped
+    dtype: numpy dtype, optional
+        dtype of the lookup table, default is the dtype of the values
+
+    return
+    lut: ndarray
+        value of each LU code, indexed by the code
+    known: ndarray (bool)
+        True for the LU codes that are reclassified
+
+    When a code is listed in several classes the last class wins, as with
+    chained .where() calls.
+    '''
+    codes = [int(code) for key in values.keys()
+             for code in lu_categories.get(key, [])]
+    if any(code < 0 for code in codes):
+        raise ValueError('LU codes must be non-negative integers')
+    size = max(codes) + 1 if codes else 1
+    if dtype is None:
+        dtype = np.result_type(*[np.asarray(v) for v in values.values()]) \
+            if values else np.float64
+    lut = np.zeros(size, dtype=dtype)
+    known = np.zeros(size, dtype=bool)
+    for key in values.keys():
+        for code in lu_categories.get(key, []):
+            lut[int(code)] = values[key]
+            known[int(code)] = True
+    return lut, known
+
+def _lut_index(lu, size):
+    '''
+    Index of each pixel in a lookup table of the given size and mask of the
+    pixels holding a valid (integer, in range, not NaN) code
+    '''
+    lu = np.asarray(lu)
+    with np.errstate(invalid='ignore'):
+        valid = (lu >= 0) & (lu < size)
+    idx = np.where(valid, lu, 0).astype(np.intp)
+    if lu.dtype.kind == 'f':
+        valid &= (idx == lu)
+    return idx, valid
+
+def _reclassify_block(lu, lut, known, default):
+    lu = np.asarray(lu)
+    idx, valid = _lut_index(lu, len(lut))
+    hit = valid & known[idx]
+    if default is None: #unlisted codes keep their LU value
+        fallback = lu
+    else: #unlisted codes get default, NaN stays NaN
+        fallback = lu * 0 + default
+    dtype = np.result_type(lut.dtype, fallback.dtype)
+    return np.where(hit, lut[idx], fallback).astype(dtype, copy=False)
+
+def _isin_block(lu, lut):
+    idx, valid = _lut_index(lu, len(lut))
+    return valid & lut[idx]
+
+def _apply(func, lu, dtype, **kwargs):
+    if isinstance(lu, xr.DataArray):
+        return xr.apply_ufunc(func, lu, kwargs=kwargs,
+                              dask='parallelized',
+                              output_dtypes=[dtype])
+    elif hasattr(lu, 'map_blocks'): #dask array
+        return lu.map_blocks(func, dtype=dtype, **kwargs)
+    else:
+        return func(lu, **kwargs)
+
+def reclassify(lu, lu_categories, values, default=None):
+    '''
+    Reclassify a LU map or datacube with a lookup table
+
+    lu: ndarray, dask array or xr.DataArray
+        LU codes
+    lu_categories: dict
+        {class: [LU codes]}
+    values: dict
+        {class: value}
+    default: float, optional
+        value of the pixels whose code is not listed. Default is None, which
+        keeps the LU value (as root_depth and Consumed_fraction do). NaN
+        pixels stay NaN in both cases.
+
+    return
+    same type as lu
+    '''
+    lu_dtype = np.dtype(lu.dtype) if hasattr(lu, 'dtype') \
+        else np.asarray(lu).dtype
+    # values take the precision of float LU maps, as with .where(lu!=code, v)
+    dtype = np.result_type(lu_dtype, *values.values()) \
+        if lu_dtype.kind == 'f' else None
+    lut, known = compile_lut(lu_categories, values, dtype=dtype)
+    out_dtype = np.result_type(lut.dtype, lu_dtype if default is None
+                               else np.result_type(lu_dtype, default))
+    return _apply(_reclassify_block, lu, out_dtype,
+                  lut=lut, known=known, default=default)
+
+def isin(lu, codes):
+    '''
+    Lookup-table equivalent of np.isin(lu, codes) for LU maps
+
+    lu: ndarray, dask array or xr.DataArray
+        LU codes
+    codes: list
+        LU codes to select
+
+    return
+    boolean mask, same type as lu
+    '''
+    lut, _ = compile_lut({'codes': codes}, {'codes': True}, dtype=bool)
+    return _apply(_isin_block, lu, bool, lut=lut)
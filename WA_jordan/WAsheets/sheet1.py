@@ -44,23 +44,20 @@ def main(BASIN,unit_conversion=1000,ET_scale = 1):
     #                             chunksize=BASIN['chunksize'],
     #                             output=output_file.format('basin_et_monthly'),
     #                             quantity='volume')
-    df_ETrain=cf.calc_flux_per_LU_class(BASIN['data_cube']['monthly']['etrain'], 
+    fluxes=cf.calc_fluxes_per_LU_class(
+            {var:BASIN['data_cube']['monthly'][var] 
+             for var in ['etrain','etincr']}, 
                              BASIN['data_cube']['monthly']['lu'], 
                              BASIN['gis_data']['basin_mask'],
                      chunksize=BASIN['chunksize'], #option to process in chunks
-                     output=output_file.format('basin_etrain_monthly'), 
-                     #option to save output as csv                     
-                     lu_dictionary=lu_dictionary, #calc for LU categories
-                     quantity='volume')
-    
-    df_ETincr=cf.calc_flux_per_LU_class(BASIN['data_cube']['monthly']['etincr'], 
-                             BASIN['data_cube']['monthly']['lu'], 
-                             BASIN['gis_data']['basin_mask'],
-                     chunksize=BASIN['chunksize'], #option to process in chunks
-                     output=output_file.format('basin_etincr_monthly'), 
+                     outputs={var:output_file.format(
+                             'basin_{0}_monthly'.format(var))
+                             for var in ['etrain','etincr']}, 
                      #option to save output as csv                     
                      lu_dictionary=lu_dictionary, #calc for LU categories
                      quantity='volume')
+    df_ETrain=fluxes['etrain']
+    df_ETincr=fluxes['etincr']
     
     #calc_non_utilizable
     df_non_util_ro = cf.calc_non_utilizable(BASIN['data_cube']['monthly']['p'],
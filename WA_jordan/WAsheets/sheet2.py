@@ -28,32 +28,17 @@ def main(BASIN,unit_conversion=1000):
     output_file=os.path.join(folder,'sheet2_{0}.csv')
     
     #Calulate yearly data to fill in Sheet 2    
-    ET=cf.calc_flux_per_LU_class(BASIN['data_cube']['monthly']['et'], 
+    variables=['et','e','t','i']
+    fluxes=cf.calc_fluxes_per_LU_class(
+            {var:BASIN['data_cube']['monthly'][var] for var in variables}, 
                          BASIN['data_cube']['monthly']['lu'], 
                          BASIN['gis_data']['basin_mask'],
                  chunksize=BASIN['chunksize'], #option to process in chunks
-                 output=output_file.format('lu_et_monthly'), 
+                 outputs={var:output_file.format('lu_{0}_monthly'.format(var))
+                          for var in variables}, 
                  #option to save output as csv                  
                  quantity='volume')
-    E=cf.calc_flux_per_LU_class(BASIN['data_cube']['monthly']['e'], 
-                         BASIN['data_cube']['monthly']['lu'], 
-                         BASIN['gis_data']['basin_mask'],
-                 chunksize=BASIN['chunksize'], #option to process in chunks
-                 output=output_file.format('lu_e_monthly'), 
-                 #option to save output as csv                     
-                 quantity='volume')
-    T=cf.calc_flux_per_LU_class(BASIN['data_cube']['monthly']['t'], 
-                         BASIN['data_cube']['monthly']['lu'], 
-                         BASIN['gis_data']['basin_mask'],
-                 chunksize=BASIN['chunksize'],
-                 output=output_file.format('lu_t_monthly'),                               
-                 quantity='volume')
-    I=cf.calc_flux_per_LU_class(BASIN['data_cube']['monthly']['i'], 
-                         BASIN['data_cube']['monthly']['lu'], 
-                         BASIN['gis_data']['basin_mask'],
-                 chunksize=BASIN['chunksize'],
-                 output=output_file.format('lu_i_monthly'),               
-                 quantity='volume') 
+    ET,E,T,I=[fluxes[var] for var in variables]
     sheet_folder=os.path.join(BASIN['output_folder'],'csv','sheet2') 
     if not os.path.exists(sheet_folder):
         os.makedirs(sheet_folder) #create sheet1 folder 
@@ -35,27 +35,36 @@ def main(BASIN,unit_conversion=1):
     lu_dict=gd.get_sheet1_classes()  
     
     ### Calulate monthly data to fill in Sheet 5  
-    data={'basin':dict()}
-    # Full basin
-    for variable in ['sro','bf','supply_sw']:
-        df=cf.calc_flux_per_LU_class(
-                 BASIN['data_cube']['monthly'][variable], 
-                 BASIN['data_cube']['monthly']['lu'], 
-                 BASIN['gis_data']['basin_mask'],
-#                 chunksize=BASIN['chunksize'], 
-                 output=output_file.format('{0}_{1}'.format('basin',variable)), 
-                 lu_dictionary=lu_dict, #calc for LU categories
-                 quantity='volume')
-        data['basin'][variable]=df/unit_conversion
-                
-    for variable in ['return_sw','return_sw_from_gw','return_sw_from_sw']:        
-        df=cf.calc_flux_per_basin(
-                 BASIN['data_cube']['monthly'][variable], 
-                 BASIN['gis_data']['basin_mask'],
-#                 chunksize=BASIN['chunksize'], 
-                 output=output_file.format('{0}_{1}'.format('basin',variable)),
-                 quantity='volume')
-        data['basin'][variable]=df/unit_conversion
+    # Full basin and sub basins in one pass over each datacube
+    masks={'basin':BASIN['gis_data']['basin_mask']}
+    masks.update(BASIN['gis_data']['subbasin_mask'])
+    fluxes=cf.calc_fluxes_per_subbasin(
+             {variable:BASIN['data_cube']['monthly'][variable] 
+              for variable in ['sro','bf','supply_sw']}, 
+             masks,
+             lu_nc=BASIN['data_cube']['monthly']['lu'], 
+#             chunksize=BASIN['chunksize'], 
+             lu_dictionary=lu_dict, #calc for LU categories
+             quantity='volume')
+    returns=cf.calc_fluxes_per_subbasin(
+             {variable:BASIN['data_cube']['monthly'][variable] 
+              for variable in ['return_sw','return_sw_from_gw',
+                               'return_sw_from_sw']}, 
+             masks,
+#             chunksize=BASIN['chunksize'], 
+             quantity='volume')
+    data=dict()
+    for sb in masks:
+        data[sb]=dict()
+        fluxes[sb].update(returns[sb])
+        for variable,df in fluxes[sb].items():
+            if sb=='basin':
+                output=output_file.format('{0}_{1}'.format('basin',variable))
+            else:
+                output=output_file.format('subbasin_{0}_{1}'.format(sb,variable))
+            df.to_csv(output,sep=';')
+            print('Save flux as {0}'.format(output))
+            data[sb][variable]=df/unit_conversion
 
     #connection between subbasin
     sb_codes=BASIN['gis_data']['subbasin_mask'].keys()
@@ -67,25 +76,6 @@ def main(BASIN,unit_conversion=1):
     basin_inflows=basin_total_outflow*0
     #Sub basins
     for sb in sb_codes:
-        data[sb]=dict()
-        for variable in ['sro','bf','supply_sw']:
-            df=cf.calc_flux_per_LU_class(
-                     BASIN['data_cube']['monthly'][variable], 
-                     BASIN['data_cube']['monthly']['lu'], 
-                     BASIN['gis_data']['subbasin_mask'][sb],
-#                     chunksize=BASIN['chunksize'], 
-                     output=output_file.format('subbasin_{0}_{1}'.format(sb,variable)), 
-                     lu_dictionary=lu_dict, #calc for LU categories
-                     quantity='volume')
-            data[sb][variable]=df/unit_conversion
-        for variable in ['return_sw','return_sw_from_gw','return_sw_from_sw']:        
-            df=cf.calc_flux_per_basin(
-                     BASIN['data_cube']['monthly'][variable], 
-                     BASIN['gis_data']['subbasin_mask'][sb],
-#                     chunksize=BASIN['chunksize'], 
-                     output=output_file.format('subbasin_{0}_{1}'.format(sb,variable)),
-                     quantity='volume')
-            data[sb][variable]=df/unit_conversion
         ##read timeseries
         #inflow
         if len(dico_in[sb])==0: #no inflow
@@ -24,6 +24,10 @@ import gzip
 import shutil
 import zipfile
 import calendar
+import uuid
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from dateutil.relativedelta import relativedelta
 from tqdm import tqdm
 #from find_possible_dates import find_possible_dates
@@ -82,70 +86,137 @@ def unzip(path):
     temp_file = zip_ref.extract(tif_files[0], path = folder)
     return temp_file
 
-def fill_data_to_nc(nc_file, overview, optionsProj, optionsClip, shape):
+def warp_in_memory(path, optionsProj, optionsClip):
+    """
+    Reproject and clip a raster to the grid of the nc-file. Both warps go
+    to /vsimem, so no temporary tif-files are written to disk. Returns the
+    array and the metadata of the clipped raster.
+    """
+    tag = uuid.uuid4().hex
+    temp_fileP = '/vsimem/{0}_proj.tif'.format(tag)
+    temp_file = '/vsimem/{0}_clip.tif'.format(tag)
+    try:
+        projds = gdal.Warp(temp_fileP, path, options = optionsProj)
+        projds = None
+        sourceds = gdal.Warp(temp_file, temp_fileP, options = optionsClip)
+        data = sourceds.ReadAsArray()
+        metadata = sourceds.GetMetadata() or dict()
+        sourceds = None
+    finally:
+        for fn in [temp_fileP, temp_file]:
+            if gdal.VSIStatL(fn) is not None:
+                gdal.Unlink(fn)
+    return data, metadata
+
+def read_timestep(fhs, optionsProj, optionsClip):
+    """
+    Read the data of one date, fhs is the list of (name, path or value)
+    of the date in the overview. Returns a {name: data} dictionary.
+    """
+    var = dict()
+    for fh in [x for x in fhs if x is not None]:
+        # Reproject and open tif-file for a specific date.
+        if isinstance(fh[1], str):
+            ext = fh[1].split('.')[-1].split(":")[0]
+            
+            if ext == 'gz':
+                path = ungz(fh[1])
+            elif ext == 'zip':
+                path = unzip(fh[1])
+            else:
+                path = fh[1]
+                
+            assert "GDAL_DATA" in os.environ
+            
+            path = check_projection(path)
+            data, metadata = warp_in_memory(path, optionsProj, optionsClip)
+            var[fh[0]] = data.astype(np.float32)
+            
+            if ext == 'nc':
+                var_name = fh[0]
+                scale = metadata.get("{0}#scale_factor".format(var_name))
+                offset = metadata.get("{0}#add_offset".format(var_name))
+                if scale is not None and offset is not None:
+                    var[fh[0]][var[fh[0]] != -9999] *= float(scale)
+                    var[fh[0]][var[fh[0]] != -9999] += float(offset)
+
+            if ext in ['gz', 'zip']:
+                os.remove(path)
+
+        # Open non-spatial data for a specific date.
+        elif isinstance(fh[1], float):
+            var[fh[0]] = fh[1]
+        else:
+            continue
+    return var
+
+# warp options of the worker processes, set by _init_worker
+_WORKER_OPTIONS = None
 
+def _init_worker(example, shape):
+    global _WORKER_OPTIONS
+    # WarpOptions can not be pickled, each worker builds its own
+    _, _, optionsProj, optionsClip = get_lats_lons(example, shape)
+    _WORKER_OPTIONS = (optionsProj, optionsClip)
+
+def _read_timestep_worker(fhs):
+    return read_timestep(fhs, *_WORKER_OPTIONS)
+
+def fill_data_to_nc(nc_file, overview, optionsProj, optionsClip, shape,
+                    example = None, n_workers = 1, batch_size = 12,
+                    progress_callback = None):
+    """
+    Warp the data of all dates in the overview and write it to nc_file.
+    
+    With n_workers > 1 the dates are read by a pool of worker processes
+    (example is then needed to set up the warp options in the workers).
+    The main process is the only writer and appends the dates in order, in
+    batches of batch_size time steps, to the nc-file that stays open.
+    """
     # Save the time-invariant data to nc-file.
     if "invariant" in overview.keys():
         invar = overview.pop("invariant")
         var = dict()
         for fh in [x for x in invar if x is not None]:
-            temp_file = tempfile.NamedTemporaryFile(suffix='.tif').name
-            temp_fileP = tempfile.NamedTemporaryFile(suffix='.tif').name
-#            sourceds = gdal.Warp(temp_file, fh[1], options = options)
-            gdal.Warp(temp_fileP, fh[1], options = optionsProj)
-            sourceds = gdal.Warp(temp_file, temp_fileP, options = optionsClip)
-            var[fh[0]] = sourceds.ReadAsArray()
-            sourceds = None
-            os.remove(temp_file)
-            os.remove(temp_fileP)
+            var[fh[0]], _ = warp_in_memory(fh[1], optionsProj, optionsClip)
         fill_nc_one_timestep(nc_file, var, shape)
     
     # Save time-variant data to nc-file.
-    for date in tqdm(sorted(overview.keys())):
-        var = dict()
-        for fh in [x for x in overview[date] if x is not None]:
-            # Reproject and open tif-file for a specific date.
-            if isinstance(fh[1], str):
-                ext = fh[1].split('.')[-1].split(":")[0]
-                
-                if ext == 'gz':
-                    path = ungz(fh[1])
-                elif ext == 'zip':
-                    path = unzip(fh[1])
-                else:
-                    path = fh[1]
-                    
-                assert "GDAL_DATA" in os.environ
-                
-                path = check_projection(path)
-                temp_file = tempfile.NamedTemporaryFile(suffix='.tif').name
-                temp_fileP = tempfile.NamedTemporaryFile(suffix='.tif').name       
-                
-                gdal.Warp(temp_fileP, path, options = optionsProj)
-                sourceds = gdal.Warp(temp_file, temp_fileP, options = optionsClip)
-                var[fh[0]] = sourceds.ReadAsArray().astype(np.float32)
-                
-                if ext == 'nc':
-                    var_name = fh[0]
-                    scale = sourceds.GetMetadataItem("{0}#scale_factor".format(var_name))
-                    offset = sourceds.GetMetadataItem("{0}#add_offset".format(var_name))
-                    if scale is not None and offset is not None:
-                        var[fh[0]][var[fh[0]] != -9999] *= float(scale)
-                        var[fh[0]][var[fh[0]] != -9999] += float(offset)
-
-                sourceds = None
-                os.remove(temp_file)
-                os.remove(temp_fileP)
-                if ext in ['gz', 'zip']:
-                    os.remove(path)
-
-            # Open non-spatial data for a specific date.
-            elif isinstance(fh[1], float):
-                var[fh[0]] = fh[1]
-            else:
-                continue
-        #fill_nc_one_timestep(nc_file, var, shape, date.toordinal())
-        fill_nc_one_timestep(nc_file, var, shape, np.datetime64(date))
+    dates = sorted(overview.keys())
+    n_workers = max(1, min(n_workers or 1, len(dates)))
+    out_nc = netCDF4.Dataset(nc_file, 'r+')
+    batch_dates, batch_vars = [], []
+    
+    def write(date, var, i):
+        batch_dates.append(np.datetime64(date))
+        batch_vars.append(var)
+        if len(batch_dates) >= batch_size or i == len(dates):
+            fill_nc_timesteps(out_nc, batch_dates, batch_vars)
+            del batch_dates[:], batch_vars[:]
+        if progress_callback is not None:
+            progress_callback(i, len(dates), "processed {0}/{1} dates".format(i, len(dates)))
+    
+    try:
+        if n_workers == 1:
+            for i, date in enumerate(tqdm(dates)):
+                write(date, read_timestep(overview[date], optionsProj, optionsClip), i + 1)
+        else:
+            ctx = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers = n_workers, mp_context = ctx,
+                                     initializer = _init_worker,
+                                     initargs = (example, shape)) as executor:
+                todo = iter(dates)
+                pending = deque()
+                # at most two dates per worker in flight, written in order
+                for date in itertools.islice(todo, 2 * n_workers):
+                    pending.append((date, executor.submit(_read_timestep_worker, overview[date])))
+                for i in tqdm(range(1, len(dates) + 1)):
+                    date, fut = pending.popleft()
+                    write(date, fut.result(), i)
+                    for nxt in itertools.islice(todo, 1):
+                        pending.append((nxt, executor.submit(_read_timestep_worker, overview[nxt])))
+    finally:
+        out_nc.close()
         
     return True
         
@@ -313,26 +384,39 @@ def get_lats_lons(example, shape):
     
     return lats, lons, optionsProj, optionsClip
 
+def fill_nc_timesteps(out_nc, times, variables):
+    """
+    Append time steps to an open nc-file. variables holds one {name: data}
+    dictionary per time step, variables missing from a time step are filled
+    with their _FillValue.
+    """
+    varis = out_nc.variables.keys()
+    dimis = out_nc.dimensions.keys()
+    
+    time = out_nc.variables['time']
+    t0 = time.shape[0]
+    t1 = t0 + len(times)
+    time[t0:t1] = np.array(times).astype(time.dtype)
+    
+    for name in [x for x in varis if "time" in out_nc[x].dimensions and x not in dimis]:
+        field = out_nc.variables[name]
+        shape = tuple([y for x, y in enumerate(field.shape) if field.dimensions[x] != "time"])
+        # keep the precision of the data, as when writing one step at a time
+        dtypes = [np.asarray(var[name]).dtype for var in variables if name in var.keys()]
+        dtype = np.result_type(*dtypes) if dtypes else np.float64
+        data = np.ones((len(times),) + shape, dtype = dtype) * field._FillValue
+        for i, var in enumerate(variables):
+            if name in var.keys():
+                data[i] = var[name]
+        field[t0:t1,...] = data
+
 def fill_nc_one_timestep(nc_file, var, shape, time_val = None):
     # Open existing nc-file.
     out_nc = netCDF4.Dataset(nc_file, 'r+')
-    varis = out_nc.variables.keys()
-    dimis = out_nc.dimensions.keys()
     
     # Add time-dependent data to nc-file.
     if time_val is not None:
-        time = out_nc.variables['time']
-        tidx = time.shape
-        time[tidx] = time_val
-        
-        for name in [x for x in varis if "time" in out_nc[x].dimensions and x not in dimis]:
-            field = out_nc.variables[name]
-            if name in var.keys():
-                field[tidx,...] = var[name]
-            else:
-                shape = tuple([y for x, y in enumerate(out_nc[name].shape) if out_nc[name].dimensions[x] != "time"])
-                dummy_data = np.ones(shape) * out_nc[name]._FillValue
-                field[tidx,...] = dummy_data
+        fill_nc_timesteps(out_nc, [time_val], [var])
     
     # Add invariant data to nc-file.
     else:
@@ -342,9 +426,70 @@ def fill_nc_one_timestep(nc_file, var, shape, time_val = None):
     # Close nc-file.
     out_nc.close()
 
-def make_netcdf(nc_file, dataset, shape, example, name, start=None, end=None):
+def nc_dates(nc_file):
+    """
+    Dates already on the time axis of an existing nc-file.
+    """
+    with netCDF4.Dataset(nc_file, 'r') as out_nc:
+        time = out_nc.variables['time']
+        if time.shape[0] == 0:
+            return []
+        dates = netCDF4.num2date(time[:], time.units,
+                                 calendar = getattr(time, 'calendar', 'standard'),
+                                 only_use_cftime_datetimes = False,
+                                 only_use_python_datetimes = True)
+    return [datetime.date(x.year, x.month, x.day) for x in dates]
+
+def check_nc(nc_file, dim, var, attr = None):
+    """
+    Check that an existing nc-file has the grid of dim and the variables
+    and attributes of var (as init_nc would create them), so that new time
+    steps can be appended to it. Raises a ValueError when they differ.
+    """
+    with netCDF4.Dataset(nc_file, 'r') as out_nc:
+        for name, values in dim.items():
+            if name not in out_nc.dimensions:
+                raise ValueError("{0} has no dimension {1}".format(nc_file, name))
+            if values is None:
+                if not out_nc.dimensions[name].isunlimited():
+                    raise ValueError("{0}: dimension {1} is not unlimited".format(nc_file, name))
+            elif out_nc.variables[name].shape != values.shape or \
+                    not np.allclose(out_nc.variables[name][:], values.astype('f4')):
+                raise ValueError("{0}: {1} does not match the grid of the template".format(nc_file, name))
+        for name, props in var.items():
+            quantity = props[2]['quantity']
+            if quantity not in out_nc.variables:
+                raise ValueError("{0} has no variable {1}".format(nc_file, quantity))
+            field = out_nc.variables[quantity]
+            if tuple(field.dimensions) != tuple(np.atleast_1d(props[1])):
+                raise ValueError("{0}: dimensions of {1} differ".format(nc_file, quantity))
+            attrs = {k: field.getncattr(k) for k in props[2].keys() if k in field.ncattrs()}
+            if attrs != props[2]:
+                raise ValueError("{0}: attributes of {1} differ ({2} != {3})".format(
+                    nc_file, quantity, attrs, props[2]))
+        if attr is not None:
+            for k, v in attr.items():
+                if k in out_nc.ncattrs() and out_nc.getncattr(k) != v:
+                    raise ValueError("{0}: attribute {1} differs".format(nc_file, k))
+
+def make_netcdf(nc_file, dataset, shape, example, name, start=None, end=None,
+                n_workers=1, batch_size=12, progress_callback=None,
+                append=False):
+    """
+    Create nc_file from the tif-files of dataset, warped to the grid of
+    example and clipped to shape. n_workers processes read and warp the
+    dates in parallel (None for all cores), batch_size time steps are
+    written to the nc-file at once.
+    
+    With append an existing nc_file is kept: after checking that its grid
+    and variables match, only the dates that are not in the file yet are
+    warped and appended. New dates must come after the last date in the
+    file.
+    """
     
     print (f" \n writing {nc_file}")
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
     
     # Give necessary dimensions in nc-file.
     dims = {'time':  None, 'latitude': None, 'longitude': None}
@@ -386,10 +531,26 @@ def make_netcdf(nc_file, dataset, shape, example, name, start=None, end=None):
 #               }
 
     dims['latitude'], dims['longitude'], optionsProj, optionsClip = get_lats_lons(example, shape)
-    init_nc(nc_file, dims, dataset, attr = {"basin_name" : name})
-
     overview = make_overview(dataset, start, end)
-    succes = fill_data_to_nc(nc_file, overview, optionsProj, optionsClip, shape)
+    if append and os.path.isfile(nc_file):
+        check_nc(nc_file, dims, dataset, attr = {"basin_name" : name})
+        existing = nc_dates(nc_file)
+        overview.pop("invariant", None)
+        for date in existing:
+            overview.pop(date, None)
+        if existing and overview and min(overview.keys()) <= max(existing):
+            raise ValueError("{0}: can not insert dates before {1}, the last date in the file".format(
+                nc_file, max(existing)))
+        print("appending {0} new dates to {1} existing dates".format(len(overview), len(existing)))
+        if len(overview) == 0:
+            return True
+    else:
+        init_nc(nc_file, dims, dataset, attr = {"basin_name" : name})
+
+    succes = fill_data_to_nc(nc_file, overview, optionsProj, optionsClip, shape,
+                             example = example, n_workers = n_workers,
+                             batch_size = batch_size,
+                             progress_callback = progress_callback)
     return succes
 
 ##%% Example
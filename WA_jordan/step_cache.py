@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+"""
+Result cache for the preprocessing, SMBalance and Hydroloop steps
+
+A step is identified by a key hashed from the step name, the compiled code of
+the step and of the project modules it uses, its parameters and the
+fingerprints of its input files (path, size and modification time, or the
+file contents with hash_contents=True). The output files of a step are
+copied into the cache together with a manifest.json of the inputs, parameters and outputs they come
+from. When a step is run again with the same key its outputs are restored from
+the cache instead of being recomputed, also when another step has overwritten
+them in the meantime (several hydroloop functions save to fixed file names).
+The disk space owned by the cache is bounded, least recently used entries are
+removed first.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import marshal
+import hashlib
+import inspect
+
+# Bump to invalidate all existing cache entries
+CACHE_VERSION = 2
+
+# Top-level modules whose code is part of the cache key of a step
+PROJECT_MODULES = ('WA_jordan', 'WA', 'WAsheets', 'WA_Hyperloop',
+                   'watertools_iwmi', 'createNC_cmi', 'pre_proc_sm_balance',
+                   'SMBalance')
+
+# Default bound of the disk space owned by the cache, in bytes
+MAX_SIZE = 20 * 1024**3
+
+_module_hashes = {}
+
+def file_fingerprint(path, hash_contents=False):
+    '''
+    Fingerprint of a file: absolute path, size and modification time, or
+    sha256 of the contents and size if hash_contents
+    '''
+    st = os.stat(path)
+    if hash_contents:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        return {'size': st.st_size, 'sha256': sha.hexdigest()}
+    return {'path': os.path.abspath(path), 'size': st.st_size,
+            'mtime_ns': st.st_mtime_ns}
+
+def _same_state(fingerprint, other):
+    '''
+    True if two file fingerprints describe the same contents, wherever the
+    files are
+    '''
+    ignore = ('path',)
+    return {k: v for k, v in fingerprint.items() if k not in ignore} == \
+        {k: v for k, v in other.items() if k not in ignore}
+
+def _copy(source, target):
+    '''
+    Copy source to target through a temporary file, so that a file at target
+    is replaced and not rewritten in place
+    '''
+    tmp = target + '.tmp'
+    shutil.copy2(source, tmp)
+    os.replace(tmp, target)
+
+def _module_hash(module):
+    '''
+    sha256 of the compiled code of a module, also available in the frozen
+    application where there is no source
+    '''
+    name = module.__name__
+    if name not in _module_hashes:
+        try:
+            code = marshal.dumps(module.__spec__.loader.get_code(name))
+        except Exception:
+            try:
+                code = inspect.getsource(module).encode()
+            except (OSError, TypeError):
+                code = repr(getattr(module, '__version__', None)).encode()
+        _module_hashes[name] = hashlib.sha256(code).hexdigest()
+    return _module_hashes[name]
+
+def _project_module(value):
+    if inspect.ismodule(value):
+        module = value
+    elif inspect.isfunction(value) or inspect.isclass(value):
+        module = sys.modules.get(getattr(value, '__module__', None))
+    else:
+        return None
+    if module is None or \
+            module.__name__.split('.')[0] not in PROJECT_MODULES:
+        return None
+    return module
+
+def code_hash(func):
+    '''
+    Hash of the code of the module of func and of all project modules it
+    uses, directly or through other project modules
+    '''
+    module = inspect.getmodule(func)
+    if module is None:
+        return hashlib.sha256(getattr(func, '__qualname__',
+                                      repr(func)).encode()).hexdigest()
+    modules = {}
+    stack = [module]
+    while stack:
+        module = stack.pop()
+        if module.__name__ in modules:
+            continue
+        modules[module.__name__] = _module_hash(module)
+        for value in list(vars(module).values()):
+            dependency = _project_module(value)
+            if dependency is not None and dependency.__name__ not in modules:
+                stack.append(dependency)
+    text = json.dumps(modules, sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def _is_file(value):
+    return isinstance(value, str) and os.path.isfile(value)
+
+def _output_files(result):
+    '''
+    Paths of the existing files in a step result (str, list, tuple or dict)
+    '''
+    if isinstance(result, dict):
+        values = result.values()
+    elif isinstance(result, (list, tuple)):
+        values = result
+    else:
+        values = [result]
+    return [v for v in values if _is_file(v)]
+
+def _get_entry(BASIN, keys):
+    value = BASIN
+    for key in keys:
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+def _set_entry(BASIN, keys, value):
+    for key in keys[:-1]:
+        BASIN = BASIN.setdefault(key, {})
+    BASIN[keys[-1]] = value
+
+def _flatten(dictionary, prefix=()):
+    items = {}
+    for key, value in dictionary.items():
+        if isinstance(value, dict):
+            items.update(_flatten(value, prefix + (key,)))
+        else:
+            items[prefix + (key,)] = value
+    return items
+
+class StepCache:
+    '''
+    Content-addressed cache of step outputs
+
+    cache_dir: str
+        folder of the cache, one subfolder per step and key
+    hash_contents: bool
+        hash the contents of the input files instead of using their size and
+        modification time. Slower, but survives copying or touching the inputs
+    max_size: int or None
+        bound in bytes of the disk space used by the cache. The least
+        recently used entries are removed when it is exceeded. None for no
+        bound
+    '''
+    def __init__(self, cache_dir, hash_contents=False, max_size=MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.hash_contents = hash_contents
+        self.max_size = max_size
+
+    def fingerprint(self, value):
+        '''
+        Fingerprint of an input: the file fingerprint for paths to existing
+        files, the value itself otherwise
+        '''
+        if _is_file(value):
+            return file_fingerprint(value, self.hash_contents)
+        return value
+
+    def key(self, step, func, inputs, params=None):
+        '''
+        Cache key of a step from the code of func and the project modules it
+        uses, the inputs {name: path or value} and the parameters
+        {name: value}
+        '''
+        description = {
+            'version': CACHE_VERSION,
+            'step': step,
+            'code': code_hash(func),
+            'inputs': {str(k): self.fingerprint(v) for k, v in inputs.items()},
+            'params': params or {},
+            }
+        text = json.dumps(description, sort_keys=True, default=str)
+        return hashlib.sha256(text.encode()).hexdigest()[:32]
+
+    def entry_dir(self, step, key):
+        return os.path.join(self.cache_dir, step, key)
+
+    def load(self, step, key):
+        '''
+        Manifest of a cached step, None if the step is not cached or one of
+        its cached files has been changed since
+        '''
+        entry = self.entry_dir(step, key)
+        manifest_file = os.path.join(entry, 'manifest.json')
+        if not os.path.isfile(manifest_file):
+            return None
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        for output in manifest['outputs'].values():
+            cached = os.path.join(entry, output['file'])
+            if not os.path.isfile(cached) or \
+                    not _same_state(self.fingerprint(cached),
+                                    output['fingerprint']):
+                shutil.rmtree(entry, ignore_errors=True)
+                return None
+        # the modification time of the manifest orders the entries for eviction
+        os.utime(manifest_file)
+        return manifest
+
+    def restore(self, step, key, manifest):
+        '''
+        Copy the cached outputs back to their original paths, unless the file
+        there is still the one the step produced
+        '''
+        for output in manifest['outputs'].values():
+            path = output['path']
+            cached = os.path.join(self.entry_dir(step, key), output['file'])
+            if os.path.isfile(path) and \
+                    self.fingerprint(path) == output['fingerprint']:
+                continue
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            _copy(cached, path)
+            print('Restored {0} from cache'.format(path))
+
+    def store(self, step, key, inputs, params, outputs, result=None,
+              duration=None, aliases=None):
+        '''
+        Copy the output files {name: path} of a step into the cache with
+        the manifest of the inputs and parameters they come from. aliases
+        {name: path} are outputs that refer to files the step did not write,
+        only their paths are stored
+        '''
+        entry = self.entry_dir(step, key)
+        tmp = entry + '.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        manifest = {
+            'step': step,
+            'key': key,
+            'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'duration': duration,
+            'params': params or {},
+            'inputs': {str(k): {'value': v, 'fingerprint': self.fingerprint(v)}
+                       for k, v in inputs.items()},
+            'outputs': {},
+            'aliases': {str(k): os.path.abspath(v)
+                        for k, v in (aliases or {}).items()},
+            'result': result,
+            }
+        for i, (name, path) in enumerate(outputs.items()):
+            fname = '{0}_{1}'.format(i, os.path.basename(path))
+            shutil.copy2(path, os.path.join(tmp, fname))
+            manifest['outputs'][str(name)] = {
+                'path': os.path.abspath(path), 'file': fname,
+                'fingerprint': self.fingerprint(path)}
+        with open(os.path.join(tmp, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2, default=str)
+        shutil.rmtree(entry, ignore_errors=True)
+        os.replace(tmp, entry)
+        self.evict(keep=entry)
+        return manifest
+
+    def entries(self):
+        '''
+        Cache entries as (last used, bytes, folder), least recently used
+        first
+        '''
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for step in os.listdir(self.cache_dir):
+            step_dir = os.path.join(self.cache_dir, step)
+            if not os.path.isdir(step_dir):
+                continue
+            for key in os.listdir(step_dir):
+                entry = os.path.join(step_dir, key)
+                manifest_file = os.path.join(entry, 'manifest.json')
+                if not os.path.isfile(manifest_file):
+                    continue
+                size = sum(os.path.getsize(os.path.join(entry, fname))
+                           for fname in os.listdir(entry))
+                entries.append((os.stat(manifest_file).st_mtime, size, entry))
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        '''
+        Remove the least recently used entries until the cache owns at most
+        max_size bytes, never the entry keep
+        '''
+        if self.max_size is None:
+            return
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total <= self.max_size:
+                break
+            if entry == keep:
+                continue
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            print('Removed {0} from cache'.format(entry))
+
+    def call(self, step, func, inputs, params=None, args=(), kwargs=None):
+        '''
+        Run func(*args, **kwargs) unless a step with the same key is cached
+
+        inputs: dict
+            {name: path} input files of the step (used for the key only)
+        params: dict
+            parameters of the step that change the results (key only)
+
+        return
+        result of func, output files are the files in the result that are
+        not inputs
+        '''
+        kwargs = kwargs or {}
+        key = self.key(step, func, inputs, params)
+        manifest = self.load(step, key)
+        if manifest is not None:
+            print('{0}: using cached results {1}'.format(step, key))
+            self.restore(step, key, manifest)
+            return manifest['result']
+        start = time.time()
+        result = func(*args, **kwargs)
+        input_files = set(os.path.abspath(v) for v in inputs.values()
+                          if _is_file(v))
+        outputs = {i: path for i, path in enumerate(_output_files(result))
+                   if os.path.abspath(path) not in input_files}
+        self.store(step, key, inputs, params, outputs, result=result,
+                   duration=time.time() - start)
+        return result
+
+    def run_basin_step(self, func, BASIN, inputs, params=None):
+        '''
+        Run a hydroloop step func(BASIN) unless it is cached
+
+        inputs: list
+            BASIN entries read by the step, as tuples of keys, e.g.
+            ('data_cube', 'monthly', 'lu') or ('params', 'wcpc')
+
+        The outputs are the BASIN['data_cube'] entries that the step sets or
+        whose file it rewrites. On a cache hit they are restored and set in
+        BASIN.
+        '''
+        step = func.__name__
+        values = {'/'.join(map(str, keys)): _get_entry(BASIN, keys)
+                  for keys in inputs}
+        key = self.key(step, func, values, params)
+        manifest = self.load(step, key)
+        if manifest is not None:
+            print('{0}: using cached results {1}'.format(step, key))
+            self.restore(step, key, manifest)
+            for name, output in manifest['outputs'].items():
+                _set_entry(BASIN, tuple(name.split('/')), output['path'])
+            for name, path in manifest.get('aliases', {}).items():
+                _set_entry(BASIN, tuple(name.split('/')), path)
+            return BASIN
+        before = {keys: (value, self.fingerprint(value))
+                  for keys, value in _flatten(BASIN['data_cube']).items()}
+        start = time.time()
+        BASIN = func(BASIN)
+        # files that existed unchanged before the step, e.g. inputs that the
+        # step sets under another name, are not copies the step made
+        existing = {os.path.abspath(value): fingerprint
+                    for value, fingerprint in before.values()
+                    if isinstance(fingerprint, dict)}
+        outputs = {}
+        aliases = {}
+        for keys, value in _flatten(BASIN['data_cube']).items():
+            if not _is_file(value):
+                continue
+            fingerprint = self.fingerprint(value)
+            if before.get(keys) == (value, fingerprint):
+                continue
+            name = '/'.join(('data_cube',) + keys)
+            if existing.get(os.path.abspath(value)) == fingerprint:
+                aliases[name] = value
+            else:
+                outputs[name] = value
+        self.store(step, key, values, params, outputs,
+                   duration=time.time() - start, aliases=aliases)
+        return BASIN
@@ -0,0 +1,25 @@
+import numpy as np
+
+import WA_Hyperloop.flow_routing as fr
+
+
+def test_flat_zero_plateau_drains_to_edge():
+    dem = np.zeros((7, 9))
+
+    filled = fr.fill_depressions(dem)
+    receivers = fr.flow_directions(filled, xres=250., yres=250.)
+
+    interior = np.zeros(dem.shape, dtype=bool)
+    interior[1:-1, 1:-1] = True
+    assert np.all(receivers.reshape(dem.shape)[interior] >= 0)
+
+    accumulation = fr.flow_accumulation(receivers, dem.shape)
+    assert accumulation[~interior].sum() == dem.size
+
+
+def test_upstream_of_flat_zero_plateau():
+    dem = np.zeros((7, 9))
+    targets = np.zeros(dem.shape, dtype=bool)
+    targets[0, :] = targets[-1, :] = targets[:, 0] = targets[:, -1] = True
+
+    assert fr.upstream_of(dem, targets, xres=250., yres=250.).all()
@@ -0,0 +1,70 @@
+import os
+import importlib.util
+
+import numpy as np
+import pytest
+
+scipy_interpolate = pytest.importorskip('scipy.interpolate')
+
+
+def _load_raster_conversions():
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        'watertools_iwmi', 'General', 'raster_conversions.py')
+    spec = importlib.util.spec_from_file_location('raster_conversions', path)
+    module = importlib.util.module_from_spec(spec)
+    try:
+        spec.loader.exec_module(module)
+    except ImportError as error:
+        pytest.skip('raster_conversions dependencies missing: {0}'.format(error),
+                    allow_module_level=True)
+    return module
+
+RC = _load_raster_conversions()
+
+
+def nearest_reference(data, mask):
+    # the NearestNDInterpolator evaluation gap_filling used before
+    xx, yy = np.meshgrid(np.arange(data.shape[1]), np.arange(data.shape[0]))
+    xym = np.vstack((np.ravel(xx[mask]), np.ravel(yy[mask]))).T
+    interp0 = scipy_interpolate.NearestNDInterpolator(xym, np.ravel(data[mask]))
+    expected = np.array(data, dtype=np.float64)
+    expected[~mask] = interp0(xx[~mask], yy[~mask])
+    return expected
+
+
+def check(data, mask, radius=16):
+    np.testing.assert_array_equal(RC.gap_filling_nearest(data, mask, radius=radius),
+                                  nearest_reference(data, mask))
+
+
+@pytest.mark.parametrize('dtype', [np.int16, np.float32, np.float64])
+def test_random_maps(dtype):
+    rng = np.random.default_rng(42)
+    for _ in range(10):
+        shape = tuple(rng.integers(5, 60, size=2))
+        # few distinct values, so equidistant valid pixels often differ
+        data = rng.integers(0, 4, size=shape).astype(dtype)
+        mask = rng.random(shape) > rng.uniform(0.3, 0.95)
+        mask[0, 0] = True
+        y, x = rng.integers(0, shape[0]), rng.integers(0, shape[1])
+        mask[y:y + 20, x:x + 20] = False
+        mask[0, 0] = True
+        check(data, mask)
+
+
+def test_equal_distance_ties():
+    data = np.zeros((5, 9))
+    mask = np.zeros(data.shape, dtype=bool)
+    data[2, 0], data[2, 8] = 1., 2.
+    data[0, 4], data[4, 4] = 3., 3.
+    mask[2, 0] = mask[2, 8] = mask[0, 4] = mask[4, 4] = True
+    check(data, mask)
+
+
+def test_gaps_wider_than_radius():
+    rng = np.random.default_rng(7)
+    data = rng.integers(0, 3, size=(40, 40)).astype(np.float64)
+    mask = np.zeros(data.shape, dtype=bool)
+    mask[0, :] = mask[:, 0] = mask[-1, :] = True
+    mask[20, 39] = True
+    check(data, mask, radius=3)
@@ -0,0 +1,40 @@
+import os
+
+import step_cache
+
+
+def scale(input_file, output_file, factor):
+    with open(input_file) as f:
+        value = float(f.read())
+    # rewrite the fixed output file in place, as netCDF4 and GDAL do
+    with open(output_file, 'w') as f:
+        f.write(str(value * factor))
+    return output_file
+
+
+def test_parameter_change_and_back_hits_cache(tmp_path):
+    input_file = str(tmp_path / 'input.txt')
+    output_file = str(tmp_path / 'output.txt')
+    with open(input_file, 'w') as f:
+        f.write('2')
+    cache = step_cache.StepCache(str(tmp_path / '.step_cache'))
+    calls = []
+
+    def run(factor):
+        def step(*args):
+            calls.append(factor)
+            return scale(*args)
+        return cache.call('scale', step, inputs={'input': input_file},
+                          params={'factor': factor},
+                          args=(input_file, output_file, factor))
+
+    run(3)
+    run(5)
+    with open(output_file) as f:
+        assert f.read() == '10.0'
+
+    assert run(3) == output_file
+    assert calls == [3, 5]
+    with open(output_file) as f:
+        assert f.read() == '6.0'
+    assert not os.path.exists(output_file + '.tmp')
@@ -8,11 +8,9 @@ import numpy as np
 import os
 import glob
 import pandas as pd
-import gdal
 import calendar
 
-
-def Nearest_Interpolate(Dir_in, Startdate, Enddate, format_in = None, format_out = None, Dir_out = None, AOI = None):
+def Nearest_Interpolate(Dir_in, Startdate, Enddate, format_in = None, format_out = None, Dir_out = None, AOI = None, block_rows = None):
     """
     This functions calculates monthly tiff files based on the daily tiff files.
     (will calculate the total sum)
@@ -27,11 +25,12 @@ def Nearest_Interpolate(Dir_in, Startdate, Enddate, format_in = None, format_out
         Contains the end date of the model 'yyyy-mm-dd'
     Dir_out : str
         Path to the output data, default is same as Dir_in
+    block_rows : int
+        Number of rows read at once, default is as many as fit in 512 MB
 
     """
     # import WA+ modules
-    import watertools.General.data_conversions as DC
-    import watertools.General.raster_conversions as RC
+    import watertools.Functions.Time_Conversions.Temporal_Resampling as TR
 
     # Change working directory
     os.chdir(Dir_in)
@@ -46,75 +45,44 @@ def Nearest_Interpolate(Dir_in, Startdate, Enddate, format_in = None, format_out
     else:
         files = glob.glob(format_in.replace(":02d","").format(yyyy= "*", mm = "*", dd = "*"))    
 
-    # Get array information and define projection
-    geo_out, proj, size_X, size_Y = RC.Open_array_info(files[0])
-    if int(proj.split('"')[-2]) == 4326:
-        proj = "WGS84"
-
-    # Get the No Data Value
-    dest = gdal.Open(files[0])
-    NDV = dest.GetRasterBand(1).GetNoDataValue()
+    # Get the day of every daily file and the month it belongs to
+    files, Starts, Ends = TR.Periods_files(files, 1, format_in)
+    Starts_month = Dates
+    Ends_month = Dates + pd.offsets.MonthEnd(0)
+    weights = TR.Weight_Matrix(Starts, Ends, Starts_month, Ends_month)
 
     # Define output directory
     if Dir_out is None:
-	     Dir_out = Dir_in
+        Dir_out = Dir_in
 
     if not os.path.exists(Dir_out):
-	     os.makedirs(Dir_out)
+        os.makedirs(Dir_out)
 
-    # loop over the months and sum the days
-    for date in Dates:
+    # Check the amount of days in every month and define the output names
+    Days_found = np.asarray(weights.sum(axis = 0)).ravel()
+    output_names = []
+    for j, date in enumerate(Dates):
         Year = date.year
         Month = date.month
-        if format_in == None:
-            files_one_year = glob.glob('*%d.%02d*.tif' % (Year, Month))
-            #files_one_year = glob.glob('*daily*%d.%02d*.tif' % (Year, Month))
-        else:
-            files_one_year = glob.glob(format_in.replace(":02d","").format(yyyy=Year, mm = "%02d" %Month, dd = "*"))
-
-        # Create empty arrays
-        Month_data = np.zeros([size_Y, size_X])
 
         # Get amount of days in month
         Amount_days_in_month = int(calendar.monthrange(Year, Month)[1])
 
-        if len(files_one_year) is not Amount_days_in_month:
+        if Days_found[j] != Amount_days_in_month:
             print("One day is missing!!! month %s year %s" %(Month, Year))
-            print("Days found = %d" %len(files_one_year))
+            print("Days found = %d" %Days_found[j])
 
-        for file_one_year in files_one_year:
-            file_path = os.path.join(Dir_in, file_one_year)
-
-            Day_data = RC.Open_tiff_array(file_path)
-            Day_data[np.isnan(Day_data)] = 0.0
-            Day_data[Day_data == -9999] = 0.0
-            Month_data += Day_data
-            
-        if str(type(AOI)) == "<class 'numpy.ndarray'>":
-            Month_data = Month_data * AOI
-            
         # Define output name
         if format_out == None:
-            file_name = file_one_year.split('_')[0] + '_monthly_' + file_one_year.split('_')[-1] 
+            file_one_year = os.path.basename(files[0])
+            file_name = file_one_year.split('_')[0] + '_monthly_' + file_one_year.split('_')[-1]
             output_name = os.path.join(Dir_out, 'monthly', file_name)
-            # output_name = os.path.join(Dir_out, file_one_year
-            #                            .replace('daily', 'monthly')
-            #                            .replace('day', 'month'))
-    
             output_name = output_name[:-14] + '%d.%02d.01.tif' % (date.year, date.month)
         else:
             output_name = os.path.join(Dir_out, format_out.format(yyyy = date.year,  mm = date.month, dd = 1))
+        output_names.append(output_name)
 
-        # Save tiff file
-        DC.Save_as_tiff(output_name, Month_data, geo_out, proj)
+    # Sum the days, no data counts as zero
+    TR.Resample(files, weights, output_names, method = 'sum', NDV = -9999, AOI = AOI, block_rows = block_rows)
 
     return
-
-
-
-
-
-
-
-
-
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+Module: Function/Time_Conversions
+
+Temporal resampling of rasters with a period (daily, 8-daily, 16-daily) to
+rasters of other periods (monthly). The number of days that the period of
+every input file overlaps every output period is kept in a sparse weight
+matrix (input files x output periods). Every input raster is read once per
+block of rows and its data is added to all output periods it overlaps. An
+output period is finished as soon as the last file overlapping it is read,
+so only the output periods that are open at the same time are kept in memory.
+"""
+# General Python modules
+import os
+import datetime
+import numpy as np
+import pandas as pd
+import scipy.sparse as sparse
+import gdal
+
+def Date_from_file(File, format_in = None):
+    """
+    Get the date from the name of a file.
+
+    Parameters
+    ----------
+    File : str
+        Name of the file, by default ending with yyyy.mm.dd.tif
+    format_in : str
+        Format of the file name with {yyyy}, {mm:02d} and {dd:02d}
+
+    """
+    if format_in == None:
+        year = File.split('.')[-4][-4:]
+        month = File.split('.')[-3]
+        day = File.split('.')[-2]
+        return pd.Timestamp(int(year), int(month), int(day))
+    else:
+        return pd.Timestamp(datetime.datetime.strptime(File, format_in.replace("{yyyy}", "%Y").replace("{mm:02d}", "%m").replace("{dd:02d}", "%d")))
+
+def Periods_files(files, days, format_in = None):
+    """
+    Get the period of each file from its name. A period starts at the date in
+    the file name and lasts the given number of days, but not past the end of
+    the year (as the last MODIS composite of a year). Files without a date in
+    their name are left out.
+
+    Parameters
+    ----------
+    files : list
+        Names of the files
+    days : int
+        Number of days of a period, 1 for daily files
+    format_in : str
+        Format of the file names, see Date_from_file
+
+    Returns
+    -------
+    files : list
+        Names of the files with a date
+    Starts : pandas.DatetimeIndex
+        First day of the period of each file
+    Ends : pandas.DatetimeIndex
+        Last day of the period of each file
+    """
+    files_out = []
+    Starts = []
+    for File in files:
+        try:
+            Starts.append(Date_from_file(File, format_in))
+        except (ValueError, IndexError):
+            continue
+        files_out.append(File)
+    Starts = pd.DatetimeIndex(Starts)
+    Ends = Starts + pd.Timedelta(days = days - 1)
+    Ends_year = pd.DatetimeIndex([pd.Timestamp(Start.year, 12, 31) for Start in Starts])
+    Ends = Ends.where(Ends <= Ends_year, Ends_year)
+    return files_out, Starts, Ends
+
+def Months(Startdate, Enddate):
+    """
+    Get the months from the month of the start date until the month of the
+    end date.
+
+    Returns
+    -------
+    Starts : pandas.DatetimeIndex
+        First day of every month
+    Ends : pandas.DatetimeIndex
+        Last day of every month
+    """
+    Starts = pd.date_range(pd.Timestamp(Startdate).replace(day = 1), Enddate, freq = 'MS')
+    Ends = Starts + pd.offsets.MonthEnd(0)
+    return Starts, Ends
+
+def Weight_Matrix(Starts_in, Ends_in, Starts_out, Ends_out):
+    """
+    Calculate the number of days the periods of the input files overlap the
+    output periods.
+
+    Returns
+    -------
+    weights : scipy.sparse.csr_matrix
+        Days of overlap, input files as rows and output periods as columns
+    """
+    Starts_in = np.asarray(Starts_in, dtype = 'datetime64[D]')
+    Ends_in = np.asarray(Ends_in, dtype = 'datetime64[D]')
+    rows = []
+    cols = []
+    values = []
+    for j, (Start_out, End_out) in enumerate(zip(np.asarray(Starts_out, dtype = 'datetime64[D]'),
+                                                 np.asarray(Ends_out, dtype = 'datetime64[D]'))):
+        overlap = (np.minimum(Ends_in, End_out) - np.maximum(Starts_in, Start_out)).astype(int) + 1
+        i = np.flatnonzero(overlap > 0)
+        rows.append(i)
+        cols.append(np.full(len(i), j))
+        values.append(overlap[i])
+    weights = sparse.csr_matrix((np.concatenate(values).astype(np.float64),
+                                 (np.concatenate(rows), np.concatenate(cols))),
+                                shape = (len(Starts_in), len(Starts_out)))
+    return weights
+
+def Resample(files, weights, output_names, method = 'state', NDV = None, Days_out = None, AOI = None, block_rows = None, memory = 512):
+    """
+    Resample rasters with a sparse weight matrix, see Weight_Matrix, and save
+    the output rasters.
+
+    Parameters
+    ----------
+    files : list
+        Paths to the input rasters, rows of the weight matrix
+    weights : scipy.sparse matrix
+        Weights of the input rasters (rows) for every output raster (columns)
+    output_names : list
+        Paths to the output rasters, columns of the weight matrix
+    method : str
+        'state' for the weighted average, 'flux' for the weighted average
+        times the number of days of the output period (Days_out) and 'sum' for
+        the weighted sum. No data is left out of the average and counted as
+        zero in the sum.
+    NDV : float
+        No data value of the input rasters, NaN is always no data
+    Days_out : list
+        Number of days of every output period, needed for 'flux'
+    AOI : ndarray
+        Array that the output rasters are multiplied with
+    block_rows : int
+        Number of rows read at once, by default as many as fit in memory
+    memory : float
+        Memory in MB for the output periods that are open at once, used when
+        block_rows is None
+
+    """
+    # import WA+ modules
+    import watertools.General.raster_conversions as RC
+
+    weights = sparse.csr_matrix(weights)
+    weights.eliminate_zeros()
+
+    # Read the files in order of their first output period and finish an
+    # output period after the last file that overlaps it
+    nout = weights.shape[1]
+    first = np.full(weights.shape[0], nout)
+    for i in range(weights.shape[0]):
+        cols = weights.indices[weights.indptr[i]:weights.indptr[i+1]]
+        if len(cols) > 0:
+            first[i] = cols.min()
+    order = [i for i in np.argsort(first, kind = 'stable') if first[i] < nout]
+    opens = np.full(nout, -1)
+    last = np.full(nout, -1)
+    for n, i in enumerate(order):
+        cols = weights.indices[weights.indptr[i]:weights.indptr[i+1]]
+        opens[cols[opens[cols] == -1]] = n
+        last[cols] = n
+    finished = dict()
+    for j in range(nout):
+        finished.setdefault(last[j], []).append(j)
+
+    # Number of output periods that are open at the same time
+    opened = np.zeros(len(order) + 1, dtype = int)
+    np.add.at(opened, opens[last >= 0], 1)
+    np.add.at(opened, last[last >= 0] + 1, -1)
+    opened = np.cumsum(opened)
+
+    # Get array information and define projection
+    geo_out, proj, size_X, size_Y = RC.Open_array_info(files[0])
+    if int(proj.split('"')[-2]) == 4326:
+        proj = "WGS84"
+
+    # Define the blocks of rows
+    if block_rows is None:
+        block_rows = int(memory * 1024**2 / (16. * size_X * max(np.max(opened), 1)))
+    block_rows = int(min(max(block_rows, 1), size_Y))
+    blocks = list(range(0, size_Y, block_rows))
+    if len(blocks) > 1:
+        Create_outputs(output_names, files[0])
+
+    for y0 in blocks:
+        rows = min(block_rows, size_Y - y0)
+        Sum = dict()
+        Weight_tot = dict()
+
+        # Output periods without input files
+        for j in finished.get(-1, []):
+            Finish(j, np.zeros([rows, size_X]), np.zeros([rows, size_X]), output_names, method, Days_out, AOI, y0, len(blocks), geo_out, proj)
+
+        for n, i in enumerate(order):
+
+            # Open the block of the current file
+            dest = gdal.Open(files[i])
+            Data = dest.GetRasterBand(1).ReadAsArray(0, y0, size_X, rows).astype(np.float64)
+            dest = None
+
+            # Remove NDV
+            Valid = ~np.isnan(Data)
+            if NDV is not None:
+                Valid[Data == NDV] = False
+            Data[~Valid] = 0
+            Valid = Valid.astype(np.float64)
+
+            # Add the weighted data to all the output periods of the file
+            for j, Weight in zip(weights.indices[weights.indptr[i]:weights.indptr[i+1]],
+                                 weights.data[weights.indptr[i]:weights.indptr[i+1]]):
+                if j not in Sum:
+                    Sum[j] = np.zeros([rows, size_X])
+                    Weight_tot[j] = np.zeros([rows, size_X])
+                Sum[j] += Data * Weight
+                Weight_tot[j] += Valid * Weight
+
+            for j in finished.get(n, []):
+                Finish(j, Sum.pop(j), Weight_tot.pop(j), output_names, method, Days_out, AOI, y0, len(blocks), geo_out, proj)
+
+    return
+
+def Finish(j, Sum, Weight_tot, output_names, method, Days_out, AOI, y0, nblocks, geo_out, proj):
+    """
+    Calculate a block of an output raster and save it.
+    """
+    # import WA+ modules
+    import watertools.General.data_conversions as DC
+
+    if method == 'sum':
+        Data = Sum
+    else:
+        Data = np.ones(Sum.shape) * np.nan
+        Data[Weight_tot != 0.] = Sum[Weight_tot != 0.] / Weight_tot[Weight_tot != 0.]
+        if method == 'flux':
+            Data = Data * Days_out[j]
+
+    if str(type(AOI)) == "<class 'numpy.ndarray'>":
+        Data = Data * AOI[y0:y0 + Data.shape[0]]
+
+    if nblocks == 1:
+        DC.Save_as_tiff(output_names[j], Data, geo_out, proj)
+    else:
+        dest = gdal.Open(output_names[j], gdal.GA_Update)
+        dest.GetRasterBand(1).WriteArray(Data, 0, y0)
+        dest = None
+
+def Create_outputs(output_names, example):
+    """
+    Create empty output rasters with the grid and projection of an example
+    raster, written block by block afterwards.
+    """
+    dest = gdal.Open(example)
+    driver = gdal.GetDriverByName("GTiff")
+    for output_name in output_names:
+        dir_name = os.path.dirname(output_name)
+        if dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+        dst_ds = driver.Create(output_name, dest.RasterXSize, dest.RasterYSize, 1, gdal.GDT_Float32, ['COMPRESS=LZW'])
+        dst_ds.SetProjection(dest.GetProjection())
+        dst_ds.GetRasterBand(1).SetNoDataValue(-9999)
+        dst_ds.SetGeoTransform(dest.GetGeoTransform())
+        dst_ds = None
+    dest = None
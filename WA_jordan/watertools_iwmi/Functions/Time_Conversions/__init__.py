@@ -4,8 +4,8 @@ Authors: Tim Hessels
 """
 
 
-from watertools_iwmi.Functions.Time_Conversions import Eightdaily_to_monthly_state, Eightdaily_to_monthly_flux, Weekly_to_monthly_flux, Sixteendaily_to_monthly_state, Monthly_to_yearly_flux, Day_to_monthly_flux, Day_to_monthly_state, Monthly_to_yearly_state, Hour_to_daily_flux, Hour_to_daily_state
+from watertools_iwmi.Functions.Time_Conversions import Eightdaily_to_monthly_state, Eightdaily_to_monthly_flux, Weekly_to_monthly_flux, Sixteendaily_to_monthly_state, Monthly_to_yearly_flux, Day_to_monthly_flux, Day_to_monthly_state, Monthly_to_yearly_state, Hour_to_daily_flux, Hour_to_daily_state, Temporal_Resampling
 
-__all__ = ['Eightdaily_to_monthly_state', 'Eightdaily_to_monthly_flux', 'Weekly_to_monthly_flux', 'Sixteendaily_to_monthly_state', 'Monthly_to_yearly_flux', 'Day_to_monthly_flux', 'Day_to_monthly_state', 'Monthly_to_yearly_state', 'Hour_to_daily_flux', 'Hour_to_daily_state']
+__all__ = ['Eightdaily_to_monthly_state', 'Eightdaily_to_monthly_flux', 'Weekly_to_monthly_flux', 'Sixteendaily_to_monthly_state', 'Monthly_to_yearly_flux', 'Day_to_monthly_flux', 'Day_to_monthly_state', 'Monthly_to_yearly_state', 'Hour_to_daily_flux', 'Hour_to_daily_state', 'Temporal_Resampling']
 
 __version__ = '0.1'
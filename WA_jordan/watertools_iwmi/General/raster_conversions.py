@@ -14,6 +14,8 @@ import numpy as np
 import subprocess
 from pyproj import Proj, transform
 import scipy.interpolate
+import scipy.ndimage
+import scipy.spatial
 import fiona
 import requests
 import pycurl
@@ -949,13 +951,18 @@ def Get_epsg(g, extension = 'tiff'):
         
     return(epsg_to)
 
-def gap_filling(dataset, NoDataValue, method = 1):
+def gap_filling(dataset, NoDataValue, method = 1, window = 3):
     """
     This function fills the no data gaps in a numpy array
 
     Keyword arguments:
     dataset -- 'C:/'  path to the source data (dataset that must be filled)
     NoDataValue -- Value that must be filled
+    method -- 1 (Default) nearest neighbour, 2 linear interpolation and
+              3 inverse distance weighting, only the pixels within window
+              pixels of the gaps are used by method 2 and 3
+    window -- integer, the width in pixels of the neighbourhood of the gaps
+              used by method 2 and 3
     """
     import watertools.General.data_conversions as DC
 
@@ -976,17 +983,15 @@ def gap_filling(dataset, NoDataValue, method = 1):
         mask = ~(np.isnan(data))
     else:
         mask = ~(data==NoDataValue)
-    xx, yy = np.meshgrid(np.arange(data.shape[1]), np.arange(data.shape[0]))
-    xym = np.vstack( (np.ravel(xx[mask]), np.ravel(yy[mask])) ).T
-    data0 = np.ravel( data[:,:][mask] )
 
     if method == 1:
-        interp0 = scipy.interpolate.NearestNDInterpolator( xym, data0 )
-        data_end = interp0(np.ravel(xx), np.ravel(yy)).reshape( xx.shape )
+        data_end = gap_filling_nearest(data, mask)
 
     if method == 2:
-        interp0 = scipy.interpolate.LinearNDInterpolator( xym, data0 )
-        data_end = interp0(np.ravel(xx), np.ravel(yy)).reshape( xx.shape )
+        data_end = gap_filling_local(data, mask, method = 'linear', window = window)
+
+    if method == 3:
+        data_end = gap_filling_local(data, mask, method = 'idw', window = window)
 
     if Save_as_tiff == 1:
         EndProduct=dataset[:-4] + '_GF.tif'
@@ -1002,6 +1007,107 @@ def gap_filling(dataset, NoDataValue, method = 1):
 
     return (EndProduct)
 
+def gap_filling_nearest(data, mask, radius = 16):
+    """
+    This function fills the gaps in a numpy array with the value of the
+    nearest valid pixel, found with a Euclidean distance transform.
+
+    When several valid pixels with different values are equally near, the
+    pixel is filled as scipy's NearestNDInterpolator over all valid pixels
+    would, so the result is identical to that interpolation.
+
+    Keyword arguments:
+    data -- numpy array that must be filled
+    mask -- numpy array, True for the valid pixels
+    radius -- integer, ties are checked up to this distance in pixels, more
+              distant gap pixels are filled by the interpolator
+    """
+    data_end = np.array(data, dtype = np.float64)
+    gaps = ~mask
+    if not np.any(gaps) or not np.any(mask):
+        return data_end
+
+    # nearest valid pixel of every pixel
+    yy_near, xx_near = scipy.ndimage.distance_transform_edt(gaps, return_distances = False, return_indices = True)
+    yy, xx = np.nonzero(gaps)
+    yy_near = yy_near[yy, xx]
+    xx_near = xx_near[yy, xx]
+    values = data[yy_near, xx_near]
+    data_end[yy, xx] = values
+
+    # find the gap pixels with other valid values at the same distance
+    distance2 = (yy_near - yy)**2 + (xx_near - xx)**2
+    ties = distance2 > radius**2
+    dy, dx = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+    offsets2 = dy**2 + dx**2
+    for d2 in np.unique(distance2[~ties]):
+        rows = np.flatnonzero(distance2 == d2)
+        for oy, ox in zip(dy[offsets2 == d2], dx[offsets2 == d2]):
+            y = yy[rows] + oy
+            x = xx[rows] + ox
+            inside = (y >= 0) & (y < data.shape[0]) & (x >= 0) & (x < data.shape[1])
+            other = np.zeros(len(rows), dtype = bool)
+            other[inside] = mask[y[inside], x[inside]] & ~(data[y[inside], x[inside]] == values[rows][inside])
+            ties[rows[other]] = True
+
+    if np.any(ties):
+        xx_valid, yy_valid = np.meshgrid(np.arange(data.shape[1]), np.arange(data.shape[0]))
+        xym = np.vstack( (np.ravel(xx_valid[mask]), np.ravel(yy_valid[mask])) ).T
+        interp0 = scipy.interpolate.NearestNDInterpolator( xym, np.ravel( data[mask] ) )
+        data_end[yy[ties], xx[ties]] = interp0(xx[ties], yy[ties])
+
+    return data_end
+
+def gap_filling_local(data, mask, method = 'linear', window = 3, neighbours = 8, power = 2):
+    """
+    This function fills the gaps in a numpy array by interpolating between the
+    valid pixels around the gaps. Only the valid pixels within window pixels
+    of a gap are used and only the gap pixels are interpolated, valid pixels
+    keep their value. Gap pixels that can not be interpolated are NaN.
+
+    Keyword arguments:
+    data -- numpy array that must be filled
+    mask -- numpy array, True for the valid pixels
+    method -- 'linear' (Default) for linear interpolation on a Delaunay
+              triangulation, 'idw' for inverse distance weighting
+    window -- integer, width in pixels of the neighbourhood of the gaps
+    neighbours -- integer, number of nearest valid pixels used by 'idw'
+    power -- power of the inverse distance used by 'idw'
+    """
+    data_end = np.array(data, dtype = np.float64)
+    gaps = ~mask
+    if not np.any(gaps):
+        return data_end
+    data_end[gaps] = np.nan
+
+    # valid pixels around the gaps
+    around = scipy.ndimage.binary_dilation(gaps, structure = np.ones((3,3), dtype = bool), iterations = window) & mask
+    yy, xx = np.nonzero(gaps)
+    yy_around, xx_around = np.nonzero(around)
+    if len(yy_around) == 0:
+        return data_end
+    xym = np.vstack((xx_around, yy_around)).T
+    values = data_end[yy_around, xx_around]
+
+    if method == 'linear':
+        try:
+            interp0 = scipy.interpolate.LinearNDInterpolator(xym, values)
+        except (ValueError, RuntimeError):
+            # not enough valid pixels to triangulate
+            return data_end
+        data_end[yy, xx] = interp0(xx, yy)
+
+    if method == 'idw':
+        tree = scipy.spatial.cKDTree(xym)
+        k = min(neighbours, len(values))
+        distance, index = tree.query(np.vstack((xx, yy)).T, k = k)
+        distance = distance.reshape(len(yy), k)
+        index = index.reshape(len(yy), k)
+        weights = 1. / distance**power
+        data_end[yy, xx] = np.sum(weights * values[index], axis = 1) / np.sum(weights, axis = 1)
+
+    return data_end
+
 def Get3Darray_time_series_monthly(Data_Path, Startdate, Enddate, Example_data = None):
     """
     This function creates a datacube
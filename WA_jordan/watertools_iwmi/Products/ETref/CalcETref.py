@@ -11,7 +11,7 @@ import numpy as np
 from watertools.Products.ETref.Interpolate_Meteo_ETref import process_GLDAS, lapse_rate, adjust_P, slope_correct
 import watertools.General.raster_conversions as RC
 
-def calc_ETref(Dir, tmin_str, tmax_str, humid_str, press_str, wind_str, down_short_str, down_long_str, up_long_str, DEMmap_str, DOY):
+def calc_ETref(Dir, tmin_str, tmax_str, humid_str, press_str, wind_str, down_short_str, down_long_str, up_long_str, DEMmap_str, DOY, terrain = None):
     """
     This function calculates the ETref by using all the input parameters (path)
     according to FAO standards
@@ -28,6 +28,7 @@ def calc_ETref(Dir, tmin_str, tmax_str, humid_str, press_str, wind_str, down_sho
     up_long_str -- 'C:/'  path to the upward longwave radiation tiff file [W*m-2], e.g. from CFSR/LANDSAF
     DEMmap_str -- 'C:/'  path to the DEM tiff file [m] e.g. from HydroSHED
     DOY -- Day of the year
+    terrain -- TerrainCache of the DEM map, see TerrainCache_ETref (optional)
     """
 
     # Get some geo-data to save results
@@ -106,7 +107,7 @@ def calc_ETref(Dir, tmin_str, tmax_str, humid_str, press_str, wind_str, down_sho
         dest = RC.reproject_dataset_example(inputs['down_short'], DEMmap_str,method = 2)
         down_short=dest.GetRasterBand(1).ReadAsArray()
         dest = None
-        down_short, tau, bias = slope_correct(down_short,press,ea,DEMmap_str,DOY)
+        down_short, tau, bias = slope_correct(down_short,press,ea,DEMmap_str,DOY,terrain)
 
         #OPEN OTHER RADS
         up_short = down_short*0.23
@@ -123,7 +123,7 @@ def adjust_P(Dir, pressure_map, DEMmap):
 
     return P
 
-def slope_correct(down_short_hor, pressure, ea, DEMmap, DOY):
+def slope_correct(down_short_hor, pressure, ea, DEMmap, DOY, terrain = None):
     """
     This function downscales the CFSR solar radiation by using the DEM map
     The Slope correction is based on Allen et al. (2006)
@@ -135,23 +135,29 @@ def slope_correct(down_short_hor, pressure, ea, DEMmap, DOY):
     ea -- numpy array with the actual vapour pressure
     DEMmap -- 'C:/' path to the DEM map
     DOY -- day of the year
+    terrain -- TerrainCache with the terrain grids of the DEM map, if None (Default)
+               the grids are calculated from the DEM map
     """
 
-    # Get Geo Info
-    GeoT, Projection, xsize, ysize = RC.Open_array_info(DEMmap)
+    if terrain is None:
+        # Get Geo Info
+        GeoT, Projection, xsize, ysize = RC.Open_array_info(DEMmap)
 
-    minx = GeoT[0]
-    miny = GeoT[3] + xsize*GeoT[4] + ysize*GeoT[5]
+        minx = GeoT[0]
+        miny = GeoT[3] + xsize*GeoT[4] + ysize*GeoT[5]
 
-    x = np.flipud(np.arange(xsize)*GeoT[1] + minx + GeoT[1]/2)
-    y = np.flipud(np.arange(ysize)*-GeoT[5] + miny + -GeoT[5]/2)
+        x = np.flipud(np.arange(xsize)*GeoT[1] + minx + GeoT[1]/2)
+        y = np.flipud(np.arange(ysize)*-GeoT[5] + miny + -GeoT[5]/2)
 
-    # Calculate Extraterrestrial Solar Radiation [W m-2]
-    demmap = RC.Open_tiff_array(DEMmap)
-    demmap[demmap<0]=0
+        # Calculate Extraterrestrial Solar Radiation [W m-2]
+        demmap = RC.Open_tiff_array(DEMmap)
+        demmap[demmap<0]=0
 
-	# apply the slope correction
-    Ra_hor, Ra_slp, sinb, sinb_hor, fi, slope, ID = SlopeInfluence(demmap,y,x,DOY)
+        # apply the slope correction
+        Ra_hor, Ra_slp, sinb, sinb_hor, fi, slope, ID = SlopeInfluence(demmap,y,x,DOY)
+    else:
+        # Terrain grids of the day of the year, see TerrainCache_ETref
+        Ra_hor, Ra_slp, sinb, sinb_hor, fi, slope = terrain.radiation(DOY)
 
     # Calculate atmospheric transmissivity
     Rs_hor = down_short_hor
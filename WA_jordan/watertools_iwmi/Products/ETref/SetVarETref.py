@@ -5,6 +5,7 @@ Module: Products/ETref
 '''
 # import general python modules
 import os
+import numpy as np
 import pandas as pd
 from joblib import Parallel, delayed
 
@@ -12,6 +13,7 @@ from joblib import Parallel, delayed
 from watertools.General import raster_conversions as RC
 from watertools.General import data_conversions as DC
 from watertools.Products.ETref.CalcETref import calc_ETref
+from watertools.Products.ETref.TerrainCache_ETref import terrain_cache
 
 
 def SetVariables(Dir, Startdate, Enddate, latlim, lonlim, pixel_size, cores, LANDSAF, Waitbar):
@@ -42,6 +44,11 @@ def SetVariables(Dir, Startdate, Enddate, latlim, lonlim, pixel_size, cores, LAN
         amount = 0
         Waitbar.printWaitBar(amount, total_amount, prefix = 'Progress:', suffix = 'Complete', length = 50)
 
+    # Reproject the DEM and calculate the terrain grids of all days once
+    terrain = terrain_cache(Dir, pixel_size)
+    if LANDSAF != 1:
+        terrain.prepare(Dates.dayofyear)
+
     # Pass variables to parallel function and run
     args = [Dir, lonlim, latlim, pixel_size, LANDSAF]
     if not cores:
@@ -65,6 +72,20 @@ def ETref(Date, args):
     args -- includes all the parameters that are needed for the ETref
 	"""
 
+    # Calc ETref and create the daily ETref tiff file
+    ETref, DEMmap_str = ETref_day(Date, args)
+    Save_ETref_day(Date, args[0], ETref, DEMmap_str)
+
+def ETref_day(Date, args):
+    """
+    This function calculates the ETref of one day and returns the array and the
+    path of the DEM map that defines its grid
+
+    Keyword arguments:
+    Date -- panda timestamp
+    args -- includes all the parameters that are needed for the ETref
+    """
+
 	# unpack the arguments
     [Dir, lonlim, latlim, pixel_size, LANDSAF] = args
 
@@ -119,20 +140,25 @@ def ETref(Date, args):
    # The day of year
     DOY=Date.dayofyear
 
-    # Load DEM
-    if not pixel_size:
-        DEMmap_str=os.path.join(Dir,'HydroSHED','DEM','DEM_HydroShed_m_3s.tif')
-    else:
-        DEMmap_str=os.path.join(Dir,'HydroSHED','DEM','DEM_HydroShed_m_3s.tif')
-        dest, ulx, lry, lrx, uly, epsg_to = RC.reproject_dataset_epsg(DEMmap_str, pixel_spacing = pixel_size, epsg_to=4326, method = 2)
-        DEMmap_str=os.path.join(Dir,'HydroSHED','DEM','DEM_HydroShed_m_reshaped_for_ETref.tif')
-        DEM_data = dest.GetRasterBand(1).ReadAsArray()
-        geo_dem = [ulx, pixel_size, 0.0, uly, 0.0, - pixel_size]
-        DC.Save_as_tiff(name=DEMmap_str, data=DEM_data, geo=geo_dem, projection='4326')
+    # Load DEM, reprojected to the pixel size once by the terrain cache
+    terrain = terrain_cache(Dir, pixel_size)
+    DEMmap_str = terrain.dem_path
 
     # Calc ETref
-    ETref = calc_ETref(Dir, tmin_str, tmax_str, humid_str, press_str, wind_str, input1_str, input2_str, input3_str, DEMmap_str, DOY)
+    ETref = calc_ETref(Dir, tmin_str, tmax_str, humid_str, press_str, wind_str, input1_str, input2_str, input3_str, DEMmap_str, DOY, terrain)
+
+    return ETref, DEMmap_str
 
+def Save_ETref_day(Date, Dir, ETref, DEMmap_str):
+    """
+    This function saves the ETref of one day as daily ETref tiff file
+
+    Keyword arguments:
+    Date -- panda timestamp
+    Dir -- 'C:/file/to/path/'
+    ETref -- numpy array with the ETref [mm/day]
+    DEMmap_str -- 'C:/' path to the DEM map with the grid of ETref
+    """
     # Make directory for the MODIS ET data
     output_folder=os.path.join(Dir,'ETref','Daily')
     if not os.path.exists(output_folder):
@@ -148,6 +174,69 @@ def ETref(Date, args):
     # Create daily ETref tiff files
     DC.Save_as_tiff(name=NameEnd, data=ETref, geo=geo_out, projection=proj)
 
+def SumVariables(Dir, Startdate, Enddate, latlim, lonlim, pixel_size, cores, LANDSAF, save_daily = True):
+    """
+    This function calculates the sum of the daily ETref of a period in memory,
+    without reading back daily ETref tiff files. Every core sums its own share
+    of the days, so it keeps only the grids of one day and its running sum.
+
+    Keyword arguments:
+    Dir -- 'C:/file/to/path/'
+    Startdate -- 'yyyy-mm-dd'
+    Enddate -- 'yyyy-mm-dd'
+    latlim -- [ymin, ymax] (values must be between -60 and 60)
+    lonlim -- [xmin, xmax] (values must be between -180 and 180)
+    pixel_size -- The output pixel size
+    cores -- The number of cores used to run the routine.
+             It can be 'False' to avoid using parallel computing
+             routines.
+    LANDSAF -- if LANDSAF data must be used it is 1
+    save_daily -- True (Default) also creates the daily ETref tiff files
+
+    returns the sum of the daily ETref [mm] and the path of the DEM map that
+    defines its grid
+    """
+    Dates = pd.date_range(Startdate,Enddate,freq = 'D')
 
+    # Reproject the DEM and calculate the terrain grids of all days once
+    terrain = terrain_cache(Dir, pixel_size)
+    if LANDSAF != 1:
+        terrain.prepare(Dates.dayofyear)
 
+    args = [Dir, lonlim, latlim, pixel_size, LANDSAF]
+    if not cores:
+        sums = [ETref_sum(Dates, args, save_daily)]
+    else:
+        parts = [Dates[i::cores] for i in range(min(cores, len(Dates)))]
+        sums = Parallel(n_jobs=cores)(delayed(ETref_sum)(Days, args, save_daily)
+                                      for Days in parts)
+
+    total = sums[0]
+    for part in sums[1:]:
+        total = total + part
+    return total, terrain.dem_path
+
+def ETref_sum(Dates, args, save_daily):
+    """
+    This function sums the daily ETref of some days, negative values are set
+    to zero as in the daily ETref tiff files
 
+    Keyword arguments:
+    Dates -- panda timestamps
+    args -- includes all the parameters that are needed for the ETref
+    save_daily -- if True the daily ETref tiff files are created as well
+    """
+    total = None
+    for Date in Dates:
+        ETref, DEMmap_str = ETref_day(Date, args)
+        if save_daily:
+            Save_ETref_day(Date, args[0], ETref, DEMmap_str)
+
+        # Same precision as the daily ETref tiff files
+        Dval = ETref.astype(np.float32)
+        Dval[Dval<0]=0
+        if total is None:
+            total = Dval.astype(np.float64)
+        else:
+            total = total + Dval
+    return total
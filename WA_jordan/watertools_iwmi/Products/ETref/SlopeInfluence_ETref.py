@@ -28,9 +28,23 @@ def SlopeInfluence(DEMmap,latitude,longitude,day):
     # Be carefull with high latitudes (>66, polar circle)! Calculations for regions without sunset
     # (all day sun) are not calculated correctly.
     
-    # Solar constant
-    G = 1367.0
-    
+    lat, slope, slopedir = SlopeAspect(DEMmap,latitude,longitude)
+
+    return(SunInfluence(lat,slope,slopedir,day))
+
+def SlopeAspect(DEMmap,latitude,longitude):
+
+    '''
+    This function calculates the slope and the slope direction of the terrain,
+    which only depend on the DEM and not on the day of the year.
+
+    DEMmap -- numpy array with the DEM
+    latitude -- numpy array with the latitude
+    longitude -- numpy array with the longitude
+
+    returns the latitude in radians as matrix, the slope and the slope direction
+    '''
+
     # If lat/lon are not a matrix but a vector create matrixes
     if not latitude.shape == longitude.shape:
         latitude = np.tile(latitude.reshape(len(latitude),1),[1,len(longitude)])
@@ -65,13 +79,6 @@ def SlopeInfluence(DEMmap,latitude,longitude,day):
     # Calculate slope
     slope = np.arctan((np.abs(dy_lat) + np.abs(dy_lon)) / np.sqrt(dlon**2+dlat**2))
     
-    # declination of earth
-    delta = np.arcsin(np.sin(23.45/360*2*np.pi)*np.sin((360.0/365.0)*(day-81)/360*2*np.pi))
-    # EQ 2
-    D2 = 1 / (1 + 0.033* np.cos(day/365*2*np.pi))
-    
-    constant =  G / D2 / (2*np.pi) 
-    
     # Slope direction
     with np.errstate(divide='ignore'):
         slopedir = np.arctan(dy_lon/dy_lat) 
@@ -83,6 +90,30 @@ def SlopeInfluence(DEMmap,latitude,longitude,day):
         # Correction ip dy_lat > 0
         slopedir[np.logical_and(dy_lat > 0, dy_lon < 0)] = np.pi + slopedir[np.logical_and(dy_lat > 0, dy_lon < 0)]
         slopedir[np.logical_and(dy_lat > 0, dy_lon >= 0)] = -np.pi + slopedir[np.logical_and(dy_lat > 0, dy_lon >= 0)]
+
+    return(lat, slope, slopedir)
+
+def SunInfluence(lat,slope,slopedir,day):
+
+    '''
+    This function calculates the radiation on the horizontal and the sloping
+    terrain of one day, see SlopeInfluence.
+
+    lat -- numpy array with the latitude in radians
+    slope -- numpy array with the slope, see SlopeAspect
+    slopedir -- numpy array with the slope direction, see SlopeAspect
+    day -- Day of the year
+    '''
+
+    # Solar constant
+    G = 1367.0
+    
+    # declination of earth
+    delta = np.arcsin(np.sin(23.45/360*2*np.pi)*np.sin((360.0/365.0)*(day-81)/360*2*np.pi))
+    # EQ 2
+    D2 = 1 / (1 + 0.033* np.cos(day/365*2*np.pi))
+    
+    constant =  G / D2 / (2*np.pi) 
     
     # Now calculate the expected clear sky radiance day by day for:
     # - A horizontal surface
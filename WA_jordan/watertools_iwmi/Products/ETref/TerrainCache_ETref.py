@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+'''
+Module: Products/ETref
+
+Description:
+This module caches the parts of the daily ETref calculation that only depend
+on the DEM and the day of the year: the DEM reprojected to the output pixel
+size, the slope and slope direction (aspect) and the radiation grids of the
+slope correction (SlopeInfluence) for every day of the year. The radiation
+grids are stored in memory-mapped .npy files next to the DEM, so every day
+(and every parallel worker) only reads the grids of its day of the year.
+The cache is rebuilt when the HydroSHED DEM or the pixel size changes.
+'''
+# import general python modules
+import os
+import json
+import numpy as np
+
+# import WA+ modules
+from watertools.General import raster_conversions as RC
+from watertools.General import data_conversions as DC
+from watertools.Products.ETref.SlopeInfluence_ETref import SlopeAspect, SunInfluence
+
+# Open caches of this process
+_CACHES = dict()
+
+class TerrainCache(object):
+    """
+    Terrain and radiation grids of the DEM used for ETref
+
+    Keyword arguments:
+    Dir -- 'C:/file/to/path/'
+    pixel_size -- The output pixel size, False to use the DEM resolution
+    """
+    def __init__(self, Dir, pixel_size):
+        DEM_folder = os.path.join(Dir, 'HydroSHED', 'DEM')
+        self.source = os.path.join(DEM_folder, 'DEM_HydroShed_m_3s.tif')
+        if not pixel_size:
+            self.dem_path = self.source
+        else:
+            self.dem_path = os.path.join(DEM_folder, 'DEM_HydroShed_m_reshaped_for_ETref.tif')
+        self.pixel_size = pixel_size
+        self.folder = os.path.join(DEM_folder, 'ETref_terrain' if not pixel_size else 'ETref_terrain_%s' %pixel_size)
+        self.meta_path = os.path.join(self.folder, 'meta.json')
+
+        st = os.stat(self.source)
+        self.key = {'source': os.path.abspath(self.source), 'size': st.st_size,
+                    'mtime_ns': st.st_mtime_ns, 'pixel_size': pixel_size}
+
+        meta = None
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+        if meta is None or meta['key'] != self.key or not os.path.exists(self.dem_path):
+            meta = self._build()
+        self.days = set(meta['days'])
+        self._open()
+
+    def _build(self):
+        # Reproject the DEM once to the output pixel size
+        if self.pixel_size:
+            dest, ulx, lry, lrx, uly, epsg_to = RC.reproject_dataset_epsg(self.source, pixel_spacing = self.pixel_size, epsg_to=4326, method = 2)
+            DEM_data = dest.GetRasterBand(1).ReadAsArray()
+            dest = None
+            geo_dem = [ulx, self.pixel_size, 0.0, uly, 0.0, - self.pixel_size]
+            DC.Save_as_tiff(name=self.dem_path, data=DEM_data, geo=geo_dem, projection='4326')
+
+        # Same coordinates as in slope_correct
+        GeoT, Projection, xsize, ysize = RC.Open_array_info(self.dem_path)
+        minx = GeoT[0]
+        miny = GeoT[3] + xsize*GeoT[4] + ysize*GeoT[5]
+        x = np.flipud(np.arange(xsize)*GeoT[1] + minx + GeoT[1]/2)
+        y = np.flipud(np.arange(ysize)*-GeoT[5] + miny + -GeoT[5]/2)
+
+        demmap = RC.Open_tiff_array(self.dem_path)
+        demmap[demmap<0]=0
+        lat, slope, slopedir = SlopeAspect(demmap, y, x)
+        fi = 0.75 + 0.25*np.cos(slope) - (0.5*slope/np.pi)
+
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        np.savez(os.path.join(self.folder, 'terrain.npz'), lat = lat,
+                 slope = slope, slopedir = slopedir, fi = fi)
+
+        # Grids per day of the year, index 0 is day 1. The radiation on a
+        # horizontal surface only depends on the latitude, one value per row.
+        np.lib.format.open_memmap(os.path.join(self.folder, 'slope_radiation.npy'), mode = 'w+',
+                                  dtype = np.float32, shape = (366, 2) + slope.shape).flush()
+        np.lib.format.open_memmap(os.path.join(self.folder, 'horizontal_radiation.npy'), mode = 'w+',
+                                  dtype = np.float64, shape = (366, 2, slope.shape[0])).flush()
+
+        meta = {'key': self.key, 'days': []}
+        self._write_meta(meta)
+        return meta
+
+    def _write_meta(self, meta):
+        tmp = self.meta_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, self.meta_path)
+
+    def _open(self, mode = 'r'):
+        terrain = np.load(os.path.join(self.folder, 'terrain.npz'))
+        self.lat = terrain['lat']
+        self.slope = terrain['slope']
+        self.slopedir = terrain['slopedir']
+        self.fi = terrain['fi']
+        self.slope_radiation = np.load(os.path.join(self.folder, 'slope_radiation.npy'), mmap_mode = mode)
+        self.horizontal_radiation = np.load(os.path.join(self.folder, 'horizontal_radiation.npy'), mmap_mode = mode)
+
+    def prepare(self, days):
+        """
+        Calculate and store the radiation grids of days of the year that are
+        not in the cache yet. Call this once before running days in parallel.
+
+        Keyword arguments:
+        days -- days of the year (1 to 366)
+        """
+        missing = sorted(set(int(day) for day in days) - self.days)
+        if not missing:
+            return
+        self._open(mode = 'r+')
+        for day in missing:
+            Ra_hor, Ra_slp, sinb, sinb_hor = self._calculate(day)
+            self.slope_radiation[day - 1, 0] = Ra_slp
+            self.slope_radiation[day - 1, 1] = sinb
+            self.horizontal_radiation[day - 1, 0] = Ra_hor[:, 0]
+            self.horizontal_radiation[day - 1, 1] = sinb_hor[:, 0]
+        self.slope_radiation.flush()
+        self.horizontal_radiation.flush()
+        self.days.update(missing)
+        self._write_meta({'key': self.key, 'days': sorted(self.days)})
+        self._open()
+
+    def _calculate(self, day):
+        with np.errstate(all = 'ignore'):
+            Ra_hor, Ra_slp, sinb, sinb_hor, fi, slope, ID = SunInfluence(self.lat, self.slope, self.slopedir, day)
+        return Ra_hor, Ra_slp, sinb, sinb_hor
+
+    def radiation(self, day):
+        """
+        Radiation grids of a day of the year, as returned by SlopeInfluence
+        (without the cells with two periods of sunlight)
+
+        Keyword arguments:
+        day -- day of the year (1 to 366)
+        """
+        if day in self.days:
+            cols = self.slope.shape[1]
+            Ra_hor = np.repeat(self.horizontal_radiation[day - 1, 0][:, None], cols, axis = 1)
+            sinb_hor = np.repeat(self.horizontal_radiation[day - 1, 1][:, None], cols, axis = 1)
+            Ra_slp = np.array(self.slope_radiation[day - 1, 0])
+            sinb = np.array(self.slope_radiation[day - 1, 1])
+        else:
+            Ra_hor, Ra_slp, sinb, sinb_hor = self._calculate(day)
+        return Ra_hor, Ra_slp, sinb, sinb_hor, self.fi, self.slope
+
+def terrain_cache(Dir, pixel_size):
+    """
+    Open the terrain cache of a directory once per process, see TerrainCache
+
+    Keyword arguments:
+    Dir -- 'C:/file/to/path/'
+    pixel_size -- The output pixel size, False to use the DEM resolution
+    """
+    key = (os.path.abspath(Dir), pixel_size)
+    cache = _CACHES.get(key)
+    if cache is not None:
+        st = os.stat(cache.source)
+        if cache.key['size'] != st.st_size or cache.key['mtime_ns'] != st.st_mtime_ns:
+            cache = None
+    if cache is None:
+        cache = TerrainCache(Dir, pixel_size)
+        _CACHES[key] = cache
+    elif os.path.exists(cache.meta_path):
+        # days added by an other process
+        with open(cache.meta_path) as f:
+            days = set(json.load(f)['days'])
+        if days - cache.days:
+            cache.days = days
+            cache._open()
+    return cache
@@ -6,20 +6,21 @@ Module: Products/ETref
 # import general python modules
 import sys
 import pandas as pd
-import numpy as np
 import calendar
 import os
-import gdal
 
 # import WA+ modules
 from watertools.General import raster_conversions as RC
 from watertools.General import data_conversions as DC
-from watertools.Products.ETref import daily
+from watertools.Products.ETref.CollectDataETref import CollectData
+from watertools.Products.ETref.CollectLANDSAFETref import CollectLANDSAF
+from watertools.Products.ETref.SetVarETref import SumVariables
 
 def main(Dir, Startdate = '', Enddate = '',
-         latlim = [-60, 60], lonlim = [-180, 180], pixel_size = False, cores = False, LANDSAF =  0, SourceLANDSAF=  '', Waitbar = 1):
+         latlim = [-60, 60], lonlim = [-180, 180], pixel_size = False, cores = False, LANDSAF =  0, SourceLANDSAF=  '', Waitbar = 1, save_daily = True):
     """
-    This function downloads TRMM3B43 V7 (monthly) data
+    This function creates ETref (monthly) data based on Hydroshed, GLDAS, and (CFSR/LANDSAF).
+    The daily ETref is summed in memory per month.
 
     Keyword arguments:
     Dir -- 'C:/file/to/path/'
@@ -30,7 +31,10 @@ def main(Dir, Startdate = '', Enddate = '',
     cores -- The number of cores used to run the routine.
              It can be 'False' to avoid using parallel computing
              routines.
+    LANDSAF -- if LANDSAF data must be used it is 1
+    SourceLANDSAF -- the path to the LANDSAF files
     Waitbar -- 1 (Default) will print the waitbar
+    save_daily -- True (Default) also creates the daily ETref tiff files
     """
 
     print('Create monthly Reference ET data for period %s till %s' %(Startdate, Enddate))
@@ -52,32 +56,20 @@ def main(Dir, Startdate = '', Enddate = '',
         Y=Date.year
         M=Date.month
         Mday=calendar.monthrange(Y,M)[1]
-        Days=pd.date_range(Date,Date+pd.Timedelta(days=Mday),freq='D')
         StartTime=Date.strftime('%Y')+'-'+Date.strftime('%m')+ '-01'
         EndTime=Date.strftime('%Y')+'-'+Date.strftime('%m')+'-'+str(Mday)
 
-        # Get ETref on daily basis
-        daily(Dir=Dir, Startdate=StartTime,Enddate=EndTime,latlim=latlim, lonlim=lonlim, pixel_size = pixel_size, cores=cores, LANDSAF=LANDSAF, SourceLANDSAF=SourceLANDSAF, Waitbar = 0)
+        # Download data (using the wa.Collect scripts)
+        CollectData(Dir, StartTime, EndTime, latlim, lonlim, cores, LANDSAF)
+        if LANDSAF == 1:
+            CollectLANDSAF(SourceLANDSAF, Dir, StartTime, EndTime, latlim, lonlim)
+
+        # Sum ETref on daily basis
+        dataMonth, DEMmap = SumVariables(Dir, StartTime, EndTime, latlim, lonlim, pixel_size, cores, LANDSAF, save_daily)
 
-        # Load DEM
-        if not pixel_size:
-            nameDEM='DEM_HydroShed_m_3s.tif'
-            DEMmap=os.path.join(Dir,'HydroSHED','DEM',nameDEM )
-        else:
-            DEMmap=os.path.join(Dir,'HydroSHED','DEM','DEM_HydroShed_m_reshaped_for_ETref.tif')
         # Get some geo-data to save results
         geo_ET, proj, size_X, size_Y = RC.Open_array_info(DEMmap)
 
-        dataMonth=np.zeros([size_Y,size_X])
-
-        for Day in Days[:-1]:
-            DirDay=os.path.join(Dir,'ETref','Daily','ETref_mm-day-1_daily_' + Day.strftime('%Y.%m.%d') + '.tif')
-            dataDay=gdal.Open(DirDay)
-            Dval=dataDay.GetRasterBand(1).ReadAsArray().astype(np.float32)
-            Dval[Dval<0]=0
-            dataMonth=dataMonth+Dval
-            dataDay=None
-
         # make geotiff file
         output_folder_month=os.path.join(Dir,'ETref','Monthly')
         if os.path.exists(output_folder_month)==False:
@@ -59,9 +59,9 @@ gdal.SetConfigOption("CPL_DEBUG", "ON")
 
 # Import custom modules
 try:
-    from WA_jordan import createNC_cmi, pre_proc_sm_balance
+    from WA_jordan import createNC_cmi, pre_proc_sm_balance, step_cache
     from WA_jordan.SMBalance import run_SMBalance
-    from WAsheets import model_hydroloop as mhl
+    from WAsheets import model_hydroloop as mhl, profiling
     from WAsheets import sheet1, sheet2, print_sheet
 except ImportError as e:
     logger.error(f"Failed to import modules: {e}")
@@ -82,6 +82,17 @@ class Backend:
         self.max_progress = 100
         self.last_progress_update = 0
         self.progress_lock = threading.Lock()
+        # reuse the outputs of steps whose inputs and parameters are unchanged,
+        # opt-in, the cache holds up to cache_max_size bytes of its own
+        self.use_cache = False
+        self.cache_max_size = step_cache.MAX_SIZE
+
+    def get_step_cache(self, folder):
+        """Return the step cache stored in ``folder``, or None when caching is off."""
+        if not self.use_cache or not folder:
+            return None
+        return step_cache.StepCache(os.path.join(folder, '.step_cache'),
+                                    max_size=self.cache_max_size)
 
     def log_message(self, message):
         logger.info(message)
@@ -109,7 +120,15 @@ class Backend:
                         logger.error(f"Progress callback error: {str(e)}")
                 self.last_progress_update = now
 
-    def create_netcdf(self, input_dir, shp_path, template_path, output_dir, progress_callback=None, basin_name=None):
+    def create_netcdf(self, input_dir, shp_path, template_path, output_dir, progress_callback=None, basin_name=None,
+                      n_workers=None, append=False):
+        """Create the input NetCDF files from the TIFFs in ``input_dir``.
+
+        ``n_workers`` is the number of worker processes warping the dates in
+        parallel; ``None`` uses all CPU cores. With ``append`` existing
+        NetCDF files are kept and only the dates they do not hold yet are
+        added.
+        """
         if self.running:
             return False, [self.log_message("A task is already running.")]
         self.running = True
@@ -217,12 +236,19 @@ class Backend:
                 )
                 
                 # Create the NetCDF file
-                try:
-                    with Dataset(nc_path, 'w', format='NETCDF4') as nc_file:
-                        pass  # Create empty file to ensure write permissions
-                except OSError as e:
-                    messages.append(self.log_message(f"Error: Failed to create NetCDF file {nc_filename}: {str(e)}"))
-                    return False, messages
+                appending = append and os.path.isfile(nc_path)
+                if appending:
+                    if not os.access(nc_path, os.W_OK):
+                        messages.append(self.log_message(f"Error: NetCDF file {nc_filename} is not writable"))
+                        return False, messages
+                    messages.append(self.log_message(f"Appending new dates to {nc_filename}"))
+                else:
+                    try:
+                        with Dataset(nc_path, 'w', format='NETCDF4') as nc_file:
+                            pass  # Create empty file to ensure write permissions
+                    except OSError as e:
+                        messages.append(self.log_message(f"Error: Failed to create NetCDF file {nc_filename}: {str(e)}"))
+                        return False, messages
                 
                 # Call make_netcdf and surface granular file based progress.
                 def dataset_progress_callback(processed, total, message=None):
@@ -251,6 +277,13 @@ class Backend:
                         progress_warning_logged = True
                     if supports_expected_kw:
                         call_kwargs["expected_total"] = file_counts[d]
+                    if make_netcdf_signature and "n_workers" in make_netcdf_signature.parameters:
+                        call_kwargs["n_workers"] = n_workers if n_workers else (os.cpu_count() or 1)
+                    if appending:
+                        if not (make_netcdf_signature and "append" in make_netcdf_signature.parameters):
+                            messages.append(self.log_message("Error: make_netcdf does not support appending"))
+                            return False, messages
+                        call_kwargs["append"] = True
 
                     success = make_netcdf_fn(
                         nc_path,
@@ -323,13 +356,26 @@ class Backend:
                 current_step += 33
                 self.update_progress(progress_callback, current_step, total_steps, message=f"Validating {key}")
 
+            cache = self.get_step_cache(directory)
             with warnings.catch_warnings():
                 warnings.simplefilter("ignore")
-                nrd_nc = pre_proc_sm_balance.rainy_days(nc_files['dailyP'], nc_files['P'])
+                nrd_inputs = (nc_files['dailyP'], nc_files['P'])
+                if cache is not None:
+                    nrd_nc = cache.call('rainy_days', pre_proc_sm_balance.rainy_days,
+                                        inputs={'dailyP': nc_files['dailyP'], 'P': nc_files['P']},
+                                        args=nrd_inputs)
+                else:
+                    nrd_nc = pre_proc_sm_balance.rainy_days(*nrd_inputs)
                 current_step += 33
                 self.update_progress(progress_callback, current_step, total_steps, message="Processing rainy days")
 
-            I_nc = pre_proc_sm_balance.interception(nc_files['LAI'], nc_files['P'], nrd_nc)
+            i_inputs = (nc_files['LAI'], nc_files['P'], nrd_nc)
+            if cache is not None:
+                I_nc = cache.call('interception', pre_proc_sm_balance.interception,
+                                  inputs={'LAI': nc_files['LAI'], 'P': nc_files['P'], 'NRD': nrd_nc},
+                                  args=i_inputs)
+            else:
+                I_nc = pre_proc_sm_balance.interception(*i_inputs)
             current_step = total_steps
             self.update_progress(progress_callback, current_step, total_steps, force_update=True, message="Processing interception")
 
@@ -341,7 +387,16 @@ class Backend:
         finally:
             self.running = False
 
-    def run_smbalance(self, directory, start_year, end_year, f_perc, f_smax, cf, f_bf, deep_perc_f, progress_callback=None):
+    def run_smbalance(self, directory, start_year, end_year, f_perc, f_smax, cf, f_bf, deep_perc_f, progress_callback=None,
+                      tile_size=None, n_workers=None, max_memory=None):
+        """Run the soil moisture balance on the NetCDF files in ``directory``.
+
+        ``tile_size`` is the size in pixels of the square tiles processed at
+        once and ``n_workers`` the number of worker processes; ``None`` uses
+        the SMBalance default tile size and all CPU cores. ``max_memory`` is
+        a ceiling in MB for the tiles held in memory, which shrinks the tiles
+        when needed.
+        """
         if self.running:
             return False, ["A task is already running."]
         self.running = True
@@ -417,6 +472,11 @@ class Backend:
             )
 
             call_kwargs = dict(params)
+            if smbalance_signature and "n_workers" in smbalance_signature.parameters:
+                call_kwargs["tile_size"] = tile_size
+                call_kwargs["n_workers"] = n_workers if n_workers else (os.cpu_count() or 1)
+            if smbalance_signature and "max_memory" in smbalance_signature.parameters:
+                call_kwargs["max_memory"] = max_memory
             if supports_smb_progress_kw:
                 call_kwargs["progress_callback"] = on_progress
             elif progress_callback:
@@ -425,13 +485,15 @@ class Backend:
                 ))
 
             # Run SMBalance while streaming progress updates when supported
-            run_SMBalance(
-                directory,
-                nc_files_dict,
-                start_year,
-                end_year,
-                **call_kwargs,
-            )
+            cache = self.get_step_cache(directory)
+            smbalance_args = (directory, nc_files_dict, start_year, end_year)
+            if cache is not None:
+                cache.call('SMBalance', run_SMBalance,
+                           inputs=dict(nc_files_dict),
+                           params=dict(params, start_year=start_year, end_year=end_year),
+                           args=smbalance_args, kwargs=call_kwargs)
+            else:
+                run_SMBalance(*smbalance_args, **call_kwargs)
 
             # Update progress after completion
             self.update_progress(progress_callback, 100, 100, force_update=True, message="SMBalance completed")
@@ -613,7 +675,27 @@ class Backend:
             messages.append(self.log_message(f"Error in finalizing Hydroloop outputs: {str(e)}"))
             return basin, messages
 
-    def run_hydroloop(self, progress_callback=None):
+    def save_hydroloop_profile(self, records):
+        """Save the timing and resource usage of the Hydroloop steps as
+        ``hydroloop_profile.json`` in the output folder."""
+        output_dir = self.BASIN.get('output_folder') if self.BASIN else None
+        if not output_dir:
+            return None
+        try:
+            return profiling.write_run_profile(
+                records, os.path.join(output_dir, 'hydroloop_profile.json'),
+                basin=self.BASIN.get('name'))
+        except Exception as e:
+            logger.error(f"Failed to save the Hydroloop run profile: {str(e)}")
+            return None
+
+    def run_hydroloop(self, progress_callback=None, fused=True):
+        """Run the Hydroloop steps on the initialized BASIN.
+
+        With ``fused`` the supply, demand, return and residential steps run as
+        one in-memory computation that only saves the datacubes used by the
+        sheets; otherwise every step saves its own NetCDF files.
+        """
         if self.running:
             return False, ["A task is already running."]
         if not self.BASIN:
@@ -621,39 +703,53 @@ class Backend:
         self.running = True
         try:
             messages = []
+            if fused:
+                supply_steps = [mhl.calc_supply_fused]
+            else:
+                supply_steps = [
+                    mhl.split_supply, 
+                    mhl.calc_demand,
+                    mhl.calc_return, 
+                    mhl.calc_residential_supply, 
+                    mhl.calc_total_supply,
+                ]
             process_steps = [
                 mhl.resample_lu, 
                 mhl.split_et, 
-                mhl.split_supply, 
-                mhl.calc_demand,
-                mhl.calc_return, 
-                mhl.calc_residential_supply, 
-                mhl.calc_total_supply,
+                *supply_steps,
                 mhl.calc_fraction, 
                 mhl.calc_time_series, 
                 self.finalize_hydroloop_outputs
             ]
             
             total_steps = len(process_steps) * 100
-            current_step = 0
+            cache = self.get_step_cache(self.BASIN.get('output_folder'))
+            profile = []
             
             for i, step in enumerate(process_steps):
                 messages.append(self.log_message(f"Starting {step.__name__}"))
-                for substep in range(100):
-                    time.sleep(0.01)
-                    current_step += 1
-                    self.update_progress(progress_callback, current_step, total_steps, message=f"Running {step.__name__}")
-                    
-                result = step(self.BASIN)
+                reached = {'units': 0}
+                
+                def step_progress(name, done, total, offset=i * 100):
+                    # Units of work done by the step (dask tasks, time slices), 99 per step. The
+                    # total grows when a step starts another computation, never go back.
+                    reached['units'] = max(reached['units'], 99 * done // total if total else 0)
+                    self.update_progress(progress_callback, offset + reached['units'], total_steps,
+                                         message=f"Running {name} ({done}/{total})")
+                
+                try:
+                    result, record = mhl.run_step(step, self.BASIN, cache=cache,
+                                                  progress=step_progress, records=profile)
+                finally:
+                    self.save_hydroloop_profile(profile)
                 if isinstance(result, tuple):
                     self.BASIN, step_messages = result
                     messages.extend(step_messages)
                 else:
                     self.BASIN = result
                     
-                messages.append(self.log_message(f"Completed {step.__name__}"))
-                current_step = (i + 1) * 100
-                self.update_progress(progress_callback, current_step, total_steps, force_update=True, message=f"Completed {step.__name__}")
+                messages.append(self.log_message(f"Completed {step.__name__} in {record['wall_time']:.1f} s"))
+                self.update_progress(progress_callback, (i + 1) * 100, total_steps, force_update=True, message=f"Completed {step.__name__}")
                 
             messages.append(self.log_message("Hydroloop processing completed successfully."))
             return True, messages
@@ -1442,6 +1442,10 @@ def main():
 if __name__ == "__main__":
     from PyQt5.QtWidgets import QApplication
     import sys
+    import multiprocessing
+
+    # SMBalance runs its tiles in worker processes, needed for frozen builds
+    multiprocessing.freeze_support()
 
     app = QApplication(sys.argv)
 